@@ -0,0 +1,279 @@
+"""Benchmarks for spawning synthetic template trees.
+
+Run `python benchmarks/bench.py -o baseline.json` to record results and
+`python benchmarks/bench.py --baseline baseline.json` to compare a later run
+against them. The comparison exits with status 1 if any benchmark became
+slower than the threshold allows.
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+from confspawn.config import clear_config_cache
+from confspawn.spawn import recipe, spawn_write
+
+RESULTS_VERSION = 1
+
+# Keys per config section
+SECTION_SIZE = 50
+
+# Parameters of the synthetic trees: number of files, maximum directory depth, fraction
+# of the files that are templates, lines per template and number of config values
+SCENARIOS: t.Dict[str, t.Dict[str, t.Any]] = {
+    "small": dict(
+        files=50, depth=1, template_ratio=0.5, template_lines=20, config_keys=100
+    ),
+    "wide": dict(
+        files=1000, depth=0, template_ratio=0.5, template_lines=20, config_keys=500
+    ),
+    "deep": dict(
+        files=500, depth=6, template_ratio=0.5, template_lines=20, config_keys=500
+    ),
+    "large_templates": dict(
+        files=10, depth=1, template_ratio=1.0, template_lines=2000, config_keys=500
+    ),
+    "large_config": dict(
+        files=200, depth=1, template_ratio=0.5, template_lines=20, config_keys=20000
+    ),
+}
+
+
+def write_config(config_path: Path, config_keys: int):
+    lines = []
+    for k in range(config_keys):
+        if k % SECTION_SIZE == 0:
+            lines.append(f"\n[section_{k // SECTION_SIZE}]")
+        lines.append(f'key_{k % SECTION_SIZE} = "value {k}"')
+    lines.append("\n[arrays]")
+    lines.append(f"items = [{', '.join(str(i) for i in range(100))}]")
+    config_path.write_text("\n".join(lines) + "\n")
+
+
+def _template_text(i: int, template_lines: int, config_keys: int) -> str:
+    lines = []
+    for line in range(template_lines):
+        k = (i * 7 + line) % config_keys
+        lines.append(
+            f"line_{line} = {{{{ section_{k // SECTION_SIZE}.key_{k % SECTION_SIZE} }}}}"
+        )
+    lines.append("{% for item in arrays['items'] %}{{ item }},{% endfor %}")
+    return "\n".join(lines) + "\n"
+
+
+def generate_tree(
+    root: Path,
+    files: int,
+    depth: int,
+    template_ratio: float,
+    template_lines: int,
+    config_keys: int,
+    name_prefix: str = "",
+    prefix_name: str = "confspawn_",
+):
+    """Writes a tree of `files` files to `root`, spread over directories up to
+    `depth` levels deep, of which a `template_ratio` fraction are templates
+    reading from a config with `config_keys` values."""
+    for i in range(files):
+        dir_path = root.joinpath(
+            *(f"dir_{(i + level) % 3}" for level in range(i % (depth + 1)))
+        )
+        dir_path.mkdir(parents=True, exist_ok=True)
+        # Spreads the templates evenly over the files
+        if int((i + 1) * template_ratio) > int(i * template_ratio):
+            dir_path.joinpath(f"{prefix_name}{name_prefix}file_{i}.conf").write_text(
+                _template_text(i, template_lines, config_keys)
+            )
+        else:
+            dir_path.joinpath(f"{name_prefix}file_{i}.txt").write_bytes(
+                f"asset {i}\n".encode() * 400
+            )
+
+
+def measure(run: t.Callable[[], None], repeat: int) -> t.Dict[str, float]:
+    """Times `run` `repeat` times, clearing the config cache before each run
+    so every run starts like a new process."""
+    times = []
+    for _ in range(repeat):
+        clear_config_cache()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "repeat": repeat,
+    }
+
+
+def bench_scenario(
+    name: str, params: dict, work_dir: Path, repeat: int
+) -> t.Dict[str, dict]:
+    config_path = work_dir.joinpath("config.toml")
+    write_config(config_path, params["config_keys"])
+    source = work_dir.joinpath("source")
+    generate_tree(source, **params)
+    target = work_dir.joinpath("target")
+
+    results = dict()
+    results[f"spawn_write/{name}"] = measure(
+        lambda: spawn_write(config_path, source, target, recurse=True, cache_dir=None),
+        repeat,
+    )
+
+    incremental_target = work_dir.joinpath("incremental")
+    spawn_write(
+        config_path,
+        source,
+        incremental_target,
+        recurse=True,
+        cache_dir=None,
+        incremental=True,
+    )
+    results[f"spawn_write_incremental/{name}"] = measure(
+        lambda: spawn_write(
+            config_path,
+            source,
+            incremental_target,
+            recurse=True,
+            cache_dir=None,
+            incremental=True,
+        ),
+        repeat,
+    )
+
+    # Two sources that are merged into one target, with one of them also spawned to a
+    # nested target
+    half = dict(params, files=max(1, params["files"] // 2))
+    source_a = work_dir.joinpath("source_a")
+    source_b = work_dir.joinpath("source_b")
+    generate_tree(source_a, name_prefix="a_", **half)
+    generate_tree(source_b, name_prefix="b_", **half)
+    out = work_dir.joinpath("out")
+    recipe_path = work_dir.joinpath("recipe.toml")
+    recipe_path.write_text(
+        f"config = {json.dumps(str(config_path))}\n"
+        + "".join(
+            f"\n[[sources]]\nsource = {json.dumps(str(src))}\n"
+            f"target = {json.dumps(str(tgt))}\nenv = 'less'\nrecurse = true\n"
+            for src, tgt in [
+                (source_a, out.joinpath("main")),
+                (source_b, out.joinpath("main")),
+                (source_a, out.joinpath("main", "nested")),
+            ]
+        )
+    )
+    results[f"recipe/{name}"] = measure(
+        lambda: recipe(recipe_path, cache_dir=None), repeat
+    )
+
+    return results
+
+
+def bench_confenv(work_dir: Path, repeat: int) -> t.Dict[str, dict]:
+    config_path = work_dir.joinpath("config.toml")
+    write_config(config_path, SCENARIOS["small"]["config_keys"])
+    code = (
+        "import sys\n"
+        "from confspawn.cli import config_value\n"
+        f"sys.argv = ['confenv', '-c', {str(config_path)!r}, '-v', 'section_0.key_0']\n"
+        "config_value()\n"
+    )
+    return {
+        "confenv/startup": measure(
+            lambda: subprocess.run(
+                [sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL
+            ),
+            repeat,
+        )
+    }
+
+
+def compare(
+    results: t.Dict[str, dict], baseline: t.Dict[str, dict], threshold: float
+) -> t.List[str]:
+    """Prints how each benchmark compares to the baseline and returns the names
+    of those that are more than `threshold` (a fraction) slower."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<40} {result['min'] * 1000:10.2f} ms   (new)")
+            continue
+        ratio = result["min"] / baseline[name]["min"]
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:<40} {result['min'] * 1000:10.2f} ms   {ratio:6.2f}x"
+            f"{'   REGRESSION' if regressed else ''}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Only run these scenarios. Defaults to all of them.",
+    )
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare to results in this JSON file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Fraction by which a benchmark may be slower than the baseline. "
+        "Defaults to 0.25.",
+    )
+    args = parser.parse_args()
+
+    results = dict()
+    work_root = Path(tempfile.mkdtemp(prefix="confspawn_bench_"))
+    try:
+        for name in args.scenario or SCENARIOS:
+            work_dir = work_root.joinpath(name)
+            work_dir.mkdir()
+            results.update(bench_scenario(name, SCENARIOS[name], work_dir, args.repeat))
+        confenv_dir = work_root.joinpath("confenv")
+        confenv_dir.mkdir()
+        results.update(bench_confenv(confenv_dir, args.repeat))
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "version": RESULTS_VERSION,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    baseline = dict()
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
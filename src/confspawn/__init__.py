@@ -5,22 +5,61 @@ PostgreSQL database.
 .. include:: ./documentation.md
 """
 
-from confspawn.spawn import (
-    spawn_write,
-    load_config_value,
-    move_other_files,
-    spawn_templates,
-    recipe,
-)
-from confspawn.cli import spawner, config_value, recipizer
+import typing as t
+
+# The public functions are imported lazily, so that i.e. the confenv command does not
+# have to import Jinja
+_lazy_imports = {
+    "spawn_write": "confspawn.spawn",
+    "spawn_memory": "confspawn.spawn",
+    "SpawnedFile": "confspawn.spawn",
+    "load_config_value": "confspawn.config",
+    "load_config_values": "confspawn.config",
+    "move_other_files": "confspawn.spawn",
+    "spawn_templates": "confspawn.spawn",
+    "recipe": "confspawn.spawn",
+    "spawner": "confspawn.cli",
+    "config_value": "confspawn.cli",
+    "recipizer": "confspawn.cli",
+    "SpawnTimer": "confspawn.timing",
+}
+
+if t.TYPE_CHECKING:
+    from confspawn.spawn import (
+        spawn_write,
+        spawn_memory,
+        SpawnedFile,
+        move_other_files,
+        spawn_templates,
+        recipe,
+    )
+    from confspawn.config import load_config_value, load_config_values
+    from confspawn.cli import spawner, config_value, recipizer
+    from confspawn.timing import SpawnTimer
 
 __all__ = [
     "spawn_write",
+    "spawn_memory",
+    "SpawnedFile",
     "load_config_value",
+    "load_config_values",
     "move_other_files",
     "spawn_templates",
     "spawner",
     "config_value",
     "recipe",
     "recipizer",
+    "SpawnTimer",
 ]
+
+
+def __getattr__(name: str):
+    if name in _lazy_imports:
+        from importlib import import_module
+
+        return getattr(import_module(_lazy_imports[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
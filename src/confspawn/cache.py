@@ -0,0 +1,171 @@
+import os
+import threading
+import typing as t
+from hashlib import sha1
+from pathlib import Path
+
+import jinja2
+from jinja2 import Environment
+from jinja2.bccache import Bucket, BytecodeCache, FileSystemBytecodeCache
+
+__all__ = ["SpawnBytecodeCache", "MemoryBytecodeCache"]
+
+# 64 MiB
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+def _confspawn_version() -> str:
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:  # pragma: no cover
+        return "unknown"
+    try:
+        return version("confspawn")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+class SpawnBytecodeCache(FileSystemBytecodeCache):
+    """Persistent cache of compiled templates, stored in `directory`.
+
+    Entries are keyed by the template name and filename, a hash of the
+    template source and the versions of confspawn and Jinja, so a changed
+    template or an upgrade never loads stale bytecode. When the total size
+    of the cache exceeds `max_size` bytes, `prune` removes the least recently
+    used entries.
+    """
+
+    pattern = "__confspawn_%s.cache"
+
+    def __init__(
+        self,
+        directory: t.Union[str, os.PathLike],
+        max_size: int = DEFAULT_MAX_SIZE,
+    ) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        super().__init__(str(directory), self.pattern)
+        self.max_size = max_size
+        self.version_tag = (
+            f"confspawn-{_confspawn_version()}/jinja2-{jinja2.__version__}"
+        )
+
+    def get_bucket(
+        self,
+        environment: Environment,
+        name: str,
+        filename: t.Optional[str],
+        source: str,
+    ) -> Bucket:
+        checksum = self.get_source_checksum(source)
+        key_parts = (self.version_tag, name, filename or "", checksum)
+        key = sha1("\0".join(key_parts).encode("utf-8")).hexdigest()
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket: Bucket) -> None:
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            # Mark the entry as recently used for eviction
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def prune(self) -> None:
+        """Remove the least recently used entries until the cache is no
+        larger than `max_size`."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.startswith("__confspawn_"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, entry_path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total -= size
+
+
+class MemoryBytecodeCache(BytecodeCache):
+    """Keeps compiled templates in memory, so that environments in the same
+    process (like those of the targets of a recipe) compile each template
+    only once.
+
+    Entries are keyed by the template name and filename and a hash of the
+    template source. If `persistent` is set,
+    templates missing in memory are looked up in it and newly compiled ones
+    are also stored in it. Only the persistent cache is kept when pickled
+    (i.e. when sent to another process).
+    """
+
+    def __init__(self, persistent: t.Optional[SpawnBytecodeCache] = None) -> None:
+        self.persistent = persistent
+        self._code: t.Dict[str, t.Any] = dict()
+        # Buckets of the persistent cache, to store the code once compiled
+        self._pending: t.Dict[str, Bucket] = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"persistent": self.persistent}
+
+    def __setstate__(self, state):
+        self.__init__(state["persistent"])
+
+    def get_bucket(
+        self,
+        environment: Environment,
+        name: str,
+        filename: t.Optional[str],
+        source: str,
+    ) -> Bucket:
+        checksum = self.get_source_checksum(source)
+        key = sha1(
+            "\0".join((name, filename or "", checksum)).encode("utf-8")
+        ).hexdigest()
+        bucket = Bucket(environment, key, checksum)
+        with self._lock:
+            bucket.code = self._code.get(key)
+        if bucket.code is None and self.persistent is not None:
+            persistent_bucket = self.persistent.get_bucket(
+                environment, name, filename, source
+            )
+            if persistent_bucket.code is not None:
+                bucket.code = persistent_bucket.code
+                with self._lock:
+                    self._code[key] = bucket.code
+            else:
+                with self._lock:
+                    self._pending[key] = persistent_bucket
+        return bucket
+
+    def load_bytecode(self, bucket: Bucket) -> None:
+        # Done in get_bucket
+        pass
+
+    def dump_bytecode(self, bucket: Bucket) -> None:
+        with self._lock:
+            # Code objects are immutable, so they can be shared between environments
+            self._code[bucket.key] = bucket.code
+            persistent_bucket = self._pending.pop(bucket.key, None)
+        if persistent_bucket is not None:
+            persistent_bucket.code = bucket.code
+            self.persistent.dump_bytecode(persistent_bucket)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._code.clear()
+            self._pending.clear()
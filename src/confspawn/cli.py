@@ -1,23 +1,36 @@
 import argparse
+import json
 import pathlib as p
+import re
+import shlex
+import typing as t
 
-from confspawn import load_config_value, spawn_write, recipe
+from confspawn.config import load_config_value, load_config_values
+from confspawn.link import link_modes
 
 
 def spawner():
     """
     ```shell
-    usage: confspawn [-h] -c CONFIG -s TEMPLATE -t TARGET [-r] [-p PREFIX]
+    usage: confspawn [-h] -c CONFIG -s TEMPLATE -t TARGET [-r] [-p PREFIX] [-e ENV]
+                     [-i PATTERN] [--cache-dir CACHE_DIR] [--incremental] [-j JOBS]
+                     [-w WORKERS] [--fan-out KEY]
+                     [--link-mode {copy,hardlink,reflink,symlink,auto}] [--atomic]
+                     [--skip-unchanged] [--watch] [--poll] [--timings [FILE]]
+                     [--peak-memory]
 
     Easily build configuration files from templates.
 
     examples:
     confspawn -c ./config.toml -s ./foo/templates -t /home/me/target
+    confspawn -c ./config.toml -s ./foo/templates -t ./out/{env} -e staging -e production
 
     optional arguments:
       -h, --help            show this help message and exit
       -c CONFIG, --config CONFIG
-                            File path for your TOML configuration file.
+                            File path for your TOML configuration file. Can be
+                            repeated to layer multiple files, in which case later
+                            files override values of earlier ones.
       -s TEMPLATE, --template TEMPLATE
                             Template directory path where your configuration
                             templates are. Other files not indicated by prefix
@@ -35,7 +48,54 @@ def spawner():
       -e ENV, --env ENV     Useful to specify environment-related modes, i.e.
                             production or development. 'confspawn_env.value' will
                             refer to 'confspawn_env.env.value'. Defaults to
-                            'less'.
+                            'less'. Can be repeated to spawn for multiple envs,
+                            in which case '{env}' in the target is replaced by
+                            the env.
+      -i PATTERN, --ignore PATTERN
+                            Gitignore-style pattern of files and directories that
+                            are not spawned (can be repeated). Patterns in a
+                            '.confspawnignore' file in the template directory are
+                            also used. Excluded directories are not entered.
+      --cache-dir CACHE_DIR
+                            Directory in which compiled templates are cached
+                            between runs. Defaults to the value of the
+                            CONFSPAWN_CACHE env var, if set. Otherwise, no cache
+                            is used.
+      --incremental         Only re-render or copy the files whose inputs changed
+                            since the previous incremental run, instead of
+                            rebuilding the target directory.
+      -j JOBS, --jobs JOBS  Number of processes used to render templates in
+                            parallel. Defaults to 1.
+      -w WORKERS, --workers WORKERS
+                            Number of envs that are spawned concurrently, when
+                            spawning for multiple envs. Defaults to 1.
+      --fan-out KEY         Key of an array of tables in the config. The
+                            templates are spawned once for each item, which is
+                            available as 'item' in the templates, to the target
+                            formatted with the fields of the item (i.e.
+                            './hosts/{name}').
+      --link-mode {copy,hardlink,reflink,symlink,auto}
+                            How non-template files are placed in the target.
+                            'hardlink', 'reflink' and 'symlink' fall back to
+                            copying if the file system does not support them,
+                            'auto' uses a reflink if possible. Defaults to 'copy'.
+      --atomic              Write to a staging directory first and then replace
+                            the target with it using a rename, so the target is
+                            never partially written.
+      --skip-unchanged      Leave output files that already have the right
+                            contents untouched, so they keep their modification
+                            time. Other files in the target are removed.
+      --watch               Keep running and update the target after every change
+                            to the templates, other files or config. Only the
+                            affected files are spawned again.
+      --poll                Detect changes in watch mode by polling the files,
+                            instead of using inotify (which is only available on
+                            Linux).
+      --timings [FILE]      Write the duration of each phase and template, and the
+                            number and size of the written files, as JSON to this
+                            file (or to stdout if none is given).
+      --peak-memory         With --timings, also record the peak memory allocated
+                            while spawning, which makes spawning slower.
 
     ```
     """
@@ -45,12 +105,19 @@ def spawner():
         description="Easily build configuration files from templates.\n"
         "\n\n"
         "examples:\n"
-        f"{cli_name} -c ./config.toml -s ./foo/templates -t /home/me/target\n",
+        f"{cli_name} -c ./config.toml -s ./foo/templates -t /home/me/target\n"
+        f"{cli_name} -c ./config.toml -s ./foo/templates -t ./out/{{env}} -e staging "
+        "-e production\n",
     )
 
     config_nm = "config"
-    config_help = "File path for your TOML configuration file."
-    parser.add_argument("-c", f"--{config_nm}", help=config_help, required=True)
+    config_help = (
+        "File path for your TOML configuration file. Can be repeated to layer\n"
+        "multiple files, in which case later files override values of earlier ones."
+    )
+    parser.add_argument(
+        "-c", f"--{config_nm}", help=config_help, action="append", required=True
+    )
 
     template_nm = "template"
     template_help = (
@@ -91,53 +158,362 @@ def spawner():
     env_help = (
         f"Useful to specify environment-related modes, i.e. production or development. "
         f"'confspawn_env.value' will refer to 'confspawn_env.env.value'. Defaults to"
-        f"'{env_default}'."
+        f"'{env_default}'. Can be repeated to spawn for multiple envs, in which case\n"
+        "'{env}' in the target is replaced by the env."
+    )
+    parser.add_argument(
+        "-e", f"--{env_nm}", help=env_help, action="append", required=False
+    )
+
+    ignore_nm = "ignore"
+    ignore_help = (
+        "Gitignore-style pattern of files and directories that are not spawned (can\n"
+        "be repeated). Patterns in a '.confspawnignore' file in the template\n"
+        "directory are also used. Excluded directories are not entered."
+    )
+    parser.add_argument(
+        "-i",
+        f"--{ignore_nm}",
+        help=ignore_help,
+        action="append",
+        metavar="PATTERN",
+        required=False,
+    )
+
+    cache_nm = "cache_dir"
+    cache_help = (
+        "Directory in which compiled templates are cached between runs. Defaults to\n"
+        "the value of the CONFSPAWN_CACHE env var, if set. Otherwise, no cache is used."
+    )
+    parser.add_argument("--cache-dir", dest=cache_nm, help=cache_help, required=False)
+
+    incremental_nm = "incremental"
+    incremental_help = (
+        "Only re-render or copy the files whose inputs changed since the previous\n"
+        "incremental run, instead of rebuilding the target directory."
+    )
+    parser.add_argument(
+        f"--{incremental_nm}",
+        help=incremental_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    jobs_nm = "jobs"
+    jobs_help = (
+        "Number of processes used to render templates in parallel. Defaults to 1."
+    )
+    parser.add_argument(
+        "-j", f"--{jobs_nm}", help=jobs_help, default=1, type=int, required=False
+    )
+
+    workers_nm = "workers"
+    workers_help = (
+        "Number of envs that are spawned concurrently, when spawning for multiple\n"
+        "envs. Defaults to 1."
+    )
+    parser.add_argument(
+        "-w", f"--{workers_nm}", help=workers_help, default=1, type=int, required=False
+    )
+
+    fan_out_nm = "fan_out"
+    fan_out_help = (
+        "Key of an array of tables in the config. The templates are spawned once for\n"
+        "each item, which is available as 'item' in the templates, to the target\n"
+        "formatted with the fields of the item (i.e. './hosts/{name}')."
+    )
+    parser.add_argument(
+        "--fan-out", dest=fan_out_nm, help=fan_out_help, metavar="KEY", required=False
+    )
+
+    link_nm = "link_mode"
+    link_default = "copy"
+    link_help = (
+        "How non-template files are placed in the target. 'hardlink', 'reflink' and\n"
+        "'symlink' fall back to copying if the file system does not support them,\n"
+        "'auto' uses a reflink if possible. Defaults to 'copy'."
+    )
+    parser.add_argument(
+        "--link-mode",
+        dest=link_nm,
+        help=link_help,
+        choices=link_modes,
+        default=link_default,
+        required=False,
+    )
+
+    atomic_nm = "atomic"
+    atomic_help = (
+        "Write to a staging directory first and then replace the target with it\n"
+        "using a rename, so the target is never partially written."
+    )
+    parser.add_argument(
+        f"--{atomic_nm}",
+        help=atomic_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    skip_nm = "skip_unchanged"
+    skip_help = (
+        "Leave output files that already have the right contents untouched, so they\n"
+        "keep their modification time. Other files in the target are removed."
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        dest=skip_nm,
+        help=skip_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    watch_nm = "watch"
+    watch_help = (
+        "Keep running and update the target after every change to the templates,\n"
+        "other files or config. Only the affected files are spawned again."
+    )
+    parser.add_argument(
+        f"--{watch_nm}",
+        help=watch_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    poll_nm = "poll"
+    poll_help = (
+        "Detect changes in watch mode by polling the files, instead of using inotify\n"
+        "(which is only available on Linux)."
+    )
+    parser.add_argument(
+        f"--{poll_nm}",
+        help=poll_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    timings_nm = "timings"
+    timings_help = (
+        "Write the duration of each phase and template, and the number and size of\n"
+        "the written files, as JSON to this file (or to stdout if none is given)."
+    )
+    parser.add_argument(
+        f"--{timings_nm}",
+        help=timings_help,
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        required=False,
+    )
+
+    memory_nm = "peak_memory"
+    memory_help = (
+        "With --timings, also record the peak memory allocated while spawning, which\n"
+        "makes spawning slower."
+    )
+    parser.add_argument(
+        "--peak-memory",
+        dest=memory_nm,
+        help=memory_help,
+        default=False,
+        required=False,
+        action="store_true",
     )
-    parser.add_argument("-e", f"--{env_nm}", help=env_help, required=False)
 
     config = vars(parser.parse_args())
 
-    config_path = p.Path(config[config_nm])
+    config_path = _config_paths(config[config_nm])
     template_path = p.Path(config[template_nm])
     target_path = p.Path(config[target_nm])
 
-    if config[prefix_nm] is None:
-        spawn_write(
+    # Imported here, so that the other commands do not have to import Jinja
+    from confspawn.spawn import spawn_write
+
+    # Only pass options that were set, so the defaults of spawn_write are used otherwise
+    options = dict()
+    if config[prefix_nm] is not None:
+        options["prefix_name"] = config[prefix_nm]
+    if config[cache_nm] is not None:
+        options["cache_dir"] = p.Path(config[cache_nm])
+    if config[ignore_nm] is not None:
+        options["ignore_patterns"] = config[ignore_nm]
+    if config[fan_out_nm] is not None:
+        options["fan_out"] = config[fan_out_nm]
+    # A single env is passed as is, so the target does not need to contain '{env}'
+    env_mode = config[env_nm]
+    if env_mode is not None and len(env_mode) == 1:
+        env_mode = env_mode[0]
+
+    if config[atomic_nm] and config[incremental_nm]:
+        parser.error("--atomic cannot be combined with --incremental")
+    if config[atomic_nm] and config[skip_nm]:
+        parser.error("--atomic cannot be combined with --skip-unchanged")
+    if config[watch_nm]:
+        if config[atomic_nm]:
+            parser.error("--watch cannot be combined with --atomic")
+        if config[skip_nm]:
+            parser.error("--watch cannot be combined with --skip-unchanged")
+        if config[timings_nm] is not None:
+            parser.error("--watch cannot be combined with --timings")
+
+        from confspawn.watch import watch_spawn
+
+        watch_spawn(
             config_path,
             template_path,
             target_path,
             config[recurse_nm],
-            env_mode=config[env_nm],
+            env_mode=env_mode,
+            jobs=config[jobs_nm],
+            workers=config[workers_nm],
+            link_mode=config[link_nm],
+            polling=config[poll_nm],
+            on_round=lambda names: _print_round(cli_name, names),
+            **options,
         )
+        return
+
+    timer = _make_timer(config[timings_nm], config[memory_nm])
+    spawn_write(
+        config_path,
+        template_path,
+        target_path,
+        config[recurse_nm],
+        env_mode=env_mode,
+        incremental=config[incremental_nm],
+        jobs=config[jobs_nm],
+        workers=config[workers_nm],
+        link_mode=config[link_nm],
+        atomic=config[atomic_nm],
+        skip_unchanged=config[skip_nm],
+        timer=timer,
+        **options,
+    )
+    if timer is not None:
+        _write_timings(timer, config[timings_nm])
+
+
+def _config_paths(config_args: t.List[str]) -> t.Union[p.Path, t.List[p.Path]]:
+    """A single config path, or a list of paths of layered config files."""
+    if len(config_args) == 1:
+        return p.Path(config_args[0])
+    return [p.Path(c) for c in config_args]
+
+
+def _print_round(cli_name: str, target_names: t.List[str]):
+    print(f"{cli_name}: spawned {', '.join(target_names)}", flush=True)
+
+
+def _make_timer(timings: t.Optional[str], memory: bool):
+    if timings is None:
+        return None
+
+    from confspawn.timing import SpawnTimer
+
+    return SpawnTimer(memory=memory)
+
+
+def _write_timings(timer, timings: str):
+    """Writes the timings as JSON to the file `timings`, or to stdout if it
+    is '-'."""
+    dumped = json.dumps(timer.to_dict(), indent=2)
+    if timings == "-":
+        print(dumped)
     else:
-        spawn_write(
-            config_path,
-            template_path,
-            target_path,
-            config[recurse_nm],
-            config[prefix_nm],
-            env_mode=config[env_nm],
+        with open(timings, "w") as f:
+            f.write(f"{dumped}\n")
+
+
+def _env_name(var_key: str) -> str:
+    """Env var name for a key, i.e. 'test.coolenv' becomes 'TEST_COOLENV'."""
+    return re.sub(r"[^A-Za-z0-9_]", "_", var_key).upper()
+
+
+def _parse_var(var: str) -> t.Tuple[str, str]:
+    """Parses 'ENV_NAME=dotted.key' or 'dotted.key' (name derived from the key)."""
+    if "=" in var:
+        name, var_key = var.split("=", 1)
+        return name.strip(), var_key.strip()
+    return _env_name(var), var
+
+
+def _load_mapping(mapping_path: p.Path) -> t.Dict[str, str]:
+    var_keys = dict()
+    with open(mapping_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "=" not in line:
+                raise ValueError(
+                    f"Line '{line}' in mapping file {mapping_path!s} should look like "
+                    f"ENV_NAME=dotted.key!"
+                )
+            name, var_key = _parse_var(line)
+            var_keys[name] = var_key
+    return var_keys
+
+
+def _dotenv_quote(value: str) -> str:
+    escaped = (
+        value.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("$", "\\$")
+    )
+    return f'"{escaped}"'
+
+
+def _format_values(values: t.Dict[str, t.Any], output_format: str) -> str:
+    if output_format == "json":
+        return json.dumps(values, indent=2, default=str)
+    elif output_format == "dotenv":
+        return "\n".join(
+            f"{name}={_dotenv_quote(str(value))}" for name, value in values.items()
+        )
+    else:
+        return "\n".join(
+            f"export {name}={shlex.quote(str(value))}" for name, value in values.items()
         )
 
 
 def config_value():
     """
     ```shell
-    usage: confenv [-h] -c CONFIG -v VARIABLE
+    usage: confenv [-h] -c CONFIG [-v VARIABLE] [-m MAPPING] [-f {export,dotenv,json}]
+                   [-e ENV]
 
     Retrieve configuration value from TOML file.
 
     examples:
     confenv -c ./confs/sample_config.toml -v test.coolenv
     export TEST_VAR=$(poetry run confenv -c ./confs/sample_config.toml -v test.coolenv)
+    eval "$(confenv -c ./confs/sample_config.toml -v TEST_VAR=test.coolenv -v default.nested.a)"
 
     optional arguments:
       -h, --help            show this help message and exit
       -c CONFIG, --config CONFIG
-                            File path for your TOML configuration file.
+                            File path for your TOML configuration file. Can be
+                            repeated to layer multiple files, in which case later
+                            files override values of earlier ones.
       -v VARIABLE, --variable VARIABLE
                             Variable name to print. For nested keys, use e.g.
-                            'toplevel.secondlevel.varname'.
+                            'toplevel.secondlevel.varname'. Can be given multiple
+                            times, in which case all values are printed in the
+                            chosen format. Use 'ENV_NAME=toplevel.varname' to set
+                            the name of the output variable, by default it is
+                            derived from the key (i.e. 'TOPLEVEL_VARNAME').
+      -m MAPPING, --mapping MAPPING
+                            File with a 'ENV_NAME=dotted.key' line for each value
+                            to print.
+      -f {export,dotenv,json}, --format {export,dotenv,json}
+                            Output format when printing multiple values. 'export'
+                            prints shell export lines, 'dotenv' a dotenv file and
+                            'json' a JSON object. Defaults to 'export'.
       -e ENV, --env ENV     Useful to specify environment-related modes, i.e.
                             production or development. 'confspawn_env.value' will
                             refer to 'confspawn_env.env.value'. Defaults to
@@ -152,16 +528,49 @@ def config_value():
         "examples:\n"
         f"{cli_name} -c ./confs/sample_config.toml -v test.coolenv\n"
         f"export TEST_VAR=$(poetry run confenv -c ./confs/sample_config.toml "
-        f"-v test.coolenv)",
+        f"-v test.coolenv)\n"
+        f'eval "$({cli_name} -c ./confs/sample_config.toml -v TEST_VAR=test.coolenv '
+        f'-v default.nested.a)"',
     )
 
     config_nm = "config"
-    config_help = "File path for your TOML configuration file."
-    parser.add_argument("-c", f"--{config_nm}", help=config_help, required=True)
+    config_help = (
+        "File path for your TOML configuration file. Can be repeated to layer\n"
+        "multiple files, in which case later files override values of earlier ones."
+    )
+    parser.add_argument(
+        "-c", f"--{config_nm}", help=config_help, action="append", required=True
+    )
 
     var_nm = "variable"
-    var_help = "Variable name to print. For nested keys, use e.g. 'toplevel.secondlevel.varname'."
-    parser.add_argument("-v", f"--{var_nm}", help=var_help, required=True)
+    var_help = (
+        "Variable name to print. For nested keys, use e.g. 'toplevel.secondlevel.varname'. "
+        "Can be given multiple times, in which case all values are printed in the chosen "
+        "format. Use 'ENV_NAME=toplevel.varname' to set the name of the output variable, "
+        "by default it is derived from the key (i.e. 'TOPLEVEL_VARNAME')."
+    )
+    parser.add_argument(
+        "-v", f"--{var_nm}", help=var_help, action="append", required=False
+    )
+
+    mapping_nm = "mapping"
+    mapping_help = "File with a 'ENV_NAME=dotted.key' line for each value to print."
+    parser.add_argument("-m", f"--{mapping_nm}", help=mapping_help, required=False)
+
+    format_nm = "format"
+    format_default = "export"
+    format_help = (
+        "Output format when printing multiple values. 'export' prints shell export lines, "
+        "'dotenv' a dotenv file and 'json' a JSON object. Defaults to "
+        f"'{format_default}'."
+    )
+    parser.add_argument(
+        "-f",
+        f"--{format_nm}",
+        help=format_help,
+        choices=["export", "dotenv", "json"],
+        required=False,
+    )
 
     env_nm = "env"
     env_default = "less"
@@ -174,13 +583,46 @@ def config_value():
 
     config = vars(parser.parse_args())
 
-    print(load_config_value(config[config_nm], config[var_nm], config[env_nm]))
+    variables = config[var_nm] if config[var_nm] is not None else []
+    if not variables and config[mapping_nm] is None:
+        parser.error("at least one of -v/--variable or -m/--mapping is required")
+
+    # A single variable without a format is printed as is
+    if (
+        len(variables) == 1
+        and config[mapping_nm] is None
+        and config[format_nm] is None
+        and "=" not in variables[0]
+    ):
+        print(
+            load_config_value(
+                _config_paths(config[config_nm]), variables[0], config[env_nm]
+            )
+        )
+        return
+
+    var_keys = dict()
+    if config[mapping_nm] is not None:
+        var_keys.update(_load_mapping(p.Path(config[mapping_nm])))
+    var_keys.update(_parse_var(var) for var in variables)
+
+    values = load_config_values(
+        _config_paths(config[config_nm]), var_keys, config[env_nm]
+    )
+    output_format = (
+        config[format_nm] if config[format_nm] is not None else format_default
+    )
+    print(_format_values(values, output_format))
 
 
 def recipizer():
     """
     ```shell
-    usage: confrecipe [-h] -r RECIPE [-p PREFIX] [-e ENV]
+    usage: confrecipe [-h] -r RECIPE [-p PREFIX] [-e ENV] [-i PATTERN]
+                      [--cache-dir CACHE_DIR] [--incremental] [-j JOBS] [-w WORKERS]
+                      [--link-mode {copy,hardlink,reflink,symlink,auto}] [--atomic]
+                      [--skip-unchanged] [--watch] [--poll] [--timings [FILE]]
+                      [--peak-memory]
 
     Build multiple confspawn configurations using a recipe.
 
@@ -196,6 +638,47 @@ def recipizer():
                             template. Defaults to 'confspawn_' or the value of the
                             CONFSPAWN_PREFIX env var, if set.
       -e ENV, --env ENV     Overwrite env set in recipe. Defaults to 'None'.
+      -i PATTERN, --ignore PATTERN
+                            Gitignore-style pattern of files and directories that
+                            are not spawned (can be repeated), in addition to the
+                            patterns in the recipe and in '.confspawnignore'
+                            files in the sources.
+      --cache-dir CACHE_DIR
+                            Directory in which compiled templates are cached
+                            between runs. Defaults to the value of the
+                            CONFSPAWN_CACHE env var, if set. Otherwise, no cache
+                            is used.
+      --incremental         Only re-render or copy the files whose inputs changed
+                            since the previous incremental run, instead of
+                            rebuilding the target directory.
+      -j JOBS, --jobs JOBS  Number of processes used to render templates in
+                            parallel. Defaults to 1.
+      -w WORKERS, --workers WORKERS
+                            Number of targets that are spawned concurrently.
+                            Nested targets are always spawned after the target
+                            that contains them. Defaults to 1.
+      --link-mode {copy,hardlink,reflink,symlink,auto}
+                            How non-template files are placed in the target.
+                            'hardlink', 'reflink' and 'symlink' fall back to
+                            copying if the file system does not support them,
+                            'auto' uses a reflink if possible. Defaults to 'copy'.
+      --atomic              Write to a staging directory first and then replace
+                            the target with it using a rename, so the target is
+                            never partially written.
+      --skip-unchanged      Leave output files that already have the right
+                            contents untouched, so they keep their modification
+                            time. Other files in the target are removed.
+      --watch               Keep running and update the targets after every change
+                            to the recipe, its sources or the config. Only the
+                            affected targets are spawned again.
+      --poll                Detect changes in watch mode by polling the files,
+                            instead of using inotify (which is only available on
+                            Linux).
+      --timings [FILE]      Write the duration of each phase and template, and the
+                            number and size of the written files, as JSON to this
+                            file (or to stdout if none is given).
+      --peak-memory         With --timings, also record the peak memory allocated
+                            while spawning, which makes spawning slower.
 
     ```
     """
@@ -225,11 +708,207 @@ def recipizer():
     env_help = f"Overwrite env set in recipe. Defaults to '{env_default}'."
     parser.add_argument("-e", f"--{env_nm}", help=env_help, required=False)
 
+    ignore_nm = "ignore"
+    ignore_help = (
+        "Gitignore-style pattern of files and directories that are not spawned (can\n"
+        "be repeated), in addition to the patterns in the recipe and in\n"
+        "'.confspawnignore' files in the sources."
+    )
+    parser.add_argument(
+        "-i",
+        f"--{ignore_nm}",
+        help=ignore_help,
+        action="append",
+        metavar="PATTERN",
+        required=False,
+    )
+
+    cache_nm = "cache_dir"
+    cache_help = (
+        "Directory in which compiled templates are cached between runs. Defaults to\n"
+        "the value of the CONFSPAWN_CACHE env var, if set. Otherwise, no cache is used."
+    )
+    parser.add_argument("--cache-dir", dest=cache_nm, help=cache_help, required=False)
+
+    incremental_nm = "incremental"
+    incremental_help = (
+        "Only re-render or copy the files whose inputs changed since the previous\n"
+        "incremental run, instead of rebuilding the target directory."
+    )
+    parser.add_argument(
+        f"--{incremental_nm}",
+        help=incremental_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    jobs_nm = "jobs"
+    jobs_help = (
+        "Number of processes used to render templates in parallel. Defaults to 1."
+    )
+    parser.add_argument(
+        "-j", f"--{jobs_nm}", help=jobs_help, default=1, type=int, required=False
+    )
+
+    workers_nm = "workers"
+    workers_help = (
+        "Number of targets that are spawned concurrently. Nested targets are always\n"
+        "spawned after the target that contains them. Defaults to 1."
+    )
+    parser.add_argument(
+        "-w", f"--{workers_nm}", help=workers_help, default=1, type=int, required=False
+    )
+
+    link_nm = "link_mode"
+    link_default = "copy"
+    link_help = (
+        "How non-template files are placed in the target. 'hardlink', 'reflink' and\n"
+        "'symlink' fall back to copying if the file system does not support them,\n"
+        "'auto' uses a reflink if possible. Defaults to 'copy'."
+    )
+    parser.add_argument(
+        "--link-mode",
+        dest=link_nm,
+        help=link_help,
+        choices=link_modes,
+        default=link_default,
+        required=False,
+    )
+
+    atomic_nm = "atomic"
+    atomic_help = (
+        "Write to a staging directory first and then replace the target with it\n"
+        "using a rename, so the target is never partially written."
+    )
+    parser.add_argument(
+        f"--{atomic_nm}",
+        help=atomic_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    skip_nm = "skip_unchanged"
+    skip_help = (
+        "Leave output files that already have the right contents untouched, so they\n"
+        "keep their modification time. Other files in the target are removed."
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        dest=skip_nm,
+        help=skip_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    watch_nm = "watch"
+    watch_help = (
+        "Keep running and update the targets after every change to the recipe, its\n"
+        "sources or the config. Only the affected targets are spawned again."
+    )
+    parser.add_argument(
+        f"--{watch_nm}",
+        help=watch_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    poll_nm = "poll"
+    poll_help = (
+        "Detect changes in watch mode by polling the files, instead of using inotify\n"
+        "(which is only available on Linux)."
+    )
+    parser.add_argument(
+        f"--{poll_nm}",
+        help=poll_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
+    timings_nm = "timings"
+    timings_help = (
+        "Write the duration of each phase and template, and the number and size of\n"
+        "the written files, as JSON to this file (or to stdout if none is given)."
+    )
+    parser.add_argument(
+        f"--{timings_nm}",
+        help=timings_help,
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        required=False,
+    )
+
+    memory_nm = "peak_memory"
+    memory_help = (
+        "With --timings, also record the peak memory allocated while spawning, which\n"
+        "makes spawning slower."
+    )
+    parser.add_argument(
+        "--peak-memory",
+        dest=memory_nm,
+        help=memory_help,
+        default=False,
+        required=False,
+        action="store_true",
+    )
+
     config = vars(parser.parse_args())
 
     recipe_path = p.Path(config[recipe_nm])
 
-    if config[prefix_nm] is None:
-        recipe(recipe_path, env_overwrite=config[env_nm])
-    else:
-        recipe(recipe_path, config[prefix_nm], config[env_nm])
+    from confspawn.spawn import recipe
+
+    options = dict()
+    if config[prefix_nm] is not None:
+        options["prefix_name"] = config[prefix_nm]
+    if config[cache_nm] is not None:
+        options["cache_dir"] = p.Path(config[cache_nm])
+    if config[ignore_nm] is not None:
+        options["ignore_patterns"] = config[ignore_nm]
+
+    if config[atomic_nm] and config[incremental_nm]:
+        parser.error("--atomic cannot be combined with --incremental")
+    if config[atomic_nm] and config[skip_nm]:
+        parser.error("--atomic cannot be combined with --skip-unchanged")
+    if config[watch_nm]:
+        if config[atomic_nm]:
+            parser.error("--watch cannot be combined with --atomic")
+        if config[skip_nm]:
+            parser.error("--watch cannot be combined with --skip-unchanged")
+        if config[timings_nm] is not None:
+            parser.error("--watch cannot be combined with --timings")
+
+        from confspawn.watch import watch_recipe
+
+        watch_recipe(
+            recipe_path,
+            env_overwrite=config[env_nm],
+            jobs=config[jobs_nm],
+            link_mode=config[link_nm],
+            workers=config[workers_nm],
+            polling=config[poll_nm],
+            on_round=lambda names: _print_round(cli_name, names),
+            **options,
+        )
+        return
+
+    timer = _make_timer(config[timings_nm], config[memory_nm])
+    recipe(
+        recipe_path,
+        env_overwrite=config[env_nm],
+        incremental=config[incremental_nm],
+        jobs=config[jobs_nm],
+        link_mode=config[link_nm],
+        atomic=config[atomic_nm],
+        skip_unchanged=config[skip_nm],
+        workers=config[workers_nm],
+        timer=timer,
+        **options,
+    )
+    if timer is not None:
+        _write_timings(timer, config[timings_nm])
@@ -0,0 +1,341 @@
+import datetime
+import json
+import os
+import threading
+import time
+import typing as t
+from collections.abc import Mapping
+from copy import deepcopy
+from functools import reduce
+from hashlib import sha1
+from pathlib import Path
+
+import tomli
+
+__all__ = [
+    "load_config_value",
+    "load_config_values",
+    "load_toml",
+    "load_config",
+    "clear_config_cache",
+    "ConfigOverlay",
+]
+
+# A single config file, or a list of config files that are layered on top of each other
+ConfigPaths = t.Union[str, os.PathLike, t.Sequence[t.Union[str, os.PathLike]]]
+
+# Parsed config files can also be cached on disk (so that they are shared between
+# processes) by setting a cache directory using this environment variable
+config_cache_env = os.environ.get("CONFSPAWN_CONFIG_CACHE")
+set_config_cache_dir = Path(config_cache_env) if config_cache_env else None
+
+# Files modified less than this many nanoseconds ago are not cached, as another
+# modification within the resolution of the file system timestamps would go unnoticed
+RACY_NS = 2 * 10**9
+
+_StatKey = t.Tuple[int, int, int, int]
+
+# Maps resolved path to its stat key and parsed contents
+_parsed: t.Dict[str, t.Tuple[_StatKey, dict]] = dict()
+_lock = threading.Lock()
+
+
+def _stat_key(st: os.stat_result) -> _StatKey:
+    return st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino
+
+
+def _disk_cache_file(cache_dir: Path, resolved: str) -> Path:
+    return cache_dir.joinpath(
+        f"__confspawn_config_{sha1(resolved.encode('utf-8')).hexdigest()}.json"
+    )
+
+
+# Key of the JSON objects in the disk cache that hold a value JSON does not support
+_TAG = "__confspawn__"
+
+_temporal_types = {
+    "datetime": datetime.datetime,
+    "date": datetime.date,
+    "time": datetime.time,
+}
+
+
+def _encode_value(value):
+    """Converts the TOML dates and times in `value` to tagged JSON objects.
+
+    Tables that consist of just the tag key are tagged themselves, so they
+    are not mistaken for a tagged value.
+    """
+    if isinstance(value, dict):
+        if len(value) == 1 and _TAG in value:
+            return {_TAG: ["table", [[k, _encode_value(v)] for k, v in value.items()]]}
+        return {k: _encode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_encode_value(v) for v in value]
+    # datetime is a subclass of date, so it is checked first
+    for kind, cls in _temporal_types.items():
+        if isinstance(value, cls):
+            return {_TAG: [kind, value.isoformat()]}
+    return value
+
+
+def _decode_object(obj: dict):
+    if len(obj) != 1 or _TAG not in obj:
+        return obj
+    kind, data = obj[_TAG]
+    if kind == "table":
+        return dict(data)
+    return _temporal_types[kind].fromisoformat(data)
+
+
+def _load_from_disk(
+    cache_dir: Path, resolved: str, stat_key: _StatKey
+) -> t.Optional[dict]:
+    # JSON is used instead of pickle, so that a file in the cache directory (which
+    # might be writable by others) cannot execute code when it is loaded
+    try:
+        with open(_disk_cache_file(cache_dir, resolved), "rb") as f:
+            cached = json.load(f, object_hook=_decode_object)
+        cached_key = tuple(cached["key"])
+        cached_path = cached["path"]
+        toml_dict = cached["config"]
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    if (
+        cached_key != stat_key
+        or cached_path != resolved
+        or not isinstance(toml_dict, dict)
+    ):
+        return None
+    return toml_dict
+
+
+def _store_on_disk(cache_dir: Path, resolved: str, stat_key: _StatKey, toml_dict: dict):
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file = _disk_cache_file(cache_dir, resolved)
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        cached = {"key": stat_key, "path": resolved, "config": _encode_value(toml_dict)}
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(cached, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # The cache is only an optimization
+        pass
+
+
+def load_toml(
+    pth: t.Union[str, os.PathLike],
+    cache_dir: t.Optional[Path] = set_config_cache_dir,
+) -> dict:
+    """Loads the TOML file at `pth`, parsing it only if it changed since it was
+    last loaded.
+
+    Parsed files are cached in memory and, if `cache_dir` is set (it
+    defaults to the CONFSPAWN_CONFIG_CACHE env var), on disk. A file is
+    considered changed if its size, modification time, change time or
+    inode differ. The returned dict is shared between calls, so it must not
+    be modified.
+    """
+    resolved = str(Path(pth).resolve())
+    st = os.stat(resolved)
+    stat_key = _stat_key(st)
+
+    with _lock:
+        cached = _parsed.get(resolved)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    racy = time.time_ns() - st.st_mtime_ns < RACY_NS
+
+    toml_dict = None
+    if cache_dir is not None and not racy:
+        toml_dict = _load_from_disk(cache_dir, resolved, stat_key)
+
+    if toml_dict is None:
+        with open(resolved, "rb") as f:
+            toml_dict = tomli.load(f)
+        if cache_dir is not None and not racy:
+            _store_on_disk(cache_dir, resolved, stat_key, toml_dict)
+
+    if not racy:
+        with _lock:
+            _parsed[resolved] = (stat_key, toml_dict)
+
+    return toml_dict
+
+
+_missing = object()
+
+
+class ConfigOverlay(Mapping):
+    """Read-only view of config layers merged on top of each other, without
+    copying them.
+
+    A key is looked up in the last layer first. If its value is a table,
+    it is merged with the tables at the same key in earlier layers, which
+    is again done lazily. Any other value (including arrays) replaces those
+    of earlier layers.
+    """
+
+    __slots__ = ("_layers",)
+
+    def __init__(self, layers: t.Sequence[t.Mapping]) -> None:
+        self._layers = tuple(layers)
+
+    def __getitem__(self, key):
+        tables = []
+        for layer in reversed(self._layers):
+            value = layer.get(key, _missing)
+            if value is _missing:
+                continue
+            if not isinstance(value, Mapping):
+                if tables:
+                    break
+                return value
+            tables.append(value)
+        if not tables:
+            raise KeyError(key)
+        if len(tables) == 1:
+            return tables[0]
+        return ConfigOverlay(reversed(tables))
+
+    def __iter__(self):
+        seen = set()
+        for layer in self._layers:
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self._layers)
+
+    def to_dict(self) -> dict:
+        """The merged config as a new (nested) dict."""
+        return {key: _plain(value) for key, value in self.items()}
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+
+def _plain(value):
+    """A copy of the config `value` that contains no `ConfigOverlay`."""
+    if isinstance(value, ConfigOverlay):
+        return value.to_dict()
+    return deepcopy(value)
+
+
+def _materialize(value):
+    """The config `value` with every `ConfigOverlay` in it replaced by a dict.
+
+    Unlike `_plain`, values that are not merged from multiple layers are
+    shared instead of copied, so only the merged tables are built.
+    """
+    if isinstance(value, ConfigOverlay):
+        return {key: _materialize(item) for key, item in value.items()}
+    return value
+
+
+def load_config(settings: ConfigPaths) -> t.Mapping:
+    """Loads the config file at `settings` (see `load_toml`) or, if a list of
+    paths is given, the `ConfigOverlay` of those files, with later files
+    overriding earlier ones.
+
+    Every file is parsed and cached separately, so changing one of them only
+    requires parsing that file again.
+    """
+    if isinstance(settings, (str, os.PathLike)):
+        return load_toml(settings)
+    layers = [load_toml(pth) for pth in settings]
+    if not layers:
+        raise ValueError("At least one config file must be provided!")
+    if len(layers) == 1:
+        return layers[0]
+    return ConfigOverlay(layers)
+
+
+def clear_config_cache():
+    """Clears the in-memory cache of parsed config files."""
+    with _lock:
+        _parsed.clear()
+
+
+def _get_settings(settings: ConfigPaths, env_mode: str) -> dict:
+    """Loads the config at `settings` (see `load_config`) and applies the
+    `env_mode` to 'confspawn_env', for rendering templates (see
+    `_select_env`).
+
+    Only the top-level dict is copied, nested values are shared with the
+    cache and must not be modified.
+    """
+    return _select_env(load_config(settings), env_mode)
+
+
+def _select_env(config_dict: t.Mapping, env_mode: str) -> dict:
+    """Applies the `env_mode` to 'confspawn_env' of an already parsed config.
+
+    Tables merged from layered config files are turned into dicts, so that
+    templates (and filters like `tojson`) see the same values as for a single
+    config file. Only the top-level dict and the merged tables are copied.
+    """
+    return {
+        key: _materialize(value)
+        for key, value in _env_view(config_dict, env_mode).items()
+    }
+
+
+def _env_view(config_dict: t.Mapping, env_mode: str) -> dict:
+    """Like `_select_env`, but keeps merged tables as lazy `ConfigOverlay`s,
+    for looking up single values."""
+    toml_dict = dict(config_dict)
+
+    if "confspawn_env" in toml_dict.keys():
+        envs = toml_dict["confspawn_env"]
+        if isinstance(envs, Mapping) and env_mode in envs.keys():
+            toml_dict["confspawn_env"] = envs[env_mode]
+        else:
+            toml_dict.pop("confspawn_env")
+
+    return toml_dict
+
+
+def load_config_value(settings: ConfigPaths, var_key: str, env_mode: str = "less"):
+    """Returns the value from a dict loaded from TOML file at the `settings`
+    path.
+
+    The `var_key` can use dot-notation to retrieve a nested key (i.e.
+    'toplevel.secondlevel.varname'). `settings` can also be a list of paths,
+    see `load_config`.
+
+    Can be used in combination with a print to extract it as an env var.
+    See the `confenv` CLI command (`confspawn.cli.config_value`).
+    """
+    return _plain(_deep_get(_env_view(load_config(settings), env_mode), var_key))
+
+
+def load_config_values(
+    settings: ConfigPaths, var_keys: t.Dict[str, str], env_mode: str = "less"
+) -> t.Dict[str, t.Any]:
+    """Like `load_config_value`, but retrieves many values at once, while only
+    loading the TOML file a single time.
+
+    `var_keys` maps names (for example the names of env vars) to keys in
+    dot-notation. The returned dict maps the same names to their values.
+    """
+    settings_dict = _env_view(load_config(settings), env_mode)
+    return {
+        name: _plain(_deep_get(settings_dict, key)) for name, key in var_keys.items()
+    }
+
+
+def _deep_get(dic: dict, keys: str, default=None):
+    # https://stackoverflow.com/a/46890853/13588694
+    return reduce(
+        lambda d, key: d.get(key, default) if isinstance(d, Mapping) else default,
+        keys.split("."),
+        dic,
+    )
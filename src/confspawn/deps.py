@@ -0,0 +1,135 @@
+import typing as t
+from collections.abc import Mapping
+
+from jinja2 import Environment, TemplateNotFound, meta, nodes
+
+from confspawn.manifest import config_digest
+
+__all__ = ["template_config_keys", "template_dependencies", "keys_digest"]
+
+# A path into the config, i.e. ["test", "coolenv"] for 'test.coolenv'
+KeyPath = t.List[t.Union[str, int]]
+
+# Tags that give another template access to the whole context
+_context_nodes = (nodes.Extends, nodes.Include, nodes.Import, nodes.FromImport)
+
+
+def _static_path(node: nodes.Node) -> t.Optional[KeyPath]:
+    """Path read by a chain of attribute and constant item lookups on a
+    variable, or None if `node` is no such chain."""
+    parts: KeyPath = []
+    while True:
+        if isinstance(node, nodes.Getattr):
+            parts.append(node.attr)
+            node = node.node
+        elif (
+            isinstance(node, nodes.Getitem)
+            and isinstance(node.arg, nodes.Const)
+            and isinstance(node.arg.value, (str, int))
+            and not isinstance(node.arg.value, bool)
+        ):
+            parts.append(node.arg.value)
+            node = node.node
+        elif isinstance(node, nodes.Name) and node.ctx == "load":
+            parts.append(node.name)
+            parts.reverse()
+            return parts
+        else:
+            return None
+
+
+def _collect(node: nodes.Node, keys: t.List[KeyPath]):
+    if isinstance(node, (nodes.Getattr, nodes.Getitem, nodes.Name)):
+        path = _static_path(node)
+        if path is not None:
+            keys.append(path)
+            return
+    for child in node.iter_child_nodes():
+        _collect(child, keys)
+
+
+def template_config_keys(
+    env: Environment, templ_name: str
+) -> t.Optional[t.List[KeyPath]]:
+    """Statically determines the paths into the config that the template
+    `templ_name` reads.
+
+    Every variable and every chain of attribute or constant item lookups on
+    it (like `test.coolenv` or `a["b"]`) is a path. Anything computed from it
+    at render time (filters, dynamic lookups) only depends on the value at
+    that path. Local variables are included as well, which is harmless.
+    Returns None if the template gives other templates access to its context
+    (using extends, include or import), so it depends on the whole config.
+    """
+    source, filename, _ = env.loader.get_source(env, templ_name)
+    ast = env.parse(source, templ_name, filename)
+    if ast.find(_context_nodes) is not None:
+        return None
+
+    keys: t.List[KeyPath] = []
+    _collect(ast, keys)
+    unique = {tuple(path): path for path in keys}
+    return [unique[k] for k in sorted(unique, key=repr)]
+
+
+def template_dependencies(env: Environment, templ_name: str) -> t.Optional[t.List[str]]:
+    """Statically determines the names of the templates that `templ_name`
+    extends, includes or imports, directly or through those templates.
+
+    Returns None if any of them cannot be determined before rendering,
+    because its name is not a constant or it cannot be found.
+    """
+    names: t.Set[str] = set()
+    pending = [templ_name]
+    while pending:
+        name = pending.pop()
+        try:
+            source, filename, _ = env.loader.get_source(env, name)
+        except TemplateNotFound:
+            return None
+        ast = env.parse(source, name, filename)
+        for ref in meta.find_referenced_templates(ast):
+            if ref is None:
+                return None
+            if ref != templ_name and ref not in names:
+                names.add(ref)
+                pending.append(ref)
+    return sorted(names)
+
+
+def _lookup(config_dict: Mapping, path: KeyPath) -> list:
+    """Looks up `path` like Jinja would, returning a list with the value that
+    the rendered result depends on."""
+    value: t.Any = config_dict
+    depth = 0
+    for part in path:
+        # The first part is a variable, the others can also be attributes such as
+        # dict.items, which Jinja may prefer over an item, so then depend on the
+        # whole value
+        if depth > 0 and isinstance(part, str) and hasattr(value, part):
+            break
+        if isinstance(value, Mapping):
+            if part not in value:
+                # Undefined, whatever else the parent contains
+                return [depth]
+            value = value[part]
+        elif (
+            isinstance(value, list)
+            and isinstance(part, int)
+            and -len(value) <= part < len(value)
+        ):
+            value = value[part]
+        else:
+            break
+        depth += 1
+    return [depth, value]
+
+
+def keys_digest(config_dict: Mapping, keys: t.List[KeyPath]) -> str:
+    """Digest of only the config values at the paths `keys`.
+
+    `config_dict` should already have the 'confspawn_env' of the env mode
+    applied, so that a template reading 'confspawn_env.value' depends on the
+    value for that mode only.
+    """
+    return config_digest([[path, _lookup(config_dict, path)] for path in keys])
@@ -0,0 +1,131 @@
+import os
+import re
+import typing as t
+from pathlib import Path
+
+__all__ = ["IGNORE_FILE", "IgnoreRules", "load_ignore"]
+
+# File in the root of a source directory with patterns of files that are not spawned
+IGNORE_FILE = ".confspawnignore"
+
+
+def _translate(glob: str) -> str:
+    """Translates a gitignore-style glob to a regular expression, in which `*`
+    and `?` do not match a `/` and `**` matches any number of directories."""
+    out = []
+    i = 0
+    n = len(glob)
+    while i < n:
+        c = glob[i]
+        if c == "*":
+            if glob.startswith("**/", i):
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if glob.startswith("**", i):
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = glob.find("]", i + 2)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                inner = glob[i + 1 : end]
+                if inner.startswith("!"):
+                    inner = "^" + inner[1:]
+                out.append("[" + inner.replace("\\", "\\\\") + "]")
+                i = end + 1
+                continue
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(glob[i + 1]))
+            i += 2
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class IgnoreRules:
+    """Gitignore-style patterns, matched against paths relative to a source
+    directory (in POSIX form).
+
+    Blank lines and lines starting with `#` are skipped. A pattern without
+    a `/` (other than a trailing one) matches a file or directory with that
+    name at any depth, otherwise it is relative to the source directory. A
+    trailing `/` only matches directories and a leading `!` includes paths
+    excluded by earlier patterns. The last matching pattern wins. As
+    excluded directories are not entered, files inside them cannot be
+    included again.
+    """
+
+    def __init__(self, patterns: t.Iterable[str]) -> None:
+        # Tuples of compiled pattern, whether it includes and whether it only
+        # matches directories
+        self.rules: t.List[t.Tuple[t.Pattern[str], bool, bool]] = []
+        for line in patterns:
+            pattern = line.rstrip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            include = pattern.startswith("!")
+            if include:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            if "/" in pattern:
+                pattern = pattern.lstrip("/")
+            else:
+                pattern = "**/" + pattern
+            self.rules.append(
+                (re.compile(f"{_translate(pattern)}\\Z"), include, dir_only)
+            )
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def matches(self, rel: str, is_dir: bool = False) -> bool:
+        """Returns True if the path `rel` is excluded."""
+        for regex, include, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel):
+                return not include
+        return False
+
+    def excludes(self, rel: str, is_dir: bool = False) -> bool:
+        """Returns True if the path `rel` or one of the directories it is in is
+        excluded, so it would not be reached by a walk that skips excluded
+        directories."""
+        parts = rel.split("/")
+        for i in range(1, len(parts)):
+            if self.matches("/".join(parts[:i]), True):
+                return True
+        return self.matches(rel, is_dir)
+
+
+def load_ignore(
+    root: t.Union[str, os.PathLike], patterns: t.Optional[t.Iterable[str]] = None
+) -> t.Optional[IgnoreRules]:
+    """Rules for the source directory `root`, from the `IGNORE_FILE` in it (if
+    any) followed by `patterns`, or None if there are none.
+
+    The ignore file itself is also excluded.
+    """
+    lines: t.List[str] = []
+    ignore_file = Path(root).joinpath(IGNORE_FILE)
+    try:
+        with open(ignore_file, encoding="utf-8") as f:
+            lines.extend(f.read().splitlines())
+        lines.append(f"/{IGNORE_FILE}")
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    if patterns is not None:
+        lines.extend(patterns)
+    rules = IgnoreRules(lines)
+    return rules if rules else None
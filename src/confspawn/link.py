@@ -0,0 +1,163 @@
+import os
+import stat
+from pathlib import Path
+
+__all__ = ["link_modes", "place_file"]
+
+link_modes = ("copy", "hardlink", "reflink", "symlink", "auto")
+
+# ioctl request to clone a file on Linux (btrfs, XFS and others), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _copy(src: Path, dst: Path):
+    import shutil
+
+    shutil.copy(src, dst)
+
+
+def _copy_range(src: Path, dst: Path):
+    """Copies using copy_file_range, which lets the file system share or copy
+    the data without passing it through user space."""
+    if not hasattr(os, "copy_file_range"):
+        _copy(src, dst)
+        return
+
+    import shutil
+
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        if remaining > 0:
+            raise OSError("copy_file_range stopped early")
+    except OSError:
+        _copy(src, dst)
+        return
+    shutil.copymode(src, dst)
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    """Clones `src` to `dst`, returning False if this is not supported."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    import shutil
+
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        dst.unlink(missing_ok=True)
+        return False
+    shutil.copymode(src, dst)
+    return True
+
+
+def _hardlink(src: Path, dst: Path) -> bool:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # i.e. another file system or not supported
+        return False
+    return True
+
+
+def _symlink(src: Path, dst: Path) -> bool:
+    try:
+        os.symlink(src.resolve(), dst)
+    except OSError:
+        return False
+    return True
+
+
+def _same_contents(src: Path, dst: Path, chunk_size: int = 1024 * 1024) -> bool:
+    with open(src, "rb") as fsrc, open(dst, "rb") as fdst:
+        while True:
+            src_chunk = fsrc.read(chunk_size)
+            if src_chunk != fdst.read(chunk_size):
+                return False
+            if not src_chunk:
+                return True
+
+
+def _keep_unchanged(src: Path, dst: Path, link_mode: str) -> bool:
+    """If `dst` already is what placing `src` would result in, applies the mode
+    of `src` to it (if different) and returns True."""
+    try:
+        dst_st = os.lstat(dst)
+        if stat.S_ISLNK(dst_st.st_mode):
+            return link_mode == "symlink" and os.readlink(dst) == str(src.resolve())
+        if not stat.S_ISREG(dst_st.st_mode):
+            return False
+        src_st = os.stat(src)
+        same_file = (src_st.st_dev, src_st.st_ino) == (dst_st.st_dev, dst_st.st_ino)
+        if same_file:
+            # Only a hard link may share its data with the source, otherwise
+            # modifying the output would modify the source
+            return link_mode == "hardlink"
+        if link_mode == "hardlink" and src_st.st_dev == dst_st.st_dev:
+            # A hard link can be created, so the copy is replaced by one
+            return False
+        if src_st.st_size != dst_st.st_size or not _same_contents(src, dst):
+            return False
+        if stat.S_IMODE(src_st.st_mode) != stat.S_IMODE(dst_st.st_mode):
+            os.chmod(dst, stat.S_IMODE(src_st.st_mode))
+    except OSError:
+        return False
+    return True
+
+
+def place_file(
+    src: Path, dst: Path, link_mode: str = "copy", skip_unchanged: bool = False
+) -> bool:
+    """Places the file at `src` at `dst`, replacing anything already there.
+
+    `link_mode` determines how:
+
+    * 'copy' copies the file, including its mode.
+    * 'hardlink' creates a hard link, so the file data and mode are shared.
+    * 'reflink' clones the file, so the data is only copied once modified.
+    * 'symlink' creates a symbolic link to the resolved `src`.
+    * 'auto' uses a reflink if the file system supports it and copies using
+      copy_file_range otherwise.
+
+    If a link cannot be created, for example because `src` and `dst` are on
+    different file systems, the file is copied instead.
+
+    If skip_unchanged is True and `dst` already has the same contents (or is
+    the same symbolic or hard link), it is left alone, so it keeps its inode
+    and modification time. A hard link to `src` is only kept for 'hardlink'. Only its mode is updated if it differs. Returns
+    whether the file was placed.
+    """
+    if link_mode not in link_modes:
+        raise ValueError(
+            f"Unknown link mode {link_mode}! Choose one of {', '.join(link_modes)}."
+        )
+    if skip_unchanged and _keep_unchanged(src, dst, link_mode):
+        return False
+
+    # Never write through an existing (sym)link into its source
+    dst.unlink(missing_ok=True)
+
+    placed = False
+    if link_mode == "hardlink":
+        placed = _hardlink(src, dst)
+    elif link_mode == "symlink":
+        placed = _symlink(src, dst)
+    elif link_mode in ("reflink", "auto"):
+        placed = _reflink(src, dst)
+
+    if placed:
+        return True
+    elif link_mode == "auto":
+        _copy_range(src, dst)
+    else:
+        _copy(src, dst)
+    return True
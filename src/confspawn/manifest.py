@@ -0,0 +1,91 @@
+import json
+import os
+import typing as t
+from collections.abc import Mapping
+from hashlib import sha256
+from pathlib import Path
+
+__all__ = [
+    "manifest_name",
+    "file_digest",
+    "config_digest",
+    "load_manifest",
+    "write_manifest",
+    "remove_output",
+]
+
+manifest_name = ".confspawn_manifest.json"
+MANIFEST_VERSION = 2
+
+
+def file_digest(pth: Path, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 hex digest of the contents of the file at `pth`."""
+    h = sha256()
+    with open(pth, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def config_digest(config_dict: t.Any) -> str:
+    """SHA-256 hex digest of a (loaded) config, independent of key order."""
+    dumped = json.dumps(config_dict, sort_keys=True, default=_json_default)
+    return sha256(dumped.encode("utf-8")).hexdigest()
+
+
+def _json_default(value: t.Any):
+    # Mappings that are not dicts, like a ConfigOverlay, are dumped as dicts
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
+
+
+def load_manifest(target_path: Path) -> t.Optional[t.Dict[str, dict]]:
+    """Loads the outputs recorded in the manifest of a previous incremental
+    spawn to `target_path`.
+
+    Returns None if there is no (valid) manifest.
+    """
+    try:
+        with open(target_path.joinpath(manifest_name), "rb") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        not isinstance(manifest, dict)
+        or manifest.get("version") != MANIFEST_VERSION
+        or not isinstance(manifest.get("outputs"), dict)
+    ):
+        return None
+
+    return manifest["outputs"]
+
+
+def write_manifest(target_path: Path, outputs: t.Dict[str, dict]):
+    """Records the outputs of an incremental spawn in the manifest at
+    `target_path`."""
+    manifest_path = target_path.joinpath(manifest_name)
+    tmp_path = manifest_path.with_name(f"{manifest_name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "outputs": outputs}, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def remove_output(target_path: Path, rel_path: str):
+    """Removes an output that is no longer produced, along with any parent
+    directories inside `target_path` that are left empty."""
+    out_path = target_path.joinpath(rel_path)
+    try:
+        out_path.unlink()
+    except FileNotFoundError:
+        pass
+
+    parent = out_path.parent
+    while parent != target_path and target_path in parent.parents:
+        try:
+            parent.rmdir()
+        except OSError:
+            # Not empty
+            break
+        parent = parent.parent
@@ -0,0 +1,116 @@
+import typing as t
+
+from jinja2 import Environment, TemplateSyntaxError, nodes
+from jinja2.utils import missing
+
+__all__ = ["SimpleTemplate", "compile_simple"]
+
+# A lookup in the config, as the index of the part it fills, the name that is looked
+# up and the attribute or item accesses after it (True for an item access)
+Lookup = t.Tuple[int, str, t.Tuple[t.Tuple[bool, t.Any], ...]]
+
+# Names that are not looked up in the context by Jinja
+_special_names = {"self", "loop", "super", "caller", "varargs", "kwargs"}
+
+
+def _lookup(node: nodes.Node) -> t.Optional[t.Tuple[str, tuple]]:
+    """The name and accesses of an expression like `a.b['c']`, or None if it is
+    anything else."""
+    path = []
+    while True:
+        if isinstance(node, nodes.Getattr):
+            path.append((False, node.attr))
+        elif isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+            path.append((True, node.arg.value))
+        elif isinstance(node, nodes.Name) and node.ctx == "load":
+            if node.name in _special_names:
+                return None
+            return node.name, tuple(reversed(path))
+        else:
+            return None
+        node = node.node
+
+
+def compile_simple(
+    environment: Environment, source: str, name: str, filename: t.Optional[str]
+) -> t.Optional[t.Tuple[t.Tuple[str, ...], t.Tuple[Lookup, ...]]]:
+    """Splits a template that only consists of text and substitutions like
+    `{{ a.b.c }}` into its constant parts and lookups. Returns None for any
+    other template, which must be rendered by Jinja instead.
+
+    The constant parts are taken from the parsed template, so whitespace
+    control, comments and newline handling are the same as in Jinja.
+    Templates that are autoescaped are never simple.
+    """
+    if environment.block_start_string in source:
+        return None
+    autoescape = environment.autoescape
+    if callable(autoescape):
+        autoescape = autoescape(name)
+    if autoescape or environment.finalize is not None:
+        return None
+    try:
+        tree = environment.parse(source, name, filename)
+    except TemplateSyntaxError:
+        # Let Jinja raise it when the template is loaded
+        return None
+
+    parts: t.List[str] = []
+    lookups: t.List[Lookup] = []
+    for output in tree.body:
+        if not isinstance(output, nodes.Output):
+            return None
+        for node in output.nodes:
+            if isinstance(node, nodes.TemplateData):
+                parts.append(node.data)
+            elif isinstance(node, nodes.Const):
+                parts.append(str(node.value))
+            else:
+                lookup = _lookup(node)
+                if lookup is None:
+                    return None
+                lookups.append((len(parts), *lookup))
+                parts.append("")
+    return tuple(parts), tuple(lookups)
+
+
+class SimpleTemplate:
+    """A template compiled by `compile_simple`, which renders by filling the
+    lookups into its constant parts and joining them.
+
+    It renders exactly like the Jinja template would, using the getattr,
+    getitem, globals and undefined of `environment`.
+    """
+
+    __slots__ = ("environment", "name", "filename", "parts", "lookups")
+
+    def __init__(
+        self,
+        environment: Environment,
+        name: str,
+        filename: t.Optional[str],
+        parts: t.Tuple[str, ...],
+        lookups: t.Tuple[Lookup, ...],
+    ) -> None:
+        self.environment = environment
+        self.name = name
+        self.filename = filename
+        self.parts = parts
+        self.lookups = lookups
+
+    def render(self, context: t.Mapping[str, t.Any]) -> str:
+        env = self.environment
+        parts = list(self.parts)
+        for index, name, path in self.lookups:
+            value = context.get(name, missing)
+            if value is missing:
+                value = env.globals.get(name, missing)
+                if value is missing:
+                    value = env.undefined(name=name)
+            for is_item, key in path:
+                value = env.getitem(value, key) if is_item else env.getattr(value, key)
+            parts[index] = str(value)
+        return "".join(parts)
+
+    def generate(self, context: t.Mapping[str, t.Any]) -> t.Iterator[str]:
+        yield self.render(context)
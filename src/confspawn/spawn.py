@@ -1,16 +1,50 @@
 import typing as t
 import sys
 import os
-from functools import reduce
-import shutil
+import locale
+import stat
+import time
+from collections.abc import Mapping
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 import tomli
 
 from jinja2 import BaseLoader, Environment, TemplateNotFound, select_autoescape
+from jinja2.bccache import BytecodeCache
+
+from confspawn.cache import SpawnBytecodeCache, MemoryBytecodeCache, DEFAULT_MAX_SIZE
+from confspawn.deps import keys_digest, template_config_keys, template_dependencies
+from confspawn.ignore import load_ignore
+from confspawn.link import place_file
+from confspawn.simple import SimpleTemplate, compile_simple
+from confspawn.stage import discard_stage, make_stage, swap_into_place
+from confspawn.timing import SpawnTimer
+from confspawn.walk import FileRecord, walk_files
+from confspawn.config import (
+    _deep_get,
+    _get_settings,
+    _select_env,
+    load_config,
+    ConfigPaths,
+    load_config_value,
+    load_config_values,
+)
+from confspawn.manifest import (
+    config_digest,
+    file_digest,
+    load_manifest,
+    manifest_name,
+    remove_output,
+    write_manifest,
+)
 
 __all__ = [
     "spawn_write",
+    "spawn_memory",
+    "SpawnedFile",
     "load_config_value",
+    "load_config_values",
     "move_other_files",
     "spawn_templates",
     "recipe",
@@ -30,136 +64,102 @@ else:
         return string.removeprefix(prefix)
 
 
-def _get_settings(settings: Path, env_mode: str) -> dict:
-    with open(settings, "rb") as f:
-        toml_dict = tomli.load(f)
-
-    if "confspawn_env" in toml_dict.keys():
-        envs = toml_dict["confspawn_env"]
-        if isinstance(envs, dict) and env_mode in envs.keys():
-            toml_dict["confspawn_env"] = envs[env_mode]
-        else:
-            toml_dict.pop("confspawn_env")
-
-    return toml_dict
-
-
-def load_config_value(settings: Path, var_key: str, env_mode: str = "less"):
-    """Returns the value from a dict loaded from TOML file at the `settings`
-    path.
-
-    The `var_key` can use dot-notation to retrieve a nested key (i.e.
-    'toplevel.secondlevel.varname').
-
-    Can be used in combination with a print to extract it as an env var.
-    See the `confenv` CLI command (`confspawn.cli.config_value`).
-    """
-    return _deep_get(_get_settings(settings, env_mode), var_key)
-
-
-def _deep_get(dic: dict, keys: str, default=None):
-    # https://stackoverflow.com/a/46890853/13588694
-    return reduce(
-        lambda d, key: d.get(key, default) if isinstance(d, dict) else default,
-        keys.split("."),
-        dic,
-    )
-
-
 # Default value can be set using environment variable
 # However, this value can be overriden by supplying a prefix value in the specific functions
 prefix_env = os.environ.get("CONFSPAWN_PREFIX")
 set_prefix_name = prefix_env if prefix_env is not None else "confspawn_"
 
+# Compiled templates are only cached on disk if a cache directory is set, which can be
+# done using environment variables or the cache_dir argument of the specific functions
+cache_env = os.environ.get("CONFSPAWN_CACHE")
+set_cache_dir = Path(cache_env) if cache_env else None
+cache_size_env = os.environ.get("CONFSPAWN_CACHE_SIZE")
+set_cache_size = int(cache_size_env) if cache_size_env else DEFAULT_MAX_SIZE
+
+
+def _records_from_paths(
+    file_paths: t.List[Path], rel_paths: t.List[Path], prefix_name: str
+) -> t.List[FileRecord]:
+    """Records for lists of absolute and relative paths, skipping anything that
+    is not a file."""
+    records = []
+    for file_pth, rel_pth in zip(file_paths, rel_paths):
+        record = FileRecord.from_path(file_pth, rel_pth, prefix_name)
+        if record is not None:
+            records.append(record)
+    return records
+
+
+def _walk_source(
+    pth: Path,
+    recurse: bool,
+    prefix_name: str = set_prefix_name,
+    ignore_patterns: t.Optional[t.List[str]] = None,
+) -> t.Iterator[FileRecord]:
+    """Walks a source directory, skipping the files excluded by its ignore file
+    and `ignore_patterns` (see `confspawn.ignore.load_ignore`)."""
+    return walk_files(pth, recurse, prefix_name, load_ignore(pth, ignore_patterns))
+
+
+def _merge_walks(
+    walks: t.List[t.Tuple[Path, t.Iterable[FileRecord]]],
+) -> t.List[FileRecord]:
+    files_set: t.Set[str] = set()
+    records = []
+    seen_paths = []
 
-def _if_to_spawn(pth: Path, prefix_name: str = set_prefix_name):
-    return pth.is_file() and pth.name.startswith(prefix_name)
-
-
-def _get_all_sub_files(pth: Path, recurse=False):
-    """Get all subfiles and directories.
-
-    If recurse is True, it will also enter subdirectories.
-    """
-    # rglob("*") goes through all subdirectories and lists all files and directories
-    # glob does not recurse
-    if recurse:
-        globbed = pth.rglob("*")
-    else:
-        globbed = pth.glob("*")
-    return [p for p in globbed]
-
-
-def _get_all_sub_files_and_rel(
-    pth: Path, recurse=False
-) -> t.Tuple[t.List[Path], t.List[Path]]:
-    """Get all subfiles and zip with relative paths.
-
-    If recurse is True, it will also enter subdirectories.
-    """
-    # rglob("*") goes through all subdirectories and lists all files and directories
-    # glob does not recurse
-    if recurse:
-        globbed = pth.rglob("*")
-    else:
-        globbed = pth.glob("*")
-    rel_files = []
-    abs_files = []
-
-    for p in globbed:
-        if p.is_file():
-            rel_path = p.relative_to(pth)
-            rel_files.append(rel_path)
-            abs_files.append(p)
+    for pth, walk in walks:
+        for record in walk:
+            if record.rel in files_set:
+                raise ValueError(
+                    f"There was a path conflict between {', '.join(str(seen_paths))} and {pth}"
+                )
+            files_set.add(record.rel)
+            records.append(record)
+        seen_paths.append(pth)
 
-    return abs_files, rel_files
+    return records
 
 
-def _merge_paths(
-    pth_rec_list: t.List[t.Tuple[Path, bool]]
-) -> t.Tuple[t.List[Path], t.List[Path]]:
+def _merge_records(
+    pth_rec_list: t.List[t.Tuple[Path, bool]],
+    prefix_name: str = set_prefix_name,
+    ignore_patterns: t.Optional[t.List[str]] = None,
+) -> t.List[FileRecord]:
     """For a list of path, bool pairs, where the bool indicates whether to
     search recursively, see if there is a file conflict.
 
     Conflicts are checked relative to the source path passed in the
     argument. So a path <path>/some/inner/ will conflict with <other
     path>/some/inner because they would be put at the same target
-    location. The returned list contains the absolute files and relative
-    paths as tuples.
+    location. The returned list contains the records of the files of all
+    paths, except those excluded by `ignore_patterns` or the ignore file of
+    their source.
     """
-
-    files_set: t.Set[Path] = set()
-    abs_files = []
-    seen_paths = []
-
-    for pth, recurse in pth_rec_list:
-        files_set_len = len(files_set)
-        if recurse:
-            globbed = pth.rglob("*")
-        else:
-            globbed = pth.glob("*")
-        pth_files = []
-        for p in globbed:
-            if p.is_file():
-                rel_path = p.relative_to(pth)
-                pth_files.append(rel_path)
-                abs_files.append(p)
-
-        files_len = len(pth_files)
-        files_set.update(pth_files)
-        if len(files_set) != files_set_len + files_len:
-            raise ValueError(
-                f"There was a path conflict between {', '.join(str(seen_paths))} and {pth}"
-            )
-        seen_paths.append(pth)
-
-    return abs_files, list(files_set)
+    return _merge_walks(
+        [
+            (pth, _walk_source(pth, recurse, prefix_name, ignore_patterns))
+            for pth, recurse in pth_rec_list
+        ]
+    )
 
 
 class SpawnLoader(BaseLoader):
     """`SpawnLoader` serves the same purpose as `jinja2`'s built-in
     `jinja2.loaders.FileSystemLoader`, but only shows the files prefixed with
-    'self.prefix_name' as templates."""
+    'self.prefix_name' as templates.
+
+    The mapping from template name to file is built once, the first time
+    the loader is used, so lookups do not require scanning all source files.
+    Changes to the contents of a template are still picked up through the
+    mtime-based `uptodate` check. Instead of a searchpath, the files can be
+    passed directly as records (see `confspawn.walk.walk_files`) or as a
+    tuple of lists of absolute and relative paths.
+
+    Templates that only substitute config values can also be loaded as a
+    `confspawn.simple.SimpleTemplate` using `get_simple`, which skips
+    compiling them with Jinja.
+    """
 
     def __init__(
         self,
@@ -168,98 +168,228 @@ class SpawnLoader(BaseLoader):
         prefix_name: str = set_prefix_name,
         recurse: bool = False,
         template_locations: t.Optional[t.Tuple[t.List[Path], t.List[Path]]] = None,
+        records: t.Optional[t.List[FileRecord]] = None,
     ) -> None:
-        if template_locations is not None:
-            self.template_locations = template_locations
-        elif searchpath is None:
+        if template_locations is None and searchpath is None and records is None:
             raise ValueError(
-                "Either searchpath or template_locations must be provided!"
+                "Either searchpath, template_locations or records must be provided!"
             )
-        else:
-            self.searchpath = Path(searchpath)
+        self.searchpath = Path(searchpath) if searchpath is not None else None
         self.encoding = encoding
         self.prefix_name = prefix_name
         self.recurse = recurse
         self.template_locations = template_locations
-
-    def get_source(
-        self, environment: "Environment", template: str
-    ) -> t.Tuple[str, str, t.Callable[[], bool]]:
-        if self.template_locations is not None:
-            sub_files, sub_files_rel = self.template_locations
+        self.records = records
+        self._index: t.Optional[t.Dict[str, FileRecord]] = None
+        # Maps template name to the path and mtime of its source and the result of
+        # compile_simple
+        self._simple: t.Dict[str, t.Tuple[t.Tuple[str, int], t.Any]] = dict()
+
+    def _build_index(self) -> t.Dict[str, FileRecord]:
+        if self.records is not None:
+            records: t.Iterable[FileRecord] = self.records
+        elif self.template_locations is not None:
+            records = _records_from_paths(*self.template_locations, self.prefix_name)
         else:
-            sub_files, sub_files_rel = _get_all_sub_files_and_rel(
-                self.searchpath, self.recurse
-            )
-        for file_pth, rel_path in zip(sub_files, sub_files_rel):
-            # We use relative_to to remove the leading parts of the directory file path
-            # as_posix for a standardized way to represent the file path
-            if (
-                _if_to_spawn(file_pth, self.prefix_name)
-                and rel_path.as_posix() == template
-            ):
-                with open(file_pth, mode="rb") as f:
-                    contents = f.read().decode(self.encoding)
+            records = _walk_source(self.searchpath, self.recurse, self.prefix_name)
+        return {record.rel: record for record in records if record.is_template}
 
-                mtime = os.path.getmtime(file_pth)
+    def update_records(self, records: t.List[FileRecord]):
+        """Replaces the source files, i.e. after files were added or removed.
 
-                def uptodate() -> bool:
-                    try:
-                        return os.path.getmtime(file_pth) == mtime
-                    except OSError:
-                        return False
+        Templates already compiled by an environment using this loader are
+        kept, as long as their source file is unchanged.
+        """
+        self.records = records
+        self._index = None
 
-                return contents, file_pth.resolve().as_posix(), uptodate
-        raise TemplateNotFound(template)
+    @property
+    def index(self) -> t.Dict[str, FileRecord]:
+        """Mapping of template names to the records of their source files."""
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    def get_source(
+        self, environment: "Environment", template: str
+    ) -> t.Tuple[str, str, t.Callable[[], bool]]:
+        record = self.index.get(template)
+        if record is None:
+            raise TemplateNotFound(template)
+
+        file_pth = record.path
+        try:
+            with open(file_pth, mode="rb") as f:
+                contents = f.read().decode(self.encoding)
+        except FileNotFoundError:
+            # The file was removed after the index was built
+            raise TemplateNotFound(template)
+        mtime_ns = record.mtime_ns
+
+        def uptodate() -> bool:
+            # The name might refer to another file after the records are updated
+            current = self.index.get(template)
+            if current is None or current.path != file_pth:
+                return False
+            try:
+                return os.stat(file_pth).st_mtime_ns == mtime_ns
+            except OSError:
+                return False
+
+        return contents, Path(file_pth).as_posix(), uptodate
 
     def list_templates(self) -> t.List[str]:
-        template_list = []
-        if self.template_locations is not None:
-            sub_files, sub_files_rel = self.template_locations
+        return list(self.index)
+
+    def get_simple(
+        self, environment: "Environment", template: str
+    ) -> t.Optional[SimpleTemplate]:
+        """Loads the template as a `SimpleTemplate`, or returns None if it is
+        not simple. Whether it is simple is only determined again once its
+        source file changed."""
+        record = self.index.get(template)
+        if record is None:
+            return None
+        key = (record.path, record.mtime_ns)
+        cached = self._simple.get(template)
+        if cached is not None and cached[0] == key:
+            compiled = cached[1]
         else:
-            sub_files, sub_files_rel = _get_all_sub_files_and_rel(
-                self.searchpath, self.recurse
+            try:
+                with open(record.path, mode="rb") as f:
+                    contents = f.read().decode(self.encoding)
+            except FileNotFoundError:
+                return None
+            compiled = compile_simple(
+                environment, contents, template, Path(record.path).as_posix()
             )
-
-        for file_pth, rel_pth in zip(sub_files, sub_files_rel):
-            if _if_to_spawn(file_pth, self.prefix_name):
-                template_list.append(rel_pth.as_posix())
-        return template_list
+            self._simple[template] = (key, compiled)
+        if compiled is None:
+            return None
+        return SimpleTemplate(
+            environment, template, Path(record.path).as_posix(), *compiled
+        )
 
 
 def _prepare_target(target_path: Path):
+    import shutil
+
     if target_path.exists():
         shutil.rmtree(target_path)
     target_path.mkdir(parents=True)
 
 
+def _remove_stale(
+    target_path: Path, outputs: t.Set[str], preserve: t.Iterable[Path] = ()
+):
+    """Removes everything in the target that is not one of `outputs` (paths
+    relative to the target, in POSIX form), except for the paths in
+    `preserve`, and creates the target if it does not exist. Directories are
+    only removed if they end up empty."""
+    import shutil
+
+    if not target_path.is_dir():
+        target_path.unlink(missing_ok=True)
+        target_path.mkdir(parents=True)
+        return
+    preserved = {str(Path(p).resolve()) for p in preserve}
+    dirs = []
+    stack = [(str(target_path.resolve()), "")]
+    while stack:
+        dir_path, dir_rel = stack.pop()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.path in preserved:
+                    continue
+                rel = f"{dir_rel}{entry.name}"
+                if not entry.is_dir(follow_symlinks=False):
+                    if rel not in outputs:
+                        os.unlink(entry.path)
+                elif rel in outputs:
+                    shutil.rmtree(entry.path)
+                else:
+                    dirs.append(entry.path)
+                    stack.append((entry.path, f"{rel}/"))
+    # Deepest directories first, so that their parents can become empty
+    for dir_path in reversed(dirs):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass
+
+
+def _output_paths(
+    records: t.List[FileRecord], prefix_name: str, ignore_list: set
+) -> t.Set[str]:
+    """The paths of all outputs relative to the target, raising an error if a
+    template output conflicts with another file."""
+    outputs = {
+        record.rel
+        for record in records
+        if not record.is_template and record.path not in ignore_list
+    }
+    for record in records:
+        if record.is_template:
+            out_rel = _template_output(record.rel, prefix_name).as_posix()
+            if out_rel in outputs:
+                raise _template_conflict(record.rel, prefix_name)
+            outputs.add(out_rel)
+    return outputs
+
+
+def _move_records(
+    records: t.Iterable[FileRecord],
+    target_path: Path,
+    ignore_list: set,
+    link_mode: str = "copy",
+    skip_unchanged: bool = False,
+) -> t.Tuple[int, int]:
+    """Places the non-template files, returning their number and total
+    size. If skip_unchanged is True, files that are already in place are
+    left alone and not counted."""
+    made_dirs: t.Set[Path] = set()
+    count = 0
+    size = 0
+    for record in records:
+        # Files that don't start with prefix and are not ignored are moved
+        if record.is_template or record.path in ignore_list:
+            continue
+        target_file = target_path.joinpath(record.rel)
+        # ensure target directory exists
+        target_dir = target_file.parent
+        if target_dir not in made_dirs:
+            target_dir.mkdir(parents=True, exist_ok=True)
+            made_dirs.add(target_dir)
+        if place_file(Path(record.path), target_file, link_mode, skip_unchanged):
+            count += 1
+            size += record.size
+    return count, size
+
+
 def move_other_files(
     template_path: Path,
     target_path: Path,
     recurse: bool = False,
     prefix_name: str = set_prefix_name,
     ignore_list: t.Optional[set] = None,
+    link_mode: str = "copy",
+    ignore_patterns: t.Optional[t.List[str]] = None,
 ):
     """Move all files that are not template files to the other directory.
     Existing files will be overwritten.
 
-    The directory must exist.
+    The directory must exist. See `confspawn.link.place_file` for the
+    possible values of link_mode and `spawn_write` for ignore_patterns.
     """
     if ignore_list is None:
         ignore_list = set()
 
-    for file_pth in _get_all_sub_files(template_path, recurse):
-        if (
-            file_pth.is_file()
-            and not file_pth.name.startswith(prefix_name)
-            and str(file_pth.resolve()) not in ignore_list
-        ):
-            # ensure target directory exists
-            target_dir = target_path.joinpath(
-                file_pth.relative_to(template_path)
-            ).parent
-            target_dir.mkdir(parents=True, exist_ok=True)
-            shutil.copy(file_pth, target_dir)
+    _move_records(
+        _walk_source(template_path, recurse, prefix_name, ignore_patterns),
+        target_path,
+        ignore_list,
+        link_mode,
+    )
 
 
 def move_non_template_file_list(
@@ -268,29 +398,306 @@ def move_non_template_file_list(
     target_path: Path,
     prefix_name: str = set_prefix_name,
     ignore_list: t.Optional[set] = None,
+    link_mode: str = "copy",
 ):
     """Move all files that are not template files to the other directory.
 
     file_paths should be tuples of absolute paths and paths relative to
     their parent directory (i.e. their target location). Existing files
     will be overwritten. ignore_list should contain the resolved paths
-    to ignore.
+    to ignore. See `confspawn.link.place_file` for the possible values of
+    link_mode.
     """
     if ignore_list is None:
         ignore_list = set()
 
-    # Goes through all subpaths in template_path
-    for file_pth, file_pth_rel in zip(file_paths, rel_paths):
-        # Files that don't start with prefix and are not ignored are moved
-        if (
-            file_pth.is_file()
-            and not file_pth.name.startswith(prefix_name)
-            and str(file_pth.resolve()) not in ignore_list
-        ):
-            # ensure target directory exists
-            target_dir = target_path.joinpath(file_pth_rel).parent
-            target_dir.mkdir(parents=True, exist_ok=True)
-            shutil.copy(file_pth, target_dir)
+    _move_records(
+        _records_from_paths(file_paths, rel_paths, prefix_name),
+        target_path,
+        ignore_list,
+        link_mode,
+    )
+
+
+# Size of the buffer used when writing rendered templates
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Encoding of rendered templates, which are written in text mode
+_output_encoding = locale.getpreferredencoding(False)
+
+
+def _phase(timer: t.Optional[SpawnTimer], phase: str):
+    """Context manager that times a phase, if there is a timer."""
+    return timer.phase(phase) if timer is not None else nullcontext()
+
+
+def _run_timer(timer: t.Optional[SpawnTimer]):
+    return timer.run() if timer is not None else nullcontext()
+
+
+def _template_output(templ_name: str, prefix_name: str) -> Path:
+    """Relative output path of the template with name `templ_name`."""
+    rel_path = Path(templ_name)
+    return rel_path.parent.joinpath(removeprefix(rel_path.name, prefix_name))
+
+
+def _make_environment(
+    loader: BaseLoader, bytecode_cache: t.Optional[BytecodeCache] = None
+) -> Environment:
+    return Environment(
+        loader=loader,
+        autoescape=select_autoescape(),
+        bytecode_cache=bytecode_cache,
+    )
+
+
+def _load_template(env: Environment, templ_name: str):
+    """Loads a template, as a `SimpleTemplate` if it only substitutes config
+    values. Both have the same `generate` and `render` methods."""
+    if isinstance(env.loader, SpawnLoader):
+        simple = env.loader.get_simple(env, templ_name)
+        if simple is not None:
+            return simple
+    return env.get_template(templ_name)
+
+
+def _template_mode(env: Environment, templ_name: str) -> t.Optional[int]:
+    """File mode of the template source, if already known by the loader."""
+    if isinstance(env.loader, SpawnLoader):
+        record = env.loader.index.get(templ_name)
+        if record is not None:
+            return record.mode
+    return None
+
+
+def _write_template(
+    env: Environment,
+    templ_name: str,
+    config_dict: dict,
+    mod_path: Path,
+    overwrite: bool,
+    timed: bool = False,
+    skip_unchanged: bool = False,
+) -> t.Optional[t.Tuple[float, float, float, int]]:
+    """Renders a template to `mod_path`. If timed is True, returns the
+    durations of compiling, rendering and writing and the output size.
+
+    If skip_unchanged is True, an existing output with the same contents is
+    left alone (see `_write_changed`) and its mode is only set if it
+    differs."""
+    start = time.perf_counter()
+    template = _load_template(env, templ_name)
+    compiled = time.perf_counter()
+    # Get file mode
+    orig_mode = _template_mode(env, templ_name)
+    if orig_mode is None:
+        orig_mode = Path(template.filename).stat().st_mode
+    if overwrite and not skip_unchanged:
+        mod_path.unlink(missing_ok=True)
+    mod_path.parent.mkdir(exist_ok=True, parents=True)
+    # Stream the output to the file, so it is never held in memory as a whole
+    chunks = template.generate(config_dict)
+    render_time = [0.0]
+    if timed:
+        chunks = _timed_chunks(chunks, render_time)
+    if skip_unchanged:
+        size = _write_changed(chunks, mod_path)
+        if stat.S_IMODE(os.stat(mod_path).st_mode) != stat.S_IMODE(orig_mode):
+            mod_path.chmod(orig_mode)
+        if not timed:
+            return None
+        total = time.perf_counter() - compiled
+        return compiled - start, render_time[0], total - render_time[0], size
+    f = open(mod_path, "x", buffering=WRITE_BUFFER_SIZE)
+    try:
+        with f:
+            f.writelines(chunks)
+            size = f.tell() if timed else 0
+    except BaseException:
+        # Do not leave a partially rendered file behind
+        mod_path.unlink(missing_ok=True)
+        raise
+    # Set file mode
+    mod_path.chmod(orig_mode)
+
+    if not timed:
+        return None
+    total = time.perf_counter() - compiled
+    return compiled - start, render_time[0], total - render_time[0], size
+
+
+def _encode_output(chunk: str) -> bytes:
+    """Encodes a chunk like writing it in text mode would."""
+    if os.linesep != "\n":
+        chunk = chunk.replace("\n", os.linesep)
+    return chunk.encode(_output_encoding)
+
+
+def _write_changed(chunks: t.Iterable[str], mod_path: Path) -> int:
+    """Writes the chunks to `mod_path`, unless it already has exactly those
+    contents, so that it keeps its inode and modification time. Returns the
+    size of the output.
+
+    The chunks are compared to the existing file while they are rendered. At
+    the first difference, the matching start of the file and the remaining
+    chunks are written to a temporary file, which then replaces it.
+    """
+    if mod_path.is_symlink():
+        mod_path.unlink()
+    chunks = iter(chunks)
+    matched = 0
+    pending: t.Optional[str] = None
+    try:
+        existing = open(mod_path, "rb")
+    except FileNotFoundError:
+        existing = None
+    if existing is not None:
+        with existing:
+            for chunk in chunks:
+                data = _encode_output(chunk)
+                if existing.read(len(data)) != data:
+                    pending = chunk
+                    break
+                matched += len(data)
+            else:
+                if not existing.read(1):
+                    return matched
+
+    tmp_path = mod_path.with_name(f".{mod_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "x", buffering=WRITE_BUFFER_SIZE) as f:
+            if matched:
+                with open(mod_path, "rb") as existing:
+                    remaining = matched
+                    while remaining:
+                        data = existing.read(min(remaining, WRITE_BUFFER_SIZE))
+                        f.buffer.write(data)
+                        remaining -= len(data)
+            if pending is not None:
+                f.write(pending)
+            f.writelines(chunks)
+            size = f.tell()
+        os.replace(tmp_path, mod_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return size
+
+
+def _timed_chunks(chunks: t.Iterator[str], render_time: t.List[float]):
+    """Adds the time spent producing each chunk to `render_time[0]`, so that
+    rendering can be told apart from writing."""
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            render_time[0] += time.perf_counter() - start
+            return
+        render_time[0] += time.perf_counter() - start
+        yield chunk
+
+
+def _template_conflict(templ_name: str, prefix_name: str) -> ValueError:
+    return ValueError(
+        f"Modified template file {templ_name} already exists! Ensure no version without {prefix_name} "
+        f"is in the main folder."
+    )
+
+
+# State of a process in the pool used by _spawn_templates_parallel, each process owns its
+# own Environment
+_worker_state: t.Dict[str, t.Any] = dict()
+
+
+def _pool_context():
+    """Multiprocessing context for the process pools.
+
+    Forking while other threads are running (like the threads spawning
+    targets concurrently) can deadlock the child, so then the processes are
+    started by a fork server, or as new interpreters where that is not
+    available. Otherwise the default start method is used.
+    """
+    import multiprocessing
+    import threading
+
+    if threading.active_count() <= 1:
+        return None
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+
+
+def _init_render_worker(
+    loader: BaseLoader,
+    bytecode_cache: t.Optional[BytecodeCache],
+    config_dict: dict,
+    overwrite: bool,
+    timed: bool,
+    skip_unchanged: bool = False,
+):
+    _worker_state["env"] = _make_environment(loader, bytecode_cache)
+    _worker_state["config_dict"] = config_dict
+    _worker_state["overwrite"] = overwrite
+    _worker_state["timed"] = timed
+    _worker_state["skip_unchanged"] = skip_unchanged
+
+
+def _render_worker(jobs: t.List[t.Tuple[str, Path]]):
+    """Renders a chunk of templates, returning their timings if timed."""
+    return [
+        (
+            templ_name,
+            _write_template(
+                _worker_state["env"],
+                templ_name,
+                _worker_state["config_dict"],
+                mod_path,
+                _worker_state["overwrite"],
+                _worker_state["timed"],
+                _worker_state["skip_unchanged"],
+            ),
+        )
+        for templ_name, mod_path in jobs
+    ]
+
+
+def _spawn_templates_parallel(
+    env: Environment,
+    config_dict: dict,
+    render_jobs: t.List[t.Tuple[str, Path]],
+    overwrite: bool,
+    jobs: int,
+    timer: t.Optional[SpawnTimer] = None,
+    skip_unchanged: bool = False,
+):
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Use a few chunks per process to balance the load, while keeping the overhead of
+    # sending work to the processes low
+    chunk_size = max(1, len(render_jobs) // (jobs * 4))
+    chunks = [
+        render_jobs[i : i + chunk_size] for i in range(0, len(render_jobs), chunk_size)
+    ]
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=_pool_context(),
+        initializer=_init_render_worker,
+        initargs=(
+            env.loader,
+            env.bytecode_cache,
+            config_dict,
+            overwrite,
+            timer is not None,
+            skip_unchanged,
+        ),
+    ) as executor:
+        # Consume the results so that exceptions are raised
+        for results in executor.map(_render_worker, chunks):
+            if timer is not None:
+                for templ_name, timings in results:
+                    timer.add_template(templ_name, *timings)
 
 
 def spawn_templates(
@@ -298,38 +705,230 @@ def spawn_templates(
     config_dict: dict,
     target_path: Path,
     prefix_name: str = set_prefix_name,
+    template_names: t.Optional[t.List[str]] = None,
+    overwrite: bool = False,
+    jobs: int = 1,
+    timer: t.Optional[SpawnTimer] = None,
+    skip_unchanged: bool = False,
 ):
-    """Move template files and render them with the correct variables."""
-    template_names = env.list_templates()
+    """Move template files and render them with the correct variables.
+
+    By default all templates known to `env` are rendered, which can be
+    restricted by passing `template_names`. Unless `overwrite` is True, an
+    error is raised if the output of a template already exists. If
+    skip_unchanged is also True, outputs that already have the rendered
+    contents are not rewritten, so they keep their modification time.
+
+    If `jobs` is larger than 1, the templates are compiled and rendered by
+    a pool of that many processes. Each process creates its own
+    environment, using the loader and bytecode cache of `env`. All outputs
+    are checked for conflicts before rendering starts.
+
+    If a `timer` is given, the timings of each template are added to it.
+    """
+    if template_names is None:
+        template_names = env.list_templates()
+
+    render_jobs = []
     for templ_name in template_names:
-        template = env.get_template(templ_name)
-        templ_file = Path(template.filename)
-        # Get file mode
-        orig_mode = templ_file.stat().st_mode
-        mod_template = template.render(config_dict)
-        mod_name = removeprefix(templ_file.name, prefix_name)
-        mod_path_with_prefix = target_path.joinpath(templ_name)
-        mod_path = mod_path_with_prefix.parent.joinpath(mod_name)
-        if mod_path.exists():
-            raise ValueError(
-                f"Modified template file {templ_name} already exists! Ensure no version without {prefix_name} "
-                f"is in the main folder."
+        mod_path = target_path.joinpath(_template_output(templ_name, prefix_name))
+        if not overwrite and mod_path.exists():
+            raise _template_conflict(templ_name, prefix_name)
+        render_jobs.append((templ_name, mod_path))
+
+    if jobs > 1 and len(render_jobs) > 1:
+        _spawn_templates_parallel(
+            env, config_dict, render_jobs, overwrite, jobs, timer, skip_unchanged
+        )
+    else:
+        for templ_name, mod_path in render_jobs:
+            timings = _write_template(
+                env,
+                templ_name,
+                config_dict,
+                mod_path,
+                overwrite,
+                timer is not None,
+                skip_unchanged,
             )
-        mod_path.parent.mkdir(exist_ok=True, parents=True)
-        with open(mod_path, "x") as f:
-            f.write(mod_template)
-        # Set file mode
-        mod_path.chmod(orig_mode)
+            if timer is not None:
+                timer.add_template(templ_name, *timings)
+
+
+def _spawn_incremental(
+    env: Environment,
+    config_dict: dict,
+    records: t.List[FileRecord],
+    target_path: Path,
+    prefix_name: str,
+    ignore_list: set,
+    jobs: int = 1,
+    link_mode: str = "copy",
+    timer: t.Optional[SpawnTimer] = None,
+    skip_unchanged: bool = False,
+    preserve: t.Iterable[Path] = (),
+):
+    """Only re-renders or copies outputs whose inputs changed since the
+    previous incremental spawn, based on the manifest in the target.
+
+    A template only depends on the config values it reads (see
+    `template_config_keys`), so it is not re-rendered after changes to other
+    values. It is re-rendered if a template it extends, includes or imports
+    changed (see `template_dependencies`), and always if those cannot be
+    determined before rendering. Outputs whose source no longer exists are removed. If there is no
+    manifest, the target is rebuilt from scratch, unless skip_unchanged is
+    True, in which case only the files that are not outputs are removed
+    (except for those in `preserve`).
+    """
+    start = time.perf_counter()
+    old_outputs = load_manifest(target_path)
+    stale_target = old_outputs is None and skip_unchanged
+    if old_outputs is None:
+        if not stale_target:
+            with _phase(timer, "prepare"):
+                _prepare_target(target_path)
+        old_outputs = dict()
+
+    conf_digest = config_digest(config_dict)
+    outputs: t.Dict[str, dict] = dict()
+    changed_templates = []
+    changed_files = []
+
+    # All digests are needed first, as a template also depends on the templates it
+    # includes, extends or imports
+    sources: t.List[t.Tuple[FileRecord, str, t.Optional[dict], str]] = []
+    digests: t.Dict[str, str] = dict()
+    for record in records:
+        if record.is_template:
+            out_rel = _template_output(record.rel, prefix_name).as_posix()
+        elif record.path not in ignore_list:
+            out_rel = record.rel
+        else:
+            continue
+
+        old = old_outputs.get(out_rel)
+        if (
+            old is not None
+            and old["source"] == record.path
+            and old["size"] == record.size
+            and old["mtime_ns"] == record.mtime_ns
+        ):
+            # Unchanged file metadata, so avoid hashing the contents again
+            digest = old["hash"]
+        else:
+            digest = file_digest(Path(record.path))
+        sources.append((record, out_rel, old, digest))
+        digests[record.rel] = digest
+
+    for record, out_rel, old, digest in sources:
+        if out_rel in outputs:
+            raise _template_conflict(record.rel, prefix_name)
+
+        keys = None
+        conf = None
+        deps = None
+        if record.is_template:
+            unchanged = (
+                old is not None
+                and old["source"] == record.path
+                and old["hash"] == digest
+            )
+            if unchanged:
+                # The template did not change, so neither did the keys it reads
+                keys = old["keys"]
+            else:
+                keys = template_config_keys(env, record.rel)
+            conf = keys_digest(config_dict, keys) if keys is not None else conf_digest
+            if keys is None:
+                # Only templates that extend, include or import have dependencies
+                old_deps = old.get("deps") if unchanged else None
+                if old_deps is not None and all(
+                    digests.get(name) == dep_hash for name, dep_hash in old_deps.items()
+                ):
+                    deps = old_deps
+                else:
+                    names = template_dependencies(env, record.rel)
+                    if names is not None:
+                        deps = {name: digests.get(name) for name in names}
+
+        entry = {
+            "source": record.path,
+            "template": record.is_template,
+            "hash": digest,
+            "size": record.size,
+            "mtime_ns": record.mtime_ns,
+            "mode": record.mode,
+            "keys": keys,
+            "config": conf,
+            # Changing the link mode must place non-template files again
+            "link_mode": None if record.is_template else link_mode,
+            # Hashes of the templates it depends on, None if they are not known
+            "deps": deps,
+        }
+        outputs[out_rel] = entry
+
+        # Dependencies that are only known when rendering could always have changed
+        unknown_deps = record.is_template and keys is None and deps is None
+        if (
+            old == entry
+            and not unknown_deps
+            and target_path.joinpath(out_rel).is_file()
+        ):
+            continue
+        if record.is_template:
+            changed_templates.append(record.rel)
+        else:
+            changed_files.append(record)
+
+    if timer is not None:
+        timer.add_phase("manifest", time.perf_counter() - start)
+
+    with _phase(timer, "remove"):
+        if stale_target:
+            _remove_stale(target_path, outputs.keys() | {manifest_name}, preserve)
+        for out_rel in old_outputs.keys() - outputs.keys():
+            remove_output(target_path, out_rel)
+
+    with _phase(timer, "copy"):
+        placed = _move_records(
+            changed_files, target_path, ignore_list, link_mode, skip_unchanged
+        )
+    if timer is not None:
+        timer.add_files(*placed)
+    spawn_templates(
+        env,
+        config_dict,
+        target_path,
+        prefix_name,
+        template_names=changed_templates,
+        overwrite=True,
+        jobs=jobs,
+        timer=timer,
+        skip_unchanged=skip_unchanged,
+    )
+
+    with _phase(timer, "manifest"):
+        write_manifest(target_path, outputs)
 
 
 def spawn_write(
-    config_path: Path,
+    config_path: ConfigPaths,
     template_path: Path,
     target_path: Path,
     recurse: bool = False,
     prefix_name: str = set_prefix_name,
-    env_mode: str = "less",
+    env_mode: t.Union[str, t.List[str]] = "less",
     ignore_list: t.Optional[set] = None,
+    cache_dir: t.Optional[Path] = set_cache_dir,
+    incremental: bool = False,
+    jobs: int = 1,
+    link_mode: str = "copy",
+    atomic: bool = False,
+    timer: t.Optional[SpawnTimer] = None,
+    ignore_patterns: t.Optional[t.List[str]] = None,
+    workers: int = 1,
+    fan_out: t.Optional[str] = None,
+    skip_unchanged: bool = False,
 ):
     """Ensures empty directory exists at target (removing any that exist).
 
@@ -338,60 +937,781 @@ def spawn_write(
     moves them to the target with the prefix_name removed. Prefix_name
     defaults to 'confspawn_' but can be set using CONFSPAWN_PREFIX env
     var or directly in this function (the latter takes precedence).
-    """
 
-    file_paths, rel_paths = _get_all_sub_files_and_rel(template_path, recurse)
-    spawn_write_with_paths(
-        config_path,
-        file_paths,
-        rel_paths,
-        target_path,
-        prefix_name,
-        env_mode,
-        ignore_list,
-    )
+    config_path can also be a list of config files, which are merged with
+    later files overriding earlier ones (see `confspawn.config.ConfigOverlay`).
+
+    If cache_dir is set (it defaults to the CONFSPAWN_CACHE env var), compiled
+    templates are stored there and reused by later runs, as long as the template
+    source and the confspawn and Jinja versions are unchanged. The size of the
+    cache is bounded by the CONFSPAWN_CACHE_SIZE env var (in bytes, 64 MiB by
+    default).
+
+    If incremental is True, the target is not removed. Instead, a manifest
+    stored in the target records the inputs of each output (source file
+    hash, mode and the config values it reads), so that only the outputs whose inputs
+    changed are re-rendered or copied on the next incremental run. Outputs
+    whose source was removed are deleted.
+
+    If jobs is larger than 1, templates are rendered in parallel by that many
+    processes.
+
+    Non-template files are copied by default. link_mode can be set to
+    'hardlink', 'reflink', 'symlink' or 'auto' to use a cheaper mechanism
+    if the file system supports it, see `confspawn.link.place_file`.
+
+    If atomic is True, everything is first written to a staging directory
+    next to the target, which then replaces the target using a rename. So
+    the target is never empty or partially written, and it is left intact if
+    spawning fails. This cannot be combined with incremental.
+
+    If a `timer` (see `confspawn.timing.SpawnTimer`) is given, the duration
+    of each phase and template and the number and size of the written files
+    are recorded in it.
+
+    Files and directories matching the gitignore-style `ignore_patterns`, or
+    the patterns in a '.confspawnignore' file in the template directory, are
+    not spawned. Excluded directories are not even entered. See
+    `confspawn.ignore.IgnoreRules` for the syntax.
+
+    env_mode can also be a list of env modes, in which case the templates are
+    spawned for each of them, to the target with '{env}' replaced by the env
+    mode (like 'out/{env}'). The config is only parsed and the templates are
+    only compiled once. If workers is larger than 1, that many env modes are
+    spawned concurrently by threads. Each env mode is timed separately, see
+    `SpawnTimer.targets`.
+
+    If fan_out is set to the (dotted) key of an array of tables in the config,
+    the templates are spawned once for each of its items, which is available
+    as 'item' in the templates. The target is formatted with the fields of
+    the item, for example 'hosts/{name}' (see `str.format`), and the targets
+    of the items must be different and not inside each other. The templates
+    are compiled once, and if jobs is larger than 1, the items are spawned in
+    batches by a pool of that many processes.
+
+    If skip_unchanged is True, the target is not removed first. Outputs that
+    already have the right contents (or are the right link) are left alone,
+    so they keep their inode and modification time, and only their mode is
+    updated if it differs. Everything else in the target is removed. This
+    cannot be combined with atomic.
+    """
+    with _run_timer(timer):
+        with _phase(timer, "walk"):
+            records = list(
+                _walk_source(template_path, recurse, prefix_name, ignore_patterns)
+            )
+        _spawn_write_envs(
+            config_path,
+            records,
+            target_path,
+            prefix_name,
+            env_mode,
+            ignore_list,
+            cache_dir,
+            incremental,
+            jobs,
+            link_mode,
+            atomic,
+            workers,
+            timer,
+            fan_out,
+            skip_unchanged,
+        )
 
 
 def spawn_write_with_paths(
-    config_path: Path,
+    config_path: ConfigPaths,
     source_files: t.List[Path],
     source_files_relative: t.List[Path],
     target_path: Path,
     prefix_name: str = set_prefix_name,
+    env_mode: t.Union[str, t.List[str]] = "less",
+    ignore_list: t.Optional[set] = None,
+    cache_dir: t.Optional[Path] = set_cache_dir,
+    incremental: bool = False,
+    jobs: int = 1,
+    link_mode: str = "copy",
+    atomic: bool = False,
+    timer: t.Optional[SpawnTimer] = None,
+    workers: int = 1,
+    fan_out: t.Optional[str] = None,
+    skip_unchanged: bool = False,
+):
+    """Like `spawn_write`, but for lists of the absolute and relative paths
+    of the source files."""
+    with _run_timer(timer):
+        with _phase(timer, "walk"):
+            records = _records_from_paths(
+                source_files, source_files_relative, prefix_name
+            )
+        _spawn_write_envs(
+            config_path,
+            records,
+            target_path,
+            prefix_name,
+            env_mode,
+            ignore_list,
+            cache_dir,
+            incremental,
+            jobs,
+            link_mode,
+            atomic,
+            workers,
+            timer,
+            fan_out,
+            skip_unchanged,
+        )
+
+
+def _env_targets(target_path: Path, env_modes: t.List[str]) -> t.Dict[str, str]:
+    """Maps the target of each env mode to the env mode, replacing '{env}' in
+    `target_path`."""
+    target_pattern = str(target_path)
+    if len(set(env_modes)) > 1 and "{env}" not in target_pattern:
+        raise ValueError(
+            "When spawning for multiple envs, the target must contain '{env}'! Like: "
+            "out/{env}"
+        )
+    return {target_pattern.replace("{env}", env): env for env in env_modes}
+
+
+def _shared_bytecode_cache(
+    cache_dir: t.Optional[Path],
+) -> t.Tuple[t.Optional[SpawnBytecodeCache], MemoryBytecodeCache]:
+    """An in-memory bytecode cache, to share compiled templates between
+    environments, backed by the persistent cache in `cache_dir` (if set)."""
+    persistent_cache = (
+        SpawnBytecodeCache(cache_dir, set_cache_size) if cache_dir is not None else None
+    )
+    return persistent_cache, MemoryBytecodeCache(persistent_cache)
+
+
+def _spawn_write_envs(
+    config_path: ConfigPaths,
+    records: t.List[FileRecord],
+    target_path: Path,
+    prefix_name: str,
+    env_mode: t.Union[str, t.List[str]],
+    ignore_list: t.Optional[set],
+    cache_dir: t.Optional[Path],
+    incremental: bool,
+    jobs: int,
+    link_mode: str,
+    atomic: bool,
+    workers: int,
+    timer: t.Optional[SpawnTimer],
+    fan_out: t.Optional[str] = None,
+    skip_unchanged: bool = False,
+):
+    """Spawns the records for one env mode or for each of a list of env modes,
+    sharing the parsed config and compiled templates between them."""
+    if fan_out is not None:
+        if not (isinstance(env_mode, str) or env_mode is None):
+            raise ValueError("A fan-out cannot be spawned for multiple envs!")
+        if env_mode is not None:
+            target_path = Path(str(target_path).replace("{env}", env_mode))
+        persistent_cache, bytecode_cache = _shared_bytecode_cache(cache_dir)
+        environment = _make_environment(
+            SpawnLoader(prefix_name=prefix_name, records=records), bytecode_cache
+        )
+        with _phase(timer, "config"):
+            config_dict = _get_settings(config_path, env_mode)
+        _spawn_fan_out(
+            config_path,
+            records,
+            target_path,
+            prefix_name,
+            fan_out,
+            ignore_list,
+            incremental,
+            jobs,
+            link_mode,
+            atomic,
+            environment,
+            config_dict,
+            timer,
+            skip_unchanged,
+        )
+        if persistent_cache is not None:
+            with _phase(timer, "prune"):
+                persistent_cache.prune()
+        return
+
+    if isinstance(env_mode, str) or env_mode is None:
+        if env_mode is not None:
+            target_path = Path(str(target_path).replace("{env}", env_mode))
+        _spawn_write_records(
+            config_path,
+            records,
+            target_path,
+            prefix_name,
+            env_mode,
+            ignore_list,
+            cache_dir,
+            incremental,
+            jobs,
+            link_mode,
+            atomic,
+            timer=timer,
+            skip_unchanged=skip_unchanged,
+        )
+        return
+
+    targets = _env_targets(target_path, env_mode)
+    persistent_cache, bytecode_cache = _shared_bytecode_cache(cache_dir)
+    environment = _make_environment(
+        SpawnLoader(prefix_name=prefix_name, records=records), bytecode_cache
+    )
+    with _phase(timer, "config"):
+        toml_dict = load_config(config_path)
+        config_dicts = {env: _select_env(toml_dict, env) for env in env_mode}
+
+    def spawn_env(t_pth_nm: str):
+        target_timer = timer.target(t_pth_nm) if timer is not None else None
+        with _run_timer(target_timer):
+            env = targets[t_pth_nm]
+            _spawn_write_records(
+                config_path,
+                records,
+                Path(t_pth_nm),
+                prefix_name,
+                env_mode=env,
+                ignore_list=ignore_list,
+                incremental=incremental,
+                jobs=jobs,
+                link_mode=link_mode,
+                atomic=atomic,
+                environment=environment,
+                config_dict=config_dicts[env],
+                timer=target_timer,
+                skip_unchanged=skip_unchanged,
+            )
+
+    tasks = {t_pth_nm: partial(spawn_env, t_pth_nm) for t_pth_nm in targets}
+    _run_schedule(tasks, _target_parents(list(targets)), workers)
+
+    if persistent_cache is not None:
+        with _phase(timer, "prune"):
+            persistent_cache.prune()
+
+
+def _fan_out_targets(
+    config_dict: dict, fan_out: str, target_path: Path
+) -> t.List[t.Tuple[str, dict]]:
+    """Pairs of target and item for each item of the array at the dotted key
+    `fan_out`, where the target is `target_path` formatted with the fields of
+    the item."""
+    if "item" in config_dict:
+        raise ValueError(
+            f"The config cannot contain a top-level key 'item' when fanning out over "
+            f"'{fan_out}', as 'item' refers to the item in the templates!"
+        )
+    items = _deep_get(config_dict, fan_out)
+    if not isinstance(items, list) or not all(isinstance(i, Mapping) for i in items):
+        raise ValueError(
+            f"'{fan_out}' in the config must be an array of tables to fan out over!"
+        )
+    target_pattern = str(target_path)
+    targets = []
+    for item in items:
+        try:
+            targets.append((target_pattern.format_map(item), item))
+        except (KeyError, IndexError, AttributeError) as e:
+            raise ValueError(
+                f"Target {target_pattern} refers to field {e} that is missing in an "
+                f"item of '{fan_out}'!"
+            )
+    parents = _target_parents([t_pth_nm for t_pth_nm, _ in targets])
+    if len(parents) < len(targets) or any(p is not None for p in parents.values()):
+        raise ValueError(
+            f"The targets of the items of '{fan_out}' must be different and must not "
+            f"be inside each other!"
+        )
+    return targets
+
+
+def _init_fan_out_worker(
+    loader: BaseLoader,
+    bytecode_cache: t.Optional[BytecodeCache],
+    config_path: ConfigPaths,
+    config_dict: dict,
+    records: t.List[FileRecord],
+    options: dict,
+):
+    _worker_state["env"] = _make_environment(loader, bytecode_cache)
+    _worker_state["config_path"] = config_path
+    _worker_state["config_dict"] = config_dict
+    _worker_state["records"] = records
+    _worker_state["options"] = options
+
+
+def _fan_out_worker(batch: t.List[t.Tuple[str, dict]]):
+    """Spawns a batch of fan-out items, each to its own target."""
+    for t_pth_nm, item in batch:
+        _spawn_write_records(
+            _worker_state["config_path"],
+            _worker_state["records"],
+            Path(t_pth_nm),
+            environment=_worker_state["env"],
+            config_dict=dict(_worker_state["config_dict"], item=item),
+            **_worker_state["options"],
+        )
+
+
+def _spawn_fan_out(
+    config_path: ConfigPaths,
+    records: t.List[FileRecord],
+    target_path: Path,
+    prefix_name: str,
+    fan_out: str,
+    ignore_list: t.Optional[set],
+    incremental: bool,
+    jobs: int,
+    link_mode: str,
+    atomic: bool,
+    environment: Environment,
+    config_dict: dict,
+    timer: t.Optional[SpawnTimer],
+    skip_unchanged: bool = False,
+):
+    """Spawns the records once for every item of the array at `fan_out` in
+    the config, with the item available as 'item' in the templates.
+
+    With more than 1 job, the items are spawned in batches by a pool of that
+    many processes, each compiling the templates once. Only the total
+    duration of the pool is timed then, as the 'fan_out' phase.
+    """
+    targets = _fan_out_targets(config_dict, fan_out, target_path)
+    options = dict(
+        prefix_name=prefix_name,
+        ignore_list=ignore_list,
+        incremental=incremental,
+        link_mode=link_mode,
+        atomic=atomic,
+        skip_unchanged=skip_unchanged,
+    )
+
+    if jobs <= 1 or len(targets) <= 1:
+        for t_pth_nm, item in targets:
+            _spawn_write_records(
+                config_path,
+                records,
+                Path(t_pth_nm),
+                environment=environment,
+                config_dict=dict(config_dict, item=item),
+                jobs=jobs,
+                timer=timer,
+                **options,
+            )
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunk_size = max(1, len(targets) // (jobs * 4))
+    batches = [targets[i : i + chunk_size] for i in range(0, len(targets), chunk_size)]
+    with _phase(timer, "fan_out"):
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=_pool_context(),
+            initializer=_init_fan_out_worker,
+            initargs=(
+                environment.loader,
+                environment.bytecode_cache,
+                config_path,
+                config_dict,
+                records,
+                options,
+            ),
+        ) as executor:
+            # Consume the results so that exceptions are raised
+            for _ in executor.map(_fan_out_worker, batches):
+                pass
+
+
+def _spawn_write_records(
+    config_path: ConfigPaths,
+    records: t.List[FileRecord],
+    target_path: Path,
+    prefix_name: str = set_prefix_name,
     env_mode: str = "less",
     ignore_list: t.Optional[set] = None,
+    cache_dir: t.Optional[Path] = set_cache_dir,
+    incremental: bool = False,
+    jobs: int = 1,
+    link_mode: str = "copy",
+    atomic: bool = False,
+    environment: t.Optional[Environment] = None,
+    config_dict: t.Optional[dict] = None,
+    timer: t.Optional[SpawnTimer] = None,
+    skip_unchanged: bool = False,
+    preserve: t.Iterable[Path] = (),
 ):
+    """Spawns the records to the target. With skip_unchanged, the paths in
+    `preserve` (like the targets nested inside this one) are not removed."""
     if ignore_list is None:
         ignore_list = set()
+    if atomic and incremental:
+        raise ValueError("A spawn cannot be both atomic and incremental!")
+    if atomic and skip_unchanged:
+        raise ValueError("A spawn cannot be both atomic and skip unchanged outputs!")
+
+    if environment is None:
+        bytecode_cache = (
+            SpawnBytecodeCache(cache_dir, set_cache_size)
+            if cache_dir is not None
+            else None
+        )
+        env = _make_environment(
+            SpawnLoader(prefix_name=prefix_name, records=records), bytecode_cache
+        )
+    else:
+        # Reuse the environment (and so its compiled templates), for example
+        # between the rounds of watch mode
+        env = environment
+        bytecode_cache = env.bytecode_cache
+    if config_dict is None:
+        with _phase(timer, "config"):
+            config_dict = _get_settings(config_path, env_mode)
+
+    if incremental:
+        _spawn_incremental(
+            env,
+            config_dict,
+            records,
+            target_path,
+            prefix_name,
+            ignore_list,
+            jobs,
+            link_mode,
+            timer,
+            skip_unchanged,
+            preserve,
+        )
+    elif atomic:
+        with _phase(timer, "prepare"):
+            stage_path = make_stage(target_path)
+        try:
+            with _phase(timer, "copy"):
+                placed = _move_records(records, stage_path, ignore_list, link_mode)
+            if timer is not None:
+                timer.add_files(*placed)
+            spawn_templates(
+                env, config_dict, stage_path, prefix_name, jobs=jobs, timer=timer
+            )
+        except BaseException:
+            discard_stage(stage_path)
+            raise
+        with _phase(timer, "swap"):
+            swap_into_place(stage_path, target_path)
+    elif skip_unchanged:
+        outputs = _output_paths(records, prefix_name, ignore_list)
+        with _phase(timer, "remove"):
+            _remove_stale(target_path, outputs, preserve)
+        with _phase(timer, "copy"):
+            placed = _move_records(
+                records, target_path, ignore_list, link_mode, skip_unchanged=True
+            )
+        if timer is not None:
+            timer.add_files(*placed)
+
+        spawn_templates(
+            env,
+            config_dict,
+            target_path,
+            prefix_name,
+            overwrite=True,
+            jobs=jobs,
+            timer=timer,
+            skip_unchanged=True,
+        )
+    else:
+        with _phase(timer, "prepare"):
+            _prepare_target(target_path)
+        with _phase(timer, "copy"):
+            placed = _move_records(records, target_path, ignore_list, link_mode)
+        if timer is not None:
+            timer.add_files(*placed)
+
+        spawn_templates(
+            env, config_dict, target_path, prefix_name, jobs=jobs, timer=timer
+        )
 
-    env = Environment(
-        loader=SpawnLoader(
-            prefix_name=prefix_name,
-            template_locations=(source_files, source_files_relative),
-        ),
-        autoescape=select_autoescape(),
+    if isinstance(bytecode_cache, SpawnBytecodeCache):
+        with _phase(timer, "prune"):
+            bytecode_cache.prune()
+
+
+class SpawnedFile:
+    """An output of `spawn_memory`, with its contents and file permissions.
+
+    The contents of non-template files are only read from `source` the first
+    time `data` is accessed. Rendered templates have no source.
+    """
+
+    __slots__ = ("mode", "source", "_data")
+
+    def __init__(
+        self, mode: int, data: t.Optional[bytes] = None, source: t.Optional[str] = None
+    ) -> None:
+        if data is None and source is None:
+            raise ValueError("Either data or source must be provided!")
+        self.mode = mode
+        self.source = source
+        self._data = data
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            with open(self.source, "rb") as f:
+                self._data = f.read()
+        return self._data
+
+    def __repr__(self) -> str:
+        return f"SpawnedFile(mode={oct(self.mode)}, source={self.source!r})"
+
+
+def spawn_memory(
+    config: t.Union[ConfigPaths, t.Mapping],
+    sources: t.List[t.Tuple[Path, bool]],
+    prefix_name: str = set_prefix_name,
+    env_mode: str = "less",
+    ignore_list: t.Optional[set] = None,
+    cache_dir: t.Optional[Path] = set_cache_dir,
+    encoding: str = "utf-8",
+    ignore_patterns: t.Optional[t.List[str]] = None,
+) -> t.Dict[str, SpawnedFile]:
+    """Like `spawn_write`, but returns the outputs instead of writing them to a
+    target.
+
+    `sources` is a list of source paths and whether to search them
+    recursively. `config` is either the path of a config file (or a list of
+    them, see `spawn_write`) or an already parsed config, to which
+    `env_mode` is applied in the same way. The
+    returned dict maps the output path relative to the target (in POSIX
+    form) to a `SpawnedFile`. Templates are rendered and encoded using
+    `encoding`, while the other files are only read when their data is
+    accessed. The same conflicts as for `spawn_write` raise a ValueError and
+    files are ignored in the same way.
+    """
+    if ignore_list is None:
+        ignore_list = set()
+
+    records = _merge_records(
+        [(Path(pth), recurse) for pth, recurse in sources],
+        prefix_name,
+        ignore_patterns,
+    )
+    bytecode_cache = (
+        SpawnBytecodeCache(cache_dir, set_cache_size) if cache_dir is not None else None
+    )
+    env = _make_environment(
+        SpawnLoader(prefix_name=prefix_name, records=records), bytecode_cache
     )
-    config_dict = _get_settings(config_path, env_mode)
+    if isinstance(config, Mapping):
+        config_dict = _select_env(config, env_mode)
+    else:
+        config_dict = _get_settings(config, env_mode)
+
+    outputs: t.Dict[str, SpawnedFile] = dict()
+    for record in records:
+        if not record.is_template and record.path not in ignore_list:
+            outputs[record.rel] = SpawnedFile(
+                stat.S_IMODE(record.mode), source=record.path
+            )
+    for record in records:
+        if not record.is_template:
+            continue
+        out_rel = _template_output(record.rel, prefix_name).as_posix()
+        if out_rel in outputs:
+            raise _template_conflict(record.rel, prefix_name)
+        rendered = _load_template(env, record.rel).render(config_dict)
+        outputs[out_rel] = SpawnedFile(
+            stat.S_IMODE(record.mode), data=rendered.encode(encoding)
+        )
+
+    if bytecode_cache is not None:
+        bytecode_cache.prune()
+
+    return outputs
+
+
+def _target_parents(target_names: t.List[str]) -> t.Dict[str, t.Optional[str]]:
+    """For each target, find the closest other target that contains it (if any).
+
+    Spawning to a target removes everything inside it, so a target must
+    be spawned after the target containing it. Targets that resolve to the
+    same path depend on the one listed first.
+    """
+    resolved_targets: t.Dict[Path, str] = dict()
+    parents: t.Dict[str, t.Optional[str]] = dict()
+    for t_pth_nm in target_names:
+        t_pth = Path(t_pth_nm).resolve()
+        parent = resolved_targets.get(t_pth)
+        if parent is None:
+            resolved_targets[t_pth] = t_pth_nm
+        parents[t_pth_nm] = parent
+
+    for t_pth_nm in target_names:
+        if parents[t_pth_nm] is not None:
+            continue
+        for ancestor in Path(t_pth_nm).resolve().parents:
+            if ancestor in resolved_targets:
+                parents[t_pth_nm] = resolved_targets[ancestor]
+                break
+
+    return parents
+
+
+def _run_schedule(
+    tasks: t.Dict[str, t.Callable[[], t.Any]],
+    parents: t.Dict[str, t.Optional[str]],
+    workers: int = 1,
+):
+    """Runs all tasks, where a task is only started once the task of its parent
+    has finished.
 
-    _prepare_target(target_path)
-    move_non_template_file_list(
-        source_files, source_files_relative, target_path, prefix_name, ignore_list
+    With more than 1 worker, tasks that do not depend on each other run
+    concurrently in a thread pool.
+    """
+    children: t.Dict[str, t.List[str]] = {name: [] for name in tasks}
+    ready = []
+    for name in tasks:
+        parent = parents[name]
+        if parent is None:
+            ready.append(name)
+        else:
+            children[parent].append(name)
+
+    if workers <= 1:
+        while ready:
+            name = ready.pop(0)
+            tasks[name]()
+            ready.extend(children[name])
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: t.Dict[Future, str] = {
+            executor.submit(tasks[name]): name for name in ready
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                if future.exception() is not None:
+                    for other in pending:
+                        other.cancel()
+                    raise future.exception()
+                for child in children[name]:
+                    pending[executor.submit(tasks[child])] = child
+
+
+def _target_records(
+    spawn_dicts: t.List[dict], prefix_name: str = set_prefix_name
+) -> t.List[FileRecord]:
+    """Records of the files of all recipe sources of one target."""
+    walks = [
+        (
+            Path(s["src"]),
+            _walk_source(Path(s["src"]), s["recurse"], prefix_name, s.get("ignore")),
+        )
+        for s in spawn_dicts
+    ]
+    if len(walks) > 1:
+        return _merge_walks(walks)
+    return list(walks[0][1])
+
+
+def _sources_key(spawn_dicts: t.List[dict]) -> tuple:
+    return tuple(
+        (str(Path(s["src"]).resolve()), s["recurse"], tuple(s.get("ignore") or ()))
+        for s in spawn_dicts
     )
 
-    spawn_templates(env, config_dict, target_path, prefix_name)
 
+def _replica_targets(
+    target_paths: t.Dict[str, t.List[dict]], parents: t.Dict[str, t.Optional[str]]
+) -> t.Dict[str, str]:
+    """Maps every target that has the same sources and env as another target
+    (without a fan-out) to that target, whose outputs it can reuse.
 
-def recipe(
+    The outputs are read from the target they were rendered to, so that
+    target must not contain any other target, which could replace them. A
+    target is only a replica if it can be spawned right after that target
+    without breaking the order of nested targets, so if its own parent
+    target is one of the ancestors of that target.
+    """
+    has_nested = {parent for parent in parents.values() if parent is not None}
+    groups: t.Dict[tuple, t.List[str]] = dict()
+    for t_pth_nm, spawn_dicts in target_paths.items():
+        if spawn_dicts[0].get("fan_out") is None:
+            key = (_sources_key(spawn_dicts), spawn_dicts[0]["env"])
+            groups.setdefault(key, []).append(t_pth_nm)
+
+    replicas: t.Dict[str, str] = dict()
+    for group in groups.values():
+        primary = next((g for g in group if g not in has_nested), None)
+        if primary is None:
+            continue
+        ancestors = []
+        ancestor = parents[primary]
+        while ancestor is not None:
+            ancestors.append(ancestor)
+            ancestor = parents[ancestor]
+        for t_pth_nm in group:
+            if t_pth_nm == primary or t_pth_nm in ancestors:
+                continue
+            parent = parents[t_pth_nm]
+            if parent is None or parent in ancestors:
+                replicas[t_pth_nm] = primary
+    return replicas
+
+
+def _rendered_records(
+    records: t.List[FileRecord], primary_path: Path, prefix_name: str
+) -> t.List[FileRecord]:
+    """Records in which each template is replaced by its output in the target
+    it was already spawned to, so it can be placed like any other file."""
+    rendered = []
+    for record in records:
+        if record.is_template:
+            out_rel = _template_output(record.rel, prefix_name).as_posix()
+            out_path = primary_path.joinpath(out_rel)
+            record = FileRecord(
+                str(out_path.resolve()), out_rel, False, out_path.stat()
+            )
+        rendered.append(record)
+    return rendered
+
+
+def _recipe_ignore(d: dict, recipe_path: Path) -> t.List[str]:
+    patterns = d.get("ignore", [])
+    if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+        raise ValueError(
+            f"'ignore' in recipe {recipe_path!s} must be an array of patterns! Like: "
+            f"ignore = ['.git/', '*.tmp']"
+        )
+    return patterns
+
+
+def _load_recipe(
     recipe_path: Path,
-    prefix_name: str = set_prefix_name,
     env_overwrite: t.Optional[str] = None,
-):
+    ignore_patterns: t.Optional[t.List[str]] = None,
+) -> t.Tuple[ConfigPaths, t.Dict[str, t.List[dict]]]:
+    """Loads the recipe at `recipe_path`, returning the config path and the
+    sources grouped by target.
+
+    The ignore patterns of a source are those at the top level of the recipe,
+    followed by those of the source and `ignore_patterns`."""
     with open(recipe_path, "rb") as f:
         recipe_dict = tomli.load(f)
 
     if "config" not in recipe_dict:
         raise ValueError(
-            "You must specify path for the source 'config'! Like: config = 'config.toml'"
+            "You must specify path for the source 'config'! Like: config = 'config.toml' "
+            "or config = ['base.toml', 'override.toml']"
         )
 
     if (
@@ -403,11 +1723,15 @@ def recipe(
             "You must include at least one element in the [[sources]] array!"
         )
 
-    config_path = Path(recipe_dict["config"])
-
-    ignore_list = {str(recipe_path.resolve())}
+    config = recipe_dict["config"]
+    if isinstance(config, list):
+        config_path: ConfigPaths = [Path(c) for c in config]
+    else:
+        config_path = Path(config)
+    recipe_ignore = _recipe_ignore(recipe_dict, recipe_path)
+    extra_ignore = ignore_patterns if ignore_patterns is not None else []
 
-    target_paths: dict = dict()
+    target_paths: t.Dict[str, t.List[dict]] = dict()
 
     for d in recipe_dict["sources"]:
         if "source" not in d or "target" not in d:
@@ -431,7 +1755,17 @@ def recipe(
         s_pth_nm = d["source"]
         t_pth_nm = d["target"]
 
-        spawn_dict = {"src": s_pth_nm, "env": env, "recurse": recurse}
+        ignore = recipe_ignore + _recipe_ignore(d, recipe_path) + extra_ignore
+
+        fan_out = d.get("fan_out")
+
+        spawn_dict = {
+            "src": s_pth_nm,
+            "env": env,
+            "recurse": recurse,
+            "ignore": ignore,
+            "fan_out": fan_out,
+        }
 
         if t_pth_nm in target_paths:
             t_env = target_paths[t_pth_nm][0]["env"]
@@ -439,39 +1773,173 @@ def recipe(
                 raise ValueError(
                     "When spawning multiple sources to the same target, they must have the same env!"
                 )
+            if target_paths[t_pth_nm][0]["fan_out"] != fan_out:
+                raise ValueError(
+                    "When spawning multiple sources to the same target, they must have the same fan_out!"
+                )
             target_paths[t_pth_nm].append(spawn_dict)
         else:
             target_paths[t_pth_nm] = [spawn_dict]
 
-    for t_pth_nm in target_paths:
-        spawn_dicts = target_paths[t_pth_nm]
-        t_pth = Path(t_pth_nm)
-        # We checked above if they are the same
-        env = spawn_dicts[0]["env"]
-        if len(spawn_dicts) > 1:
-            src_recs = [(Path(s["src"]), s["recurse"]) for s in spawn_dicts]
-            file_paths, rel_paths = _merge_paths(src_recs)
+    return config_path, target_paths
 
-            spawn_write_with_paths(
-                config_path,
-                file_paths,
-                rel_paths,
-                t_pth,
-                prefix_name,
-                env_mode=env,
-                ignore_list=ignore_list,
-            )
-        else:
-            s_dct = spawn_dicts[0]
-            s_pth = Path(s_dct["src"])
-            recurse = s_dct["recurse"]
 
-            spawn_write(
-                config_path,
-                s_pth,
-                t_pth,
-                recurse,
-                prefix_name,
-                env_mode=env,
-                ignore_list=ignore_list,
+def recipe(
+    recipe_path: Path,
+    prefix_name: str = set_prefix_name,
+    env_overwrite: t.Optional[str] = None,
+    cache_dir: t.Optional[Path] = set_cache_dir,
+    incremental: bool = False,
+    jobs: int = 1,
+    workers: int = 1,
+    link_mode: str = "copy",
+    atomic: bool = False,
+    timer: t.Optional[SpawnTimer] = None,
+    ignore_patterns: t.Optional[t.List[str]] = None,
+    skip_unchanged: bool = False,
+):
+    """Spawns all sources in the recipe at `recipe_path` to their targets.
+
+    The config of the recipe can also be an array of config files, which are
+    merged like for `spawn_write`.
+
+    A target that is inside another target is always spawned after it. If
+    workers is larger than 1, targets that are not nested are spawned
+    concurrently by that many threads.
+
+    The config is loaded once per env mode and all targets share the compiled
+    templates, so a template that is spawned to several targets is compiled
+    only once.
+
+    Patterns of files to ignore can be set for the whole recipe and for each
+    source using an `ignore` array, and `ignore_patterns` are added to those
+    of every source.
+
+    A source with `fan_out` set to the key of an array of tables in the
+    config is spawned once for each item, to its target formatted with the
+    fields of the item (see `spawn_write`). Each item is scheduled as a
+    separate target, so it is ordered against the other targets and items
+    are spawned concurrently using `workers`.
+
+    Targets with the same sources and env (and so the same config) as
+    another target are not rendered again. Once that target is spawned, its
+    rendered templates are placed in them like the other files, using
+    `link_mode`. So the rendering work only grows with the number of
+    distinct outputs. Targets that contain other targets are never reused
+    like this, as the nested targets could replace their outputs.
+
+    See `spawn_write` for the meaning of `cache_dir`, `incremental`, `jobs`,
+    `link_mode`, `atomic`, `timer`, `skip_unchanged` and the ignore patterns.
+    With skip_unchanged, the targets nested inside a target are left alone
+    when removing the files that are not outputs. Each target is
+    timed separately, see `SpawnTimer.targets`.
+    """
+    with _run_timer(timer):
+        with _phase(timer, "recipe"):
+            config_path, target_paths = _load_recipe(
+                recipe_path, env_overwrite, ignore_patterns
             )
+        ignore_list = {str(recipe_path.resolve())}
+
+        # Shared by all targets, so that every template is compiled only once
+        persistent_cache, bytecode_cache = _shared_bytecode_cache(cache_dir)
+
+        # The config is only loaded once per env, we checked when loading the recipe
+        # that all sources of a target have the same env
+        config_dicts: t.Dict[str, dict] = dict()
+        with _phase(timer, "config"):
+            for spawn_dicts in target_paths.values():
+                env = spawn_dicts[0]["env"]
+                if env not in config_dicts:
+                    config_dicts[env] = _get_settings(config_path, env)
+
+        # Targets with the same sources share their records and environment
+        sources: t.Dict[tuple, t.Tuple[t.List[FileRecord], Environment]] = dict()
+        with _phase(timer, "walk"):
+            for spawn_dicts in target_paths.values():
+                key = _sources_key(spawn_dicts)
+                if key not in sources:
+                    records = _target_records(spawn_dicts, prefix_name)
+                    loader = SpawnLoader(prefix_name=prefix_name, records=records)
+                    sources[key] = (records, _make_environment(loader, bytecode_cache))
+
+        # Every item of a fan-out gets its own target, so that it is ordered like any
+        # other target. Maps the target of each item to its recipe target and item
+        items: t.Dict[str, t.Tuple[str, dict]] = dict()
+        schedule: t.List[str] = []
+        for t_pth_nm, spawn_dicts in target_paths.items():
+            fan_out = spawn_dicts[0].get("fan_out")
+            if fan_out is None:
+                schedule.append(t_pth_nm)
+                continue
+            config_dict = config_dicts[spawn_dicts[0]["env"]]
+            for item_target, item in _fan_out_targets(
+                config_dict, fan_out, Path(t_pth_nm)
+            ):
+                items[item_target] = (t_pth_nm, item)
+        resolved_targets = {str(Path(t_pth_nm).resolve()) for t_pth_nm in schedule}
+        for item_target in items:
+            resolved = str(Path(item_target).resolve())
+            if resolved in resolved_targets:
+                raise ValueError(
+                    f"Target {item_target} of an item of a fan-out is also the target "
+                    f"of another source!"
+                )
+            resolved_targets.add(resolved)
+            schedule.append(item_target)
+
+        def spawn_target(t_pth_nm: str):
+            target_timer = timer.target(t_pth_nm) if timer is not None else None
+            with _run_timer(target_timer):
+                recipe_target, item = items.get(t_pth_nm, (t_pth_nm, None))
+                spawn_dicts = target_paths[recipe_target]
+                env = spawn_dicts[0]["env"]
+                records, environment = sources[_sources_key(spawn_dicts)]
+                config_dict = config_dicts[env]
+                if item is not None:
+                    config_dict = dict(config_dict, item=item)
+
+                primary = replicas.get(t_pth_nm)
+                if primary is not None:
+                    # Everything is already rendered, so there are no templates left
+                    records = _rendered_records(records, Path(primary), prefix_name)
+                    environment = _make_environment(
+                        SpawnLoader(prefix_name=prefix_name, records=records)
+                    )
+
+                _spawn_write_records(
+                    config_path,
+                    records,
+                    Path(t_pth_nm),
+                    prefix_name,
+                    env_mode=env,
+                    ignore_list=ignore_list,
+                    incremental=incremental,
+                    jobs=jobs,
+                    link_mode=link_mode,
+                    atomic=atomic,
+                    environment=environment,
+                    config_dict=config_dict,
+                    timer=target_timer,
+                    skip_unchanged=skip_unchanged,
+                    preserve=nested[t_pth_nm],
+                )
+
+        parents = _target_parents(schedule)
+        nested: t.Dict[str, t.List[Path]] = {t_pth_nm: [] for t_pth_nm in schedule}
+        for t_pth_nm, parent in parents.items():
+            if parent is not None:
+                nested[parent].append(Path(t_pth_nm))
+        # Replicas are spawned after the target they reuse the outputs of
+        replicas = _replica_targets(target_paths, parents)
+        task_parents = {
+            t_pth_nm: replicas.get(t_pth_nm, parent)
+            for t_pth_nm, parent in parents.items()
+        }
+
+        tasks = {t_pth_nm: partial(spawn_target, t_pth_nm) for t_pth_nm in schedule}
+        _run_schedule(tasks, task_parents, workers)
+
+        if persistent_cache is not None:
+            with _phase(timer, "prune"):
+                persistent_cache.prune()
@@ -0,0 +1,84 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+__all__ = ["make_stage", "discard_stage", "swap_into_place"]
+
+# From linux/fs.h
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def _sibling(target_path: Path, kind: str) -> Path:
+    return target_path.with_name(
+        f".{target_path.name}.confspawn-{kind}-{uuid.uuid4().hex[:12]}"
+    )
+
+
+def make_stage(target_path: Path) -> Path:
+    """Creates an empty staging directory next to `target_path`, so that it is
+    on the same file system and can be renamed into place."""
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    stage_path = _sibling(target_path, "stage")
+    stage_path.mkdir()
+    return stage_path
+
+
+def discard_stage(stage_path: Path):
+    import shutil
+
+    shutil.rmtree(stage_path, ignore_errors=True)
+
+
+def _exchange(a: Path, b: Path) -> bool:
+    """Atomically exchanges the paths `a` and `b` using renameat2, returning
+    False if this is not supported."""
+    if not sys.platform.startswith("linux"):
+        return False
+
+    import ctypes
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+
+    result = renameat2(
+        AT_FDCWD,
+        os.fsencode(a),
+        AT_FDCWD,
+        os.fsencode(b),
+        RENAME_EXCHANGE,
+    )
+    return result == 0
+
+
+def swap_into_place(stage_path: Path, target_path: Path):
+    """Replaces `target_path` by the directory at `stage_path`.
+
+    Where the file system supports it, both are exchanged in a single
+    atomic rename. Otherwise, the old target is first renamed out of the way,
+    so there is only a very short moment in which `target_path` does not
+    exist. The old target is removed afterwards.
+    """
+    import shutil
+
+    if not os.path.lexists(target_path):
+        os.rename(stage_path, target_path)
+        return
+
+    if target_path.is_dir() and not target_path.is_symlink():
+        if _exchange(stage_path, target_path):
+            # The stage path now contains the old target
+            shutil.rmtree(stage_path)
+            return
+
+        old_path = _sibling(target_path, "old")
+        os.rename(target_path, old_path)
+        os.rename(stage_path, target_path)
+        shutil.rmtree(old_path)
+    else:
+        os.unlink(target_path)
+        os.rename(stage_path, target_path)
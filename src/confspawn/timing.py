@@ -0,0 +1,129 @@
+import threading
+import time
+import typing as t
+from contextlib import contextmanager
+
+__all__ = ["SpawnTimer"]
+
+
+class SpawnTimer:
+    """Collects how long each phase of a spawn takes, along with per-template
+    timings and the number and size of the files that were written.
+
+    Pass an instance as `timer` to `spawn_write` or `recipe` and call
+    `to_dict` afterwards to get the results as a JSON-compatible dict. For a
+    recipe, each target gets its own timer in `targets`. To receive the
+    timings while spawning, subclass it and override `on_phase` and
+    `on_template`.
+
+    If memory is True, the peak memory allocated by Python during the spawn
+    is also recorded (using tracemalloc, which slows spawning down). If
+    tracemalloc was already tracing, the peak can only be reset on Python
+    3.9 and later, so on Python 3.8 it is the peak since tracing started.
+    """
+
+    def __init__(self, memory: bool = False) -> None:
+        self.memory = memory
+        self.total = 0.0
+        self.phases: t.Dict[str, float] = dict()
+        self.templates: t.Dict[str, t.Dict[str, float]] = dict()
+        self.files = 0
+        self.bytes = 0
+        self.peak_memory: t.Optional[int] = None
+        self.targets: t.Dict[str, "SpawnTimer"] = dict()
+        self._lock = threading.Lock()
+        # The timer whose hooks are called, and the target that is timed
+        self._root = self
+        self._target_name: t.Optional[str] = None
+
+    def on_phase(self, phase: str, seconds: float, target: t.Optional[str]):
+        """Called after each phase, `target` is None outside a recipe."""
+
+    def on_template(
+        self, name: str, timings: t.Dict[str, float], target: t.Optional[str]
+    ):
+        """Called after each template is rendered, with its compile, render
+        and write durations and its size in bytes."""
+
+    def target(self, target_name: str) -> "SpawnTimer":
+        """Timer for a single target of a recipe."""
+        child = SpawnTimer()
+        child._root = self._root
+        child._target_name = target_name
+        with self._lock:
+            self.targets[target_name] = child
+        return child
+
+    @contextmanager
+    def run(self):
+        """Times the whole spawn (and the peak memory, if enabled)."""
+        tracing = False
+        if self.memory:
+            import tracemalloc
+
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                # A new trace starts with a peak of 0
+                tracemalloc.start()
+            elif hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.total += time.perf_counter() - start
+            if self.memory:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+                if tracing:
+                    tracemalloc.stop()
+
+    @contextmanager
+    def phase(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.perf_counter() - start)
+
+    def add_phase(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self._root.on_phase(phase, seconds, self._target_name)
+
+    def add_files(self, count: int, size: int):
+        """Records non-template files that were placed in the target."""
+        with self._lock:
+            self.files += count
+            self.bytes += size
+
+    def add_template(
+        self, name: str, compile_s: float, render_s: float, write_s: float, size: int
+    ):
+        timings = {
+            "compile": compile_s,
+            "render": render_s,
+            "write": write_s,
+            "bytes": size,
+        }
+        with self._lock:
+            self.templates[name] = timings
+            self.bytes += size
+            for phase in ("compile", "render", "write"):
+                self.phases[phase] = self.phases.get(phase, 0.0) + timings[phase]
+        self._root.on_template(name, timings, self._target_name)
+
+    def to_dict(self) -> dict:
+        result = {
+            "total": self.total,
+            "phases": dict(self.phases),
+            "files": self.files,
+            "bytes": self.bytes,
+            "templates": {name: dict(tm) for name, tm in self.templates.items()},
+        }
+        if self.peak_memory is not None:
+            result["peak_memory"] = self.peak_memory
+        if self.targets:
+            result["targets"] = {
+                name: child.to_dict() for name, child in self.targets.items()
+            }
+        return result
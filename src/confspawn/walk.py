@@ -0,0 +1,96 @@
+import os
+import stat
+import typing as t
+from pathlib import Path
+
+from confspawn.ignore import IgnoreRules
+
+__all__ = ["FileRecord", "walk_files"]
+
+
+class FileRecord:
+    """A file in a source directory, with the stat data needed to spawn it.
+
+    `path` is the absolute path of the file and `rel` its path relative to the
+    source directory, in POSIX form (which is also its template name).
+    `is_template` is True if its name starts with the template prefix.
+    """
+
+    __slots__ = ("path", "rel", "is_template", "mode", "size", "mtime_ns")
+
+    def __init__(
+        self, path: str, rel: str, is_template: bool, st: os.stat_result
+    ) -> None:
+        self.path = path
+        self.rel = rel
+        self.is_template = is_template
+        self.mode = st.st_mode
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+
+    @property
+    def name(self) -> str:
+        return self.rel.rpartition("/")[2]
+
+    @classmethod
+    def from_path(
+        cls, pth: Path, rel_path: Path, prefix_name: str
+    ) -> t.Optional["FileRecord"]:
+        """Creates a record for the file at `pth`, or returns None if it is not a
+        file."""
+        try:
+            st = os.stat(pth)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return cls(
+            str(pth.resolve()),
+            rel_path.as_posix(),
+            pth.name.startswith(prefix_name),
+            st,
+        )
+
+    def __repr__(self) -> str:
+        return f"FileRecord({self.path!r}, {self.rel!r})"
+
+
+def walk_files(
+    root: Path,
+    recurse: bool,
+    prefix_name: str,
+    ignore: t.Optional[IgnoreRules] = None,
+) -> t.Iterator[FileRecord]:
+    """Yields a record for each file in the directory `root` (resolved first).
+
+    If recurse is True, it will also enter subdirectories, but not symbolic
+    links to directories. Every directory is listed using a single scandir
+    call and every file is only stat'ed once. Files and directories excluded
+    by `ignore` are skipped, so excluded directories are never listed.
+    """
+    root_str = str(Path(root).resolve())
+    # Pairs of directories and their path relative to root, "" for root itself
+    stack = [(root_str, "")]
+    while stack:
+        dir_path, rel_dir = stack.pop()
+        subdirs = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recurse and not (ignore and ignore.matches(rel, True)):
+                            subdirs.append((entry.path, rel))
+                        continue
+                    if ignore and ignore.matches(rel):
+                        continue
+                    # Follows symbolic links, like Path.is_file
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    yield FileRecord(
+                        entry.path, rel, entry.name.startswith(prefix_name), st
+                    )
+        # Reversed so that subdirectories are visited in listing order
+        stack.extend(reversed(subdirs))
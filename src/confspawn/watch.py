@@ -0,0 +1,562 @@
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+from confspawn.cache import SpawnBytecodeCache
+from confspawn.config import ConfigPaths, _get_settings
+from confspawn.ignore import IGNORE_FILE, IgnoreRules, load_ignore
+from confspawn.spawn import (
+    SpawnLoader,
+    _load_recipe,
+    _make_environment,
+    _env_targets,
+    _run_schedule,
+    _spawn_fan_out,
+    _spawn_write_records,
+    _target_parents,
+    _target_records,
+    set_cache_dir,
+    set_cache_size,
+    set_prefix_name,
+)
+
+__all__ = ["watch_spawn", "watch_recipe", "InotifyWatcher", "PollingWatcher"]
+
+# A watched directory, whether its subdirectories are watched as well and the rules
+# of the files and directories in it that are not watched
+WatchRoot = t.Tuple[Path, bool, t.Optional[IgnoreRules]]
+
+# A directory watched using inotify, with its path relative to the watched root,
+# whether its subdirectories are watched and the ignore rules of the root
+_WatchedDir = t.Tuple[str, str, bool, t.Optional[IgnoreRules]]
+
+# Reported by a watcher when it lost track of the changes, so everything should be redone
+ALL_CHANGED = "*"
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+# Editors often save a file in multiple steps, so events are collected until none
+# arrive for this many seconds
+DEBOUNCE = 0.05
+
+
+def _join_rel(rel: str, name: str) -> str:
+    return f"{rel}/{name}" if rel else name
+
+
+def _walk_dirs(
+    dir_path: str, rel: str, ignore: t.Optional[IgnoreRules]
+) -> t.Iterator[t.Tuple[str, str, t.List[str]]]:
+    """Like `os.walk`, yielding every directory with its path relative to the
+    watched root and its file names, without entering excluded directories."""
+    for sub_path, dir_names, file_names in os.walk(dir_path):
+        sub_rel = os.path.relpath(sub_path, dir_path)
+        sub_rel = rel if sub_rel == os.curdir else _join_rel(rel, sub_rel)
+        sub_rel = sub_rel.replace(os.sep, "/")
+        if ignore is not None:
+            dir_names[:] = [
+                d for d in dir_names if not ignore.matches(_join_rel(sub_rel, d), True)
+            ]
+        yield sub_path, sub_rel, file_names
+
+
+class PollingWatcher:
+    """Detects changes by regularly comparing the size and modification time of
+    all files in the watched directories."""
+
+    def __init__(self, roots: t.List[WatchRoot], interval: float = 0.5) -> None:
+        self.roots = roots
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> t.Dict[str, t.Tuple[int, int]]:
+        snapshot = dict()
+        for root, recursive, ignore in self.roots:
+            stack = [(str(root), "")]
+            while stack:
+                dir_path, dir_rel = stack.pop()
+                try:
+                    it = os.scandir(dir_path)
+                except OSError:
+                    continue
+                with it:
+                    for entry in it:
+                        rel = _join_rel(dir_rel, entry.name)
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            if ignore is not None and ignore.matches(rel, is_dir):
+                                continue
+                            if is_dir:
+                                if recursive:
+                                    stack.append((entry.path, rel))
+                                continue
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def wait(self, timeout: float) -> t.Set[str]:
+        """Waits at most `timeout` seconds for changes, returning the changed
+        paths."""
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = {
+                pth
+                for pth in snapshot.keys() | self._snapshot.keys()
+                if snapshot.get(pth) != self._snapshot.get(pth)
+            }
+            self._snapshot = snapshot
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Detects changes using Linux's inotify, watching every directory below
+    the recursive roots, except the excluded ones."""
+
+    def __init__(self, roots: t.List[WatchRoot]) -> None:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.fd = fd
+        # Maps watch descriptors to their directory
+        self._dirs: t.Dict[int, _WatchedDir] = dict()
+        for root, recursive, ignore in roots:
+            self._watch_tree(str(root), "", recursive, ignore)
+
+    def _watch(
+        self, dir_path: str, rel: str, recursive: bool, ignore: t.Optional[IgnoreRules]
+    ):
+        wd = self._add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd >= 0:
+            self._dirs[wd] = (dir_path, rel, recursive, ignore)
+
+    def _watch_tree(
+        self, dir_path: str, rel: str, recursive: bool, ignore: t.Optional[IgnoreRules]
+    ):
+        if not recursive:
+            self._watch(dir_path, rel, False, ignore)
+            return
+        for sub_path, sub_rel, _ in _walk_dirs(dir_path, rel, ignore):
+            self._watch(sub_path, sub_rel, True, ignore)
+
+    def _read_events(self, changed: t.Set[str]):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            offset += struct.calcsize("iIII")
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.add(ALL_CHANGED)
+                continue
+            watched = self._dirs.get(wd)
+            if watched is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._dirs[wd]
+                continue
+
+            dir_path, dir_rel, recursive, ignore = watched
+            pth = os.path.join(dir_path, name) if name else dir_path
+            changed.add(pth)
+            if recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                rel = _join_rel(dir_rel, name)
+                if ignore is not None and ignore.matches(rel, True):
+                    continue
+                self._watch_tree(pth, rel, True, ignore)
+                # Files might have been added before the directory was watched
+                for sub_path, _, file_names in _walk_dirs(pth, rel, ignore):
+                    changed.update(os.path.join(sub_path, f) for f in file_names)
+
+    def wait(self, timeout: float) -> t.Set[str]:
+        """Waits at most `timeout` seconds for changes, returning the changed
+        paths."""
+        changed: t.Set[str] = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            self._read_events(changed)
+            ready, _, _ = select.select([self.fd], [], [], DEBOUNCE)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _make_watcher(
+    roots: t.List[WatchRoot], polling: bool, interval: float
+) -> t.Union[InotifyWatcher, PollingWatcher]:
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(roots, interval)
+
+
+def _is_inside(pth: str, root: str, recursive: bool = True) -> bool:
+    if pth == root:
+        return True
+    if recursive:
+        return pth.startswith(root + os.sep)
+    return os.path.dirname(pth) == root
+
+
+class _TargetSession:
+    """State kept between the rounds of watch mode for a single target, so its
+    environment (with the compiled templates) is reused."""
+
+    def __init__(
+        self,
+        config_path: ConfigPaths,
+        spawn_dicts: t.List[dict],
+        target_path: Path,
+        prefix_name: str,
+        ignore_list: set,
+        cache_dir: t.Optional[Path],
+        jobs: int,
+        link_mode: str,
+    ) -> None:
+        self.config_path = config_path
+        self.spawn_dicts = spawn_dicts
+        self.target_path = target_path
+        self.prefix_name = prefix_name
+        self.env_mode = spawn_dicts[0]["env"]
+        self.ignore_list = ignore_list
+        self.jobs = jobs
+        self.link_mode = link_mode
+        self.sources = [
+            (
+                str(Path(s["src"]).resolve()),
+                s["recurse"],
+                load_ignore(s["src"], s.get("ignore")),
+            )
+            for s in spawn_dicts
+        ]
+        self.resolved_target = str(target_path.resolve())
+
+        bytecode_cache = (
+            SpawnBytecodeCache(cache_dir, set_cache_size)
+            if cache_dir is not None
+            else None
+        )
+        self.loader = SpawnLoader(prefix_name=prefix_name, records=[])
+        self.environment = _make_environment(self.loader, bytecode_cache)
+
+    def affected_by(self, changed: t.Set[str]) -> bool:
+        """Whether any of the changed paths is a source file of this target,
+        so not excluded by the ignore rules of its source."""
+        for pth in changed:
+            for src, recurse, ignore in self.sources:
+                if not _is_inside(pth, src, recurse):
+                    continue
+                if ignore is None or pth == src:
+                    return True
+                rel = os.path.relpath(pth, src).replace(os.sep, "/")
+                if not ignore.excludes(rel, os.path.isdir(pth)):
+                    return True
+        return False
+
+    def spawn(self):
+        records = _target_records(self.spawn_dicts, self.prefix_name)
+        self.loader.update_records(records)
+        fan_out = self.spawn_dicts[0].get("fan_out")
+        if fan_out is not None:
+            _spawn_fan_out(
+                self.config_path,
+                records,
+                self.target_path,
+                self.prefix_name,
+                fan_out,
+                self.ignore_list,
+                True,
+                self.jobs,
+                self.link_mode,
+                False,
+                self.environment,
+                _get_settings(self.config_path, self.env_mode),
+                None,
+            )
+            return
+        _spawn_write_records(
+            self.config_path,
+            records,
+            self.target_path,
+            self.prefix_name,
+            env_mode=self.env_mode,
+            ignore_list=self.ignore_list,
+            incremental=True,
+            jobs=self.jobs,
+            link_mode=self.link_mode,
+            environment=self.environment,
+        )
+
+
+def _watch(
+    load: t.Callable[[], t.Tuple[ConfigPaths, t.Dict[str, t.List[dict]]]],
+    recipe_path: t.Optional[Path],
+    prefix_name: str,
+    ignore_list: set,
+    cache_dir: t.Optional[Path],
+    jobs: int,
+    workers: int,
+    link_mode: str,
+    polling: bool,
+    interval: float,
+    stop: t.Optional[threading.Event],
+    on_round: t.Optional[t.Callable[[t.List[str]], None]],
+):
+    def setup():
+        config_path, target_paths = load()
+        sessions = {
+            t_pth_nm: _TargetSession(
+                config_path,
+                spawn_dicts,
+                Path(t_pth_nm),
+                prefix_name,
+                ignore_list,
+                cache_dir,
+                jobs,
+                link_mode,
+            )
+            for t_pth_nm, spawn_dicts in target_paths.items()
+        }
+        parents = _target_parents(list(target_paths))
+        config_paths = (
+            [config_path]
+            if isinstance(config_path, (str, os.PathLike))
+            else config_path
+        )
+        resolved_configs = {str(Path(pth).resolve()) for pth in config_paths}
+        roots: t.List[WatchRoot] = [
+            (parent, False, None)
+            for parent in {Path(pth).parent for pth in resolved_configs}
+        ]
+        if recipe_path is not None:
+            roots.append((recipe_path.resolve().parent, False, None))
+        # Changing the ignore file of a source changes which files are watched
+        ignore_files = set()
+        for session in sessions.values():
+            for src, recurse, ignore in session.sources:
+                roots.append((Path(src), recurse, ignore))
+                ignore_files.add(os.path.join(src, IGNORE_FILE))
+        return resolved_configs, ignore_files, sessions, parents, roots
+
+    def run(names: t.List[str]):
+        # Only the given targets are spawned, each after its closest ancestor that is
+        # also spawned
+        tasks = {name: sessions[name].spawn for name in names}
+        task_parents = dict()
+        for name in names:
+            parent = parents[name]
+            while parent is not None and parent not in tasks:
+                parent = parents[parent]
+            task_parents[name] = parent
+        try:
+            _run_schedule(tasks, task_parents, workers)
+        except Exception as e:
+            # Keep watching, the error is probably fixed by a next change
+            print(f"confspawn: error: {e}", file=sys.stderr)
+        if on_round is not None:
+            on_round(names)
+
+    resolved_configs, ignore_files, sessions, parents, roots = setup()
+    resolved_recipe = str(recipe_path.resolve()) if recipe_path is not None else None
+    # Start watching before the first round, so no change made during it is missed
+    watcher = _make_watcher(roots, polling, interval)
+    run(list(sessions))
+
+    try:
+        while stop is None or not stop.is_set():
+            changed = watcher.wait(interval)
+            # Ignore our own output
+            changed = {
+                pth
+                for pth in changed
+                if not any(
+                    _is_inside(pth, s.resolved_target) for s in sessions.values()
+                )
+            }
+            if not changed:
+                continue
+
+            if (
+                ALL_CHANGED in changed
+                or resolved_recipe in changed
+                or changed & ignore_files
+            ):
+                try:
+                    resolved_configs, ignore_files, sessions, parents, roots = setup()
+                except Exception as e:
+                    print(f"confspawn: error: {e}", file=sys.stderr)
+                    continue
+                watcher.close()
+                watcher = _make_watcher(roots, polling, interval)
+                run(list(sessions))
+            elif changed & resolved_configs:
+                run(list(sessions))
+            else:
+                affected = [
+                    name
+                    for name, session in sessions.items()
+                    if session.affected_by(changed)
+                ]
+                if affected:
+                    run(affected)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def watch_spawn(
+    config_path: ConfigPaths,
+    template_path: Path,
+    target_path: Path,
+    recurse: bool = False,
+    prefix_name: str = set_prefix_name,
+    env_mode: t.Union[str, t.List[str]] = "less",
+    ignore_list: t.Optional[set] = None,
+    cache_dir: t.Optional[Path] = set_cache_dir,
+    jobs: int = 1,
+    link_mode: str = "copy",
+    polling: bool = False,
+    interval: float = 0.5,
+    stop: t.Optional[threading.Event] = None,
+    on_round: t.Optional[t.Callable[[t.List[str]], None]] = None,
+    ignore_patterns: t.Optional[t.List[str]] = None,
+    workers: int = 1,
+    fan_out: t.Optional[str] = None,
+):
+    """Spawns like `spawn_write` (in incremental mode) and then keeps watching
+    the templates and the config, updating only the affected outputs after
+    every change.
+
+    Changes are detected using inotify on Linux, or by polling every
+    `interval` seconds otherwise (or if polling is True). The environment,
+    compiled templates and parsed config are kept between rounds. Watching
+    stops when `stop` is set or on a keyboard interrupt. `on_round` is called
+    with the spawned targets after every round.
+
+    If env_mode is a list of env modes, each is spawned to its own target (see
+    `spawn_write`), by at most `workers` threads at the same time.
+    """
+    if env_mode is None:
+        targets = {str(target_path): env_mode}
+    else:
+        # Like spawn_write, '{env}' is replaced even for a single env mode
+        env_modes = [env_mode] if isinstance(env_mode, str) else env_mode
+        targets = _env_targets(target_path, env_modes)
+    target_paths = {
+        t_pth_nm: [
+            {
+                "src": template_path,
+                "env": env,
+                "recurse": recurse,
+                "ignore": ignore_patterns,
+                "fan_out": fan_out,
+            }
+        ]
+        for t_pth_nm, env in targets.items()
+    }
+    _watch(
+        lambda: (config_path, target_paths),
+        None,
+        prefix_name,
+        ignore_list if ignore_list is not None else set(),
+        cache_dir,
+        jobs,
+        workers,
+        link_mode,
+        polling,
+        interval,
+        stop,
+        on_round,
+    )
+
+
+def watch_recipe(
+    recipe_path: Path,
+    prefix_name: str = set_prefix_name,
+    env_overwrite: t.Optional[str] = None,
+    cache_dir: t.Optional[Path] = set_cache_dir,
+    jobs: int = 1,
+    workers: int = 1,
+    link_mode: str = "copy",
+    polling: bool = False,
+    interval: float = 0.5,
+    stop: t.Optional[threading.Event] = None,
+    on_round: t.Optional[t.Callable[[t.List[str]], None]] = None,
+    ignore_patterns: t.Optional[t.List[str]] = None,
+):
+    """Spawns like `recipe` (in incremental mode) and then keeps watching the
+    recipe, its sources and the config.
+
+    After a change to a source, only the targets of that source are updated.
+    A change to the config updates all targets and a change to the recipe
+    reloads it. See `watch_spawn` for the other arguments.
+    """
+    _watch(
+        lambda: _load_recipe(recipe_path, env_overwrite, ignore_patterns),
+        recipe_path,
+        prefix_name,
+        {str(recipe_path.resolve())},
+        cache_dir,
+        jobs,
+        workers,
+        link_mode,
+        polling,
+        interval,
+        stop,
+        on_round,
+    )
@@ -1,11 +1,25 @@
+import json
 import os
 import shutil
+import subprocess
+import sys
 
 from pathlib import Path
 
 import pytest
+from jinja2 import TemplateNotFound
 
-from confspawn.spawn import spawn_write, load_config_value, recipe
+from confspawn.cache import SpawnBytecodeCache
+from confspawn.cli import config_value
+from confspawn.config import load_toml, clear_config_cache
+from confspawn.walk import walk_files
+from confspawn.spawn import (
+    spawn_write,
+    load_config_value,
+    recipe,
+    SpawnLoader,
+    _target_parents,
+)
 
 
 @pytest.fixture
@@ -71,9 +85,849 @@ def test_recipizer(conf_pth, test_dir, use_dir):
     assert other_path.exists()
     s1_path = use_dir.joinpath("production/s1/some.conf")
     assert s1_path.exists()
+    # The recipe itself is not copied
+    assert not use_dir.joinpath("production/production.spwn.toml").exists()
+
+
+def test_recipizer_workers(conf_pth, test_dir, use_dir):
+    r_path = test_dir.joinpath("recipe/production/production.spwn.toml")
+    recipe(r_path, env_overwrite="production", workers=2)
+    assert use_dir.joinpath("production/some.conf").exists()
+    assert use_dir.joinpath("production/other.conf").exists()
+    assert use_dir.joinpath("production/s1/some.conf").exists()
+
+
+def test_recipe_compiles_once(templ_dir, test_dir, conf_pth, tmp_path, monkeypatch):
+    from jinja2 import Environment
+
+    compiled = []
+    compile_template = Environment.compile
+
+    def counting_compile(self, source, name=None, *args, **kwargs):
+        compiled.append(name)
+        return compile_template(self, source, name, *args, **kwargs)
+
+    monkeypatch.setattr(Environment, "compile", counting_compile)
+    other_dir = test_dir.joinpath("recipe/s1")
+    recipe_path = tmp_path.joinpath("recipe.toml")
+    recipe_path.write_text(
+        f"config = {json.dumps(str(conf_pth))}\n"
+        + "".join(
+            f"[[sources]]\nsource = {json.dumps(str(src))}\n"
+            f"target = {json.dumps(str(tmp_path.joinpath(target)))}\nenv = 'less'\n"
+            for src, target in [
+                (templ_dir, "a"),
+                (templ_dir, "b"),
+                (templ_dir, "c"),
+                (other_dir, "c"),
+            ]
+        )
+    )
+    recipe(recipe_path, cache_dir=None, jobs=1)
+
+    assert sorted(compiled) == sorted(set(compiled))
+    assert tmp_path.joinpath("c/some.conf").exists()
+    for target in "abc":
+        assert tmp_path.joinpath(target, "conf0.conf").exists()
+
+
+def test_recipe_replicas(templ_dir, conf_pth, tmp_path, monkeypatch):
+    import confspawn.spawn
+
+    rendered = []
+    write_template = confspawn.spawn._write_template
+
+    def counting_write(env, templ_name, *args, **kwargs):
+        rendered.append(templ_name)
+        return write_template(env, templ_name, *args, **kwargs)
+
+    monkeypatch.setattr(confspawn.spawn, "_write_template", counting_write)
+    recipe_path = tmp_path.joinpath("recipe.toml")
+    recipe_path.write_text(
+        f"config = {json.dumps(str(conf_pth))}\n"
+        + "".join(
+            f"[[sources]]\nsource = {json.dumps(str(templ_dir))}\n"
+            f"target = {json.dumps(str(tmp_path.joinpath(target)))}\n"
+            f"env = {json.dumps(env)}\nrecurse = true\n"
+            for target, env in [
+                ("r0", "less"),
+                ("r1", "less"),
+                ("r2", "less"),
+                ("prod", "production"),
+            ]
+        )
+    )
+    recipe(recipe_path, workers=2)
+
+    templates = [pth for pth in templ_dir.rglob("confspawn_*") if pth.is_file()]
+    # Once for the replicas and once for production
+    assert len(rendered) == 2 * len(templates)
+    primary = tmp_path.joinpath("r0")
+    for primary_file in primary.rglob("*"):
+        if primary_file.is_file():
+            rel = primary_file.relative_to(primary)
+            for replica in ("r1", "r2"):
+                replica_file = tmp_path.joinpath(replica, rel)
+                assert replica_file.read_bytes() == primary_file.read_bytes()
+                assert replica_file.stat().st_mode == primary_file.stat().st_mode
+                assert not replica_file.samefile(primary_file)
+
+    # A target nested in another one can replace its outputs, so it is not reused
+    config = tmp_path.joinpath("config.toml")
+    config.write_text("[test]\ncoolenv = 'x'\n")
+    source_dir = tmp_path.joinpath("src")
+    source_dir.joinpath("b").mkdir(parents=True)
+    source_dir.joinpath("b/confspawn_i").write_text("{{ test.coolenv }}")
+    source_dir.joinpath("t").write_text("t")
+    other_dir = tmp_path.joinpath("other")
+    other_dir.mkdir()
+    other_dir.joinpath("i").write_text("other")
+    recipe_path.write_text(
+        f"config = {json.dumps(str(config))}\n"
+        + "".join(
+            f"[[sources]]\nsource = {json.dumps(str(src))}\n"
+            f"target = {json.dumps(str(tmp_path.joinpath(target)))}\n"
+            f"env = 'less'\nrecurse = true\n"
+            for src, target in [
+                (source_dir, "out/a"),
+                (other_dir, "out/a/b"),
+                (source_dir, "out/c"),
+            ]
+        )
+    )
+    recipe(recipe_path, workers=2)
+    assert tmp_path.joinpath("out/a/b/i").read_text() == "other"
+    assert tmp_path.joinpath("out/c/b/i").read_text() == "x"
+    assert tmp_path.joinpath("out/c/t").read_text() == "t"
+
+
+def test_target_parents():
+    parents = _target_parents(["a/b/c", "a", "d", "a/b", "./d"])
+    assert parents == {"a/b/c": "a/b", "a": None, "d": None, "a/b": "a", "./d": "d"}
 
 
 def test_env_var(conf_pth):
     var = load_config_value(conf_pth, "test.coolenv")
 
     assert var == "indeedenv"
+
+
+def test_env_var_batch(conf_pth, tmp_path, monkeypatch, capsys):
+    mapping = tmp_path.joinpath("mapping.env")
+    mapping.write_text("# comment\nNAME=default.nested.some_name\n")
+    argv = ["confenv", "-c", str(conf_pth), "-m", str(mapping), "-v", "test.coolenv"]
+    monkeypatch.setattr(sys, "argv", argv)
+    config_value()
+    assert capsys.readouterr().out == (
+        "export NAME='Some Cool Name'\nexport TEST_COOLENV=indeedenv\n"
+    )
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        argv + ["-e", "staging", "-v", "V=confspawn_env.value", "-f", "json"],
+    )
+    config_value()
+    assert json.loads(capsys.readouterr().out) == {
+        "NAME": "Some Cool Name",
+        "TEST_COOLENV": "indeedenv",
+        "V": "forstaging",
+    }
+
+
+@pytest.mark.parametrize(
+    "options", [["--atomic", "--incremental"], ["--atomic", "--skip-unchanged"]]
+)
+def test_cli_conflicting_options(
+    templ_dir, conf_pth, tmp_path, monkeypatch, capsys, options
+):
+    from confspawn.cli import recipizer, spawner
+
+    spawn_argv = ["confspawn", "-c", str(conf_pth), "-s", str(templ_dir)]
+    spawn_argv += ["-t", str(tmp_path.joinpath("target"))]
+    recipe_argv = ["confrecipe", "-r", str(tmp_path.joinpath("recipe.toml"))]
+    for command, argv in [(spawner, spawn_argv), (recipizer, recipe_argv)]:
+        monkeypatch.setattr(sys, "argv", argv + options)
+        with pytest.raises(SystemExit) as exc_info:
+            command()
+        assert exc_info.value.code == 2
+        assert "cannot be combined" in capsys.readouterr().err
+    assert not tmp_path.joinpath("target").exists()
+
+
+def test_loader_index(templ_dir):
+    loader = SpawnLoader(templ_dir, recurse=True)
+    assert sorted(loader.list_templates()) == [
+        "confspawn_conf0.conf",
+        "confspawn_conf1.yaml",
+        "confspawn_script.sh",
+    ]
+    contents, filename, uptodate = loader.get_source(None, "confspawn_script.sh")
+    assert filename == templ_dir.joinpath("confspawn_script.sh").resolve().as_posix()
+    assert uptodate()
+    with pytest.raises(TemplateNotFound):
+        loader.get_source(None, "some/text")
+
+
+def test_bytecode_cache(templ_dir, conf_pth, tmp_path):
+    # Simple templates are not compiled by Jinja, so use a filter in each
+    source_dir = tmp_path.joinpath("source")
+    shutil.copytree(templ_dir, source_dir)
+    for templ in source_dir.glob("confspawn_*"):
+        templ.write_text(templ.read_text() + "{{ test.coolenv | upper }}")
+    configged_dir = tmp_path.joinpath("configged")
+    cache_dir = tmp_path.joinpath("cache")
+    spawn_write(conf_pth, source_dir, configged_dir, cache_dir=cache_dir)
+    cached = sorted(cache_dir.iterdir())
+    assert len(cached) == 3
+    rendered = configged_dir.joinpath("conf0.conf").read_text()
+
+    spawn_write(conf_pth, source_dir, configged_dir, cache_dir=cache_dir)
+    assert configged_dir.joinpath("conf0.conf").read_text() == rendered
+    assert sorted(cache_dir.iterdir()) == cached
+
+    SpawnBytecodeCache(cache_dir, max_size=0).prune()
+    assert list(cache_dir.iterdir()) == []
+
+
+def test_spawn_incremental(templ_dir, conf_pth, tmp_path):
+    source_dir = tmp_path.joinpath("source")
+    shutil.copytree(templ_dir, source_dir)
+    target_dir = tmp_path.joinpath("target")
+    spawn_write(conf_pth, source_dir, target_dir, recurse=True, incremental=True)
+    conf0 = target_dir.joinpath("conf0.conf")
+    conf1 = target_dir.joinpath("conf1.yaml")
+    conf1_mtime = conf1.stat().st_mtime_ns
+
+    source_dir.joinpath("confspawn_conf0.conf").write_text("{{ test.coolenv }}")
+    source_dir.joinpath("some/text").unlink()
+    spawn_write(conf_pth, source_dir, target_dir, recurse=True, incremental=True)
+
+    assert conf0.read_text() == "indeedenv"
+    assert conf1.stat().st_mtime_ns == conf1_mtime
+    assert not target_dir.joinpath("some").exists()
+
+    # Changing the link mode places the non-template files again
+    text = target_dir.joinpath("text")
+    source_dir.joinpath("text").write_text("text")
+    for link_mode in ("symlink", "copy"):
+        spawn_write(
+            conf_pth, source_dir, target_dir, incremental=True, link_mode=link_mode
+        )
+        assert text.is_symlink() == (link_mode == "symlink")
+        assert conf1.stat().st_mtime_ns == conf1_mtime
+
+
+def test_spawn_config_keys(conf_pth, tmp_path):
+    config = tmp_path.joinpath("config.toml")
+    shutil.copy(conf_pth, config)
+    source_dir = tmp_path.joinpath("source")
+    source_dir.mkdir()
+    source_dir.joinpath("confspawn_cool").write_text("{{ test['coolenv'] }}")
+    source_dir.joinpath("confspawn_env").write_text("{{ confspawn_env.value }}")
+    target_dir = tmp_path.joinpath("target")
+    spawn_write(config, source_dir, target_dir, incremental=True, env_mode="staging")
+    env_mtime = target_dir.joinpath("env").stat().st_mtime_ns
+
+    config.write_text(
+        conf_pth.read_text().replace("indeedenv", "changed").replace("forprod", "p")
+    )
+    spawn_write(config, source_dir, target_dir, incremental=True, env_mode="staging")
+
+    assert target_dir.joinpath("cool").read_text() == "changed"
+    assert target_dir.joinpath("env").stat().st_mtime_ns == env_mtime
+
+
+def test_spawn_incremental_dependencies(conf_pth, tmp_path):
+    source_dir = tmp_path.joinpath("source")
+    source_dir.mkdir()
+    source_dir.joinpath("confspawn_part").write_text("part")
+    source_dir.joinpath("confspawn_base").write_text("[{% block b %}{% endblock %}]")
+    source_dir.joinpath("confspawn_main").write_text('{% include "confspawn_part" %}')
+    source_dir.joinpath("confspawn_child").write_text(
+        '{% extends "confspawn_base" %}{% block b %}{% include "confspawn_part" %}'
+        "{% endblock %}"
+    )
+    source_dir.joinpath("confspawn_dynamic").write_text(
+        '{% set name = "confspawn_" ~ "part" %}{% include name %}'
+    )
+    target_dir = tmp_path.joinpath("target")
+    spawn_write(conf_pth, source_dir, target_dir, incremental=True)
+    assert target_dir.joinpath("child").read_text() == "[part]"
+
+    source_dir.joinpath("confspawn_part").write_text("changed part")
+    spawn_write(conf_pth, source_dir, target_dir, incremental=True)
+    for name in ("main", "dynamic"):
+        assert target_dir.joinpath(name).read_text() == "changed part"
+    assert target_dir.joinpath("child").read_text() == "[changed part]"
+
+    source_dir.joinpath("confspawn_base").write_text("({% block b %}{% endblock %})")
+    spawn_write(conf_pth, source_dir, target_dir, incremental=True)
+    assert target_dir.joinpath("child").read_text() == "(changed part)"
+
+
+def test_spawn_parallel(templ_dir, conf_pth, tmp_path):
+    serial_dir = tmp_path.joinpath("serial")
+    parallel_dir = tmp_path.joinpath("parallel")
+    spawn_write(conf_pth, templ_dir, serial_dir, recurse=True)
+    spawn_write(conf_pth, templ_dir, parallel_dir, recurse=True, jobs=2)
+
+    for serial_file in serial_dir.rglob("*"):
+        parallel_file = parallel_dir.joinpath(serial_file.relative_to(serial_dir))
+        if serial_file.is_file():
+            assert parallel_file.read_bytes() == serial_file.read_bytes()
+            assert parallel_file.stat().st_mode == serial_file.stat().st_mode
+
+
+def test_spawn_timings(templ_dir, conf_pth, test_dir, use_dir, tmp_path):
+    from confspawn.timing import SpawnTimer
+
+    class RecordingTimer(SpawnTimer):
+        def __init__(self):
+            super().__init__(memory=True)
+            self.seen = []
+
+        def on_template(self, name, timings, target):
+            self.seen.append((target, name))
+
+    timer = RecordingTimer()
+    spawn_write(conf_pth, templ_dir, tmp_path, recurse=True, timer=timer)
+    timings = json.loads(json.dumps(timer.to_dict()))
+    assert {"walk", "config", "copy", "compile", "render", "write"} <= set(
+        timings["phases"]
+    )
+    assert set(timings["templates"]) == {name for _, name in timer.seen}
+    assert timings["files"] == 1
+    assert timings["peak_memory"] > 0
+
+    timer = RecordingTimer()
+    recipe(test_dir.joinpath("recipe/production/production.spwn.toml"), timer=timer)
+    targets = timer.to_dict()["targets"]
+    assert set(targets) == {"use/production", "use/production/s1"}
+    assert {target for target, _ in timer.seen} == set(targets)
+
+
+def test_config_cache(conf_pth, tmp_path):
+    config = tmp_path.joinpath("config.toml")
+    shutil.copy(conf_pth, config)
+    # Recently modified files are not cached
+    os.utime(config, (0, 0))
+    cache_dir = tmp_path.joinpath("cache")
+
+    loaded = load_toml(config, cache_dir)
+    assert load_toml(config, cache_dir) is loaded
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # Loaded from disk
+    clear_config_cache()
+    assert load_toml(config, cache_dir) == loaded
+
+    config.write_text('[test]\ncoolenv = "changed"\n')
+    os.utime(config, (1, 1))
+    assert load_config_value(config, "test.coolenv") == "changed"
+
+    # Values that JSON does not support survive the disk cache
+    config.write_text(
+        "dt = 1979-05-27T07:32:00-08:00\nlocal = 1979-05-27T07:32:00\n"
+        "day = 1979-05-27\ntime = 07:32:00.5\ninf = inf\n"
+        "[tagged]\n__confspawn__ = ['datetime', '1979-05-27']\n"
+    )
+    os.utime(config, (2, 2))
+    loaded = load_toml(config, cache_dir)
+    clear_config_cache()
+    assert load_toml(config, cache_dir) == loaded
+
+    # A broken cache file is ignored
+    for cache_file in cache_dir.iterdir():
+        cache_file.write_text("{")
+    clear_config_cache()
+    assert load_toml(config, cache_dir) == loaded
+
+
+# Budget for importing the confenv command, in microseconds
+CONFENV_IMPORT_BUDGET = 100_000
+
+
+def test_confenv_startup(conf_pth):
+    code = (
+        "import sys\n"
+        f"sys.argv = ['confenv', '-c', {str(conf_pth)!r}, '-v', 'test.coolenv']\n"
+        "from confspawn.cli import config_value\n"
+        "config_value()\n"
+        "assert 'jinja2' not in sys.modules, 'confenv imported jinja2'\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == "indeedenv\n"
+
+    # Lines look like 'import time: <self> | <cumulative> | <indented module name>'
+    import_time = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() == "confspawn.cli" and not name.startswith("  "):
+            import_time = int(cumulative)
+    assert 0 < import_time < CONFENV_IMPORT_BUDGET
+
+
+@pytest.mark.parametrize(
+    "link_mode", ["copy", "hardlink", "reflink", "symlink", "auto"]
+)
+def test_link_mode(templ_dir, conf_pth, tmp_path, link_mode):
+    target_dir = tmp_path.joinpath("target")
+    spawn_write(conf_pth, templ_dir, target_dir, recurse=True, link_mode=link_mode)
+    text_file = target_dir.joinpath("some/text")
+    source_stat = templ_dir.joinpath("some/text").stat()
+    assert text_file.read_bytes() == templ_dir.joinpath("some/text").read_bytes()
+    # Hard links fall back to copying across file systems
+    if link_mode == "hardlink" and target_dir.stat().st_dev == source_stat.st_dev:
+        assert text_file.stat().st_ino == source_stat.st_ino
+    if link_mode == "symlink":
+        assert text_file.is_symlink()
+
+
+def test_walk_files(templ_dir):
+    records = list(walk_files(templ_dir, True, "confspawn_"))
+    assert sorted((r.rel, r.is_template) for r in records) == [
+        ("confspawn_conf0.conf", True),
+        ("confspawn_conf1.yaml", True),
+        ("confspawn_script.sh", True),
+        ("some/text", False),
+    ]
+    assert all(r.path == str(templ_dir.joinpath(r.rel).resolve()) for r in records)
+    assert "some/text" not in [r.rel for r in walk_files(templ_dir, False, "x")]
+
+
+def test_spawn_atomic(templ_dir, conf_pth, tmp_path):
+    target_dir = tmp_path.joinpath("target")
+    target_dir.mkdir()
+    target_dir.joinpath("old").write_text("old")
+    spawn_write(conf_pth, templ_dir, target_dir, recurse=True, atomic=True)
+    assert not target_dir.joinpath("old").exists()
+    assert target_dir.joinpath("conf0.conf").exists()
+
+    broken_dir = tmp_path.joinpath("broken")
+    broken_dir.mkdir()
+    broken_dir.joinpath("confspawn_broken").write_text("{{ test.coolenv ")
+    with pytest.raises(Exception):
+        spawn_write(conf_pth, broken_dir, target_dir, atomic=True)
+    assert target_dir.joinpath("conf0.conf").exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["broken", "target"]
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watch_spawn(templ_dir, conf_pth, tmp_path, polling):
+    import queue
+    import threading
+
+    from confspawn.watch import watch_spawn
+
+    src_dir = tmp_path.joinpath("src")
+    shutil.copytree(templ_dir, src_dir)
+    src_dir.joinpath("node_modules/dep").mkdir(parents=True)
+    # '{env}' is replaced for a single env mode, like for spawn_write
+    target_dir = tmp_path.joinpath("target-staging")
+    rounds = queue.Queue()
+    stop = threading.Event()
+    watcher = threading.Thread(
+        target=watch_spawn,
+        args=(conf_pth, src_dir, tmp_path.joinpath("target-{env}"), True),
+        kwargs=dict(
+            env_mode="staging",
+            polling=polling,
+            interval=0.1,
+            stop=stop,
+            on_round=rounds.put,
+            ignore_patterns=["node_modules/", "*.tmp"],
+        ),
+    )
+    watcher.start()
+    try:
+        assert rounds.get(timeout=10) == [str(target_dir)]
+        assert target_dir.joinpath("conf0.conf").exists()
+
+        # Changes to excluded files do not start a round
+        src_dir.joinpath("node_modules/dep/index.js").write_text("x")
+        src_dir.joinpath("some/file.tmp").write_text("x")
+        with pytest.raises(queue.Empty):
+            rounds.get(timeout=0.5)
+
+        # Moved into place, so it is never seen half written
+        tmp_path.joinpath("new").write_text("{{ test.coolenv }}")
+        os.replace(tmp_path.joinpath("new"), src_dir.joinpath("confspawn_new.txt"))
+        assert rounds.get(timeout=10) == [str(target_dir)]
+        coolenv = load_config_value(conf_pth, "test.coolenv", "staging")
+        assert target_dir.joinpath("new.txt").read_text() == str(coolenv)
+    finally:
+        stop.set()
+        watcher.join(timeout=10)
+    assert not watcher.is_alive()
+
+
+def test_spawn_streaming(conf_pth, tmp_path):
+    import tracemalloc
+
+    source_dir = tmp_path.joinpath("source")
+    source_dir.mkdir()
+    source_dir.joinpath("confspawn_large").write_text(
+        "{% for i in range(100000) %}{{ test.coolenv * 10 }} {{ i }}\n{% endfor %}"
+    )
+    target_dir = tmp_path.joinpath("target")
+    tracemalloc.start()
+    try:
+        spawn_write(conf_pth, source_dir, target_dir)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    large = target_dir.joinpath("large")
+    assert large.stat().st_size > 8 * 1024 * 1024
+    assert peak < 4 * 1024 * 1024
+
+    source_dir.joinpath("confspawn_large").write_text("a{{ test.coolenv.x.y }}")
+    with pytest.raises(Exception):
+        spawn_write(conf_pth, source_dir, target_dir)
+    assert not large.exists()
+
+
+def test_spawn_memory(templ_dir, conf_pth, tmp_path):
+    from confspawn.spawn import spawn_memory
+
+    target_dir = tmp_path.joinpath("target")
+    spawn_write(conf_pth, templ_dir, target_dir, recurse=True, env_mode="staging")
+    outputs = spawn_memory(conf_pth, [(templ_dir, True)], env_mode="staging")
+
+    written = {
+        p.relative_to(target_dir).as_posix(): p
+        for p in target_dir.rglob("*")
+        if p.is_file()
+    }
+    assert set(outputs) == set(written)
+    assert outputs["some/text"]._data is None
+    for rel, out in outputs.items():
+        assert out.data == written[rel].read_bytes()
+        assert out.mode == written[rel].stat().st_mode & 0o7777
+
+    parsed = spawn_memory(load_toml(conf_pth), [(templ_dir, False)], env_mode="staging")
+    assert parsed["conf0.conf"].data == outputs["conf0.conf"].data
+
+    with pytest.raises(ValueError):
+        spawn_memory(conf_pth, [(templ_dir, True), (templ_dir, True)])
+
+
+def test_ignore_rules():
+    from confspawn.ignore import IgnoreRules
+
+    rules = IgnoreRules(["# comment", "*.tmp", "!keep.tmp", "build/", "/top", "a/**/z"])
+    assert rules.matches("x.tmp") and rules.matches("d/x.tmp")
+    assert not rules.matches("keep.tmp")
+    assert rules.matches("d/build", True) and not rules.matches("d/build")
+    assert rules.matches("top") and not rules.matches("d/top")
+    assert rules.matches("a/z") and rules.matches("a/b/c/z")
+    assert not rules.matches("b/a/z")
+
+
+def test_spawn_ignore(conf_pth, tmp_path, monkeypatch):
+    source_dir = tmp_path.joinpath("source")
+    for rel in ["confspawn_a.tmp", "b.tmp", "keep.tmp", "c", ".git/config", "n/m/x"]:
+        source_dir.joinpath(rel).parent.mkdir(parents=True, exist_ok=True)
+        source_dir.joinpath(rel).write_text("{{ test.coolenv }}")
+    source_dir.joinpath(".confspawnignore").write_text("*.tmp\n!keep.tmp\n")
+
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda p: scanned.append(p) or scandir(p))
+    target_dir = tmp_path.joinpath("target")
+    spawn_write(
+        conf_pth, source_dir, target_dir, recurse=True, ignore_patterns=[".git/", "m"]
+    )
+
+    written = sorted(
+        p.relative_to(target_dir).as_posix()
+        for p in target_dir.rglob("*")
+        if p.is_file()
+    )
+    assert written == ["c", "keep.tmp"]
+    assert not any(".git" in str(p) or str(p).endswith("m") for p in scanned)
+
+    recipe_path = tmp_path.joinpath("recipe.toml")
+    recipe_path.write_text(
+        f"config = {json.dumps(str(conf_pth))}\nignore = ['.git/']\n"
+        f"[[sources]]\nsource = {json.dumps(str(source_dir))}\n"
+        f"target = {json.dumps(str(target_dir))}\nenv = 'less'\nrecurse = true\n"
+        f"ignore = ['c']\n"
+    )
+    recipe(recipe_path)
+    written = sorted(
+        p.relative_to(target_dir).as_posix()
+        for p in target_dir.rglob("*")
+        if p.is_file()
+    )
+    assert written == ["keep.tmp", "n/m/x"]
+
+
+def test_spawn_envs(templ_dir, conf_pth, tmp_path, monkeypatch):
+    from jinja2 import Environment
+
+    from confspawn.timing import SpawnTimer
+
+    single_dir = tmp_path.joinpath("single")
+    spawn_write(conf_pth, templ_dir, single_dir, recurse=True, env_mode="production")
+
+    compiled = []
+    compile_template = Environment.compile
+
+    def counting_compile(self, source, name=None, *args, **kwargs):
+        compiled.append(name)
+        return compile_template(self, source, name, *args, **kwargs)
+
+    monkeypatch.setattr(Environment, "compile", counting_compile)
+    timer = SpawnTimer()
+    envs = ["staging", "production"]
+    target = tmp_path.joinpath("out/{env}")
+    spawn_write(
+        conf_pth, templ_dir, target, recurse=True, env_mode=envs, workers=2, timer=timer
+    )
+
+    assert sorted(compiled) == sorted(set(compiled))
+    assert set(timer.to_dict()["targets"]) == {
+        str(tmp_path.joinpath("out", env)) for env in envs
+    }
+    for single_file in single_dir.rglob("*"):
+        if single_file.is_file():
+            rel = single_file.relative_to(single_dir)
+            prod_file = tmp_path.joinpath("out/production", rel)
+            assert prod_file.read_bytes() == single_file.read_bytes()
+            assert tmp_path.joinpath("out/staging", rel).exists()
+
+    with pytest.raises(ValueError):
+        spawn_write(conf_pth, templ_dir, tmp_path.joinpath("out"), env_mode=envs)
+
+
+def test_process_pools_in_threads(templ_dir, conf_pth, tmp_path, monkeypatch):
+    import concurrent.futures
+
+    contexts = []
+    pool_executor = concurrent.futures.ProcessPoolExecutor
+
+    def recording_executor(*args, **kwargs):
+        contexts.append(kwargs.get("mp_context"))
+        return pool_executor(*args, **kwargs)
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", recording_executor)
+    target = tmp_path.joinpath("out/{env}")
+    envs = ["staging", "production"]
+    spawn_write(
+        conf_pth, templ_dir, target, recurse=True, env_mode=envs, workers=2, jobs=2
+    )
+
+    # Processes are not forked from the threads spawning the envs
+    assert len(contexts) == 2
+    assert all(c is not None and c.get_start_method() != "fork" for c in contexts)
+    single_dir = tmp_path.joinpath("single")
+    spawn_write(conf_pth, templ_dir, single_dir, recurse=True, env_mode="production")
+    for single_file in single_dir.rglob("*"):
+        if single_file.is_file():
+            rel = single_file.relative_to(single_dir)
+            prod_file = tmp_path.joinpath("out/production", rel)
+            assert prod_file.read_bytes() == single_file.read_bytes()
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_spawn_fan_out(tmp_path, jobs):
+    config = tmp_path.joinpath("config.toml")
+    config.write_text(
+        "[test]\ncoolenv = 'x'\n"
+        + "".join(f"[[hosts]]\nname = 'h{i}'\nport = {i}\n" for i in range(5))
+    )
+    source_dir = tmp_path.joinpath("source")
+    source_dir.mkdir()
+    source_dir.joinpath("confspawn_host.conf").write_text(
+        "{{ item.name }}:{{ item.port }} {{ test.coolenv }}"
+    )
+    source_dir.joinpath("static").write_text("static")
+
+    spawn_write(
+        config, source_dir, tmp_path.joinpath("out/{name}"), fan_out="hosts", jobs=jobs
+    )
+    for i in range(5):
+        host_dir = tmp_path.joinpath(f"out/h{i}")
+        assert host_dir.joinpath("host.conf").read_text() == f"h{i}:{i} x"
+        assert host_dir.joinpath("static").read_text() == "static"
+
+    with pytest.raises(ValueError):
+        spawn_write(config, source_dir, tmp_path.joinpath("same"), fan_out="hosts")
+
+    extra_dir = tmp_path.joinpath("extra")
+    extra_dir.mkdir()
+    extra_dir.joinpath("more").write_text("more")
+    recipe_path = tmp_path.joinpath("recipe.toml")
+    recipe_path.write_text(
+        f"config = {json.dumps(str(config))}\n[[sources]]\n"
+        f"source = {json.dumps(str(source_dir))}\n"
+        f"target = {json.dumps(str(tmp_path.joinpath('r/{port}')))}\n"
+        f"env = 'less'\nfan_out = 'hosts'\n[[sources]]\n"
+        f"source = {json.dumps(str(extra_dir))}\n"
+        f"target = {json.dumps(str(tmp_path.joinpath('r/3/extra')))}\n"
+        f"env = 'less'\n"
+    )
+    recipe(recipe_path, jobs=jobs, workers=2)
+    assert tmp_path.joinpath("r/3/host.conf").read_text() == "h3:3 x"
+    # The plain target is spawned after the item that contains it
+    assert tmp_path.joinpath("r/3/extra/more").read_text() == "more"
+
+    config.write_text("item = 'shadowed'\n[[hosts]]\nname = 'h0'\nport = 0\n")
+    with pytest.raises(ValueError):
+        recipe(recipe_path)
+
+
+@pytest.mark.parametrize("link_mode", ["copy", "symlink"])
+def test_spawn_skip_unchanged(tmp_path, link_mode):
+    config = tmp_path.joinpath("config.toml")
+    config.write_text("[test]\ncoolenv = 'x'\nother = 'y'\n")
+    source_dir = tmp_path.joinpath("source")
+    source_dir.joinpath("sub").mkdir(parents=True)
+    source_dir.joinpath("confspawn_a.conf").write_text("a {{ test.coolenv }}\n")
+    source_dir.joinpath("sub/confspawn_b.conf").write_text("b {{ test.other }}\n")
+    source_dir.joinpath("static").write_text("static")
+    target = tmp_path.joinpath("out")
+
+    def spawn():
+        spawn_write(
+            config,
+            source_dir,
+            target,
+            recurse=True,
+            link_mode=link_mode,
+            skip_unchanged=True,
+        )
+
+    spawn()
+    target.joinpath("stale/deeper").mkdir(parents=True)
+    target.joinpath("stale/deeper/old").write_text("old")
+    before = {
+        rel: os.lstat(target.joinpath(rel))
+        for rel in ("a.conf", "sub/b.conf", "static")
+    }
+
+    config.write_text("[test]\ncoolenv = 'x'\nother = 'z'\n")
+    source_dir.joinpath("confspawn_a.conf").chmod(0o600)
+    spawn()
+    after = {rel: os.lstat(target.joinpath(rel)) for rel in before}
+
+    assert target.joinpath("sub/b.conf").read_text() == "b z"
+    assert after["sub/b.conf"].st_ino != before["sub/b.conf"].st_ino
+    for rel in ("a.conf", "static"):
+        assert after[rel].st_ino == before[rel].st_ino
+        assert after[rel].st_mtime_ns == before[rel].st_mtime_ns
+    assert after["a.conf"].st_mode & 0o777 == 0o600
+    assert target.joinpath("a.conf").read_text() == "a x"
+    assert not target.joinpath("stale").exists()
+
+    # Outputs hard linked to their source are placed again for other link modes
+    static = target.joinpath("static")
+    for mode in ("hardlink", link_mode):
+        spawn_write(config, source_dir, target, link_mode=mode, skip_unchanged=True)
+        assert os.path.samefile(static, source_dir.joinpath("static")) == (
+            mode != "copy"
+        )
+    assert static.is_symlink() == (link_mode == "symlink")
+
+    with pytest.raises(ValueError):
+        spawn_write(config, source_dir, target, atomic=True, skip_unchanged=True)
+
+
+def test_simple_templates(tmp_path):
+    from confspawn.spawn import _make_environment
+
+    context = {"a": {"b": {"c": 1, "items": [1]}, "n": None}, "d": "x"}
+    templates = {
+        "confspawn_plain": "{{ a.b.c }} and {{ a['b'].c }}\r\nend\n",
+        "confspawn_ws": "x {{- d -}} \n  y {# comment #}{{ 'const' }} {{ 3 }}\n\n",
+        "confspawn_missing": "{{ missing }} {{ a.n }} {{ a.b['items'][0] }}",
+        "confspawn_global": "{{ range }}{{ a.b.items }}",
+        "confspawn_filter": "{{ d | upper }}",
+        "confspawn_block": "{% if d %}{{ d }}{% endif %}",
+        "confspawn_page.html": "{{ d }}",
+    }
+    for name, source in templates.items():
+        tmp_path.joinpath(name).write_bytes(source.encode())
+    loader = SpawnLoader(tmp_path)
+    env = _make_environment(loader)
+
+    simple = {name for name in templates if loader.get_simple(env, name)}
+    assert simple == {
+        "confspawn_plain",
+        "confspawn_ws",
+        "confspawn_missing",
+        "confspawn_global",
+    }
+    for name in simple:
+        expected = env.get_template(name).render(context)
+        assert loader.get_simple(env, name).render(context) == expected
+
+    tmp_path.joinpath("confspawn_undefined").write_text("{{ missing.x }}")
+    loader.update_records(list(walk_files(tmp_path, False, "confspawn_")))
+    with pytest.raises(Exception) as simple_error:
+        loader.get_simple(env, "confspawn_undefined").render(context)
+    with pytest.raises(Exception) as jinja_error:
+        env.get_template("confspawn_undefined").render(context)
+    assert type(simple_error.value) is type(jinja_error.value)
+
+
+def test_layered_config(conf_pth, tmp_path, monkeypatch):
+    from confspawn import config as config_module
+    from confspawn.config import ConfigOverlay, load_config
+
+    override = tmp_path.joinpath("override.toml")
+    override.write_text(
+        "[default.nested]\na = 'OverA'\n[confspawn_env.staging]\nvalue = 'over'\n"
+        "[test]\ncoolenv = ['list']\n"
+    )
+    base = tmp_path.joinpath("base.toml")
+    shutil.copy(conf_pth, base)
+    # Recently modified files are not cached
+    os.utime(base, (0, 0))
+    os.utime(override, (0, 0))
+    layers = [base, override]
+
+    merged = load_config(layers)
+    assert isinstance(merged, ConfigOverlay)
+    nested = merged["default"]["nested"]
+    assert nested["a"] == "OverA" and nested["b"] == "ThisB"
+    assert list(nested)[:2] == ["some_name", "a"]
+    assert merged["test"]["coolenv"] == ["list"]
+
+    assert load_config_value(layers, "confspawn_env.value", "staging") == "over"
+    assert load_config_value(layers, "confspawn_env.value", "production") == "forprod"
+    assert load_config_value(layers, "default.nested")["d"] == "ThisD"
+
+    # Only the changed layer is parsed again
+    parsed = []
+    toml_load = config_module.tomli.load
+    monkeypatch.setattr(
+        config_module.tomli, "load", lambda f: parsed.append(f.name) or toml_load(f)
+    )
+    override.write_text("[default.nested]\na = 'Changed'\n")
+    os.utime(override, (1, 1))
+    assert load_config_value(layers, "default.nested.a") == "Changed"
+    assert parsed == [str(override)]
+
+    source_dir = tmp_path.joinpath("source")
+    source_dir.mkdir()
+    source_dir.joinpath("confspawn_a").write_text("{{ default.nested.a }}")
+    source_dir.joinpath("confspawn_b").write_text("{{ default.nested.b | lower }}")
+    target_dir = tmp_path.joinpath("target")
+    spawn_write(layers, source_dir, target_dir, incremental=True)
+    assert target_dir.joinpath("a").read_text() == "Changed"
+    assert target_dir.joinpath("b").read_text() == "thisb"
+
+    # Merged tables render like they do for a single config file
+    source_dir.joinpath("confspawn_c").write_text("{{ default.nested | tojson }}")
+    spawn_write(layers, source_dir, target_dir)
+    expected = dict(load_config_value(base, "default.nested"), a="Changed")
+    assert json.loads(target_dir.joinpath("c").read_text()) == expected